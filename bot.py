@@ -3,29 +3,69 @@ import asyncio
 import uuid
 import logging
 import time
+import threading
+import heapq
+import hashlib
+import math
+import hmac
+import base64
+import signal
+import multiprocessing
+import sqlite3
 from datetime import datetime, timedelta
 import json
 import os
 import copy
-from aiogram import Bot, Dispatcher, F
+import re
+import html
+from collections import Counter, OrderedDict, deque
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
-    Message, CallbackQuery,
+    Message, CallbackQuery, ChatMemberUpdated, InlineQuery,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo,
+    InlineQueryResultCachedMpeg4Gif, InputTextMessageContent,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
     InputMediaPhoto, InputMediaVideo, InputMediaAnimation
 )
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.filters import Command
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+)
 
 # =====================
 # НАСТРОЙКИ
 # =====================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Режим получения апдейтов: polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Вебхук: Telegram шлет апдейты на WEBHOOK_URL + WEBHOOK_PATH с заголовком
+# X-Telegram-Bot-Api-Secret-Token = WEBHOOK_SECRET. Без WEBHOOK_URL вебхук не регистрируется —
+# так сервер можно проверить локально, отправляя сохраненные Update JSON:
+# curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -H "Content-Type: application/json" \
+#      -d @update.json http://localhost:8080/webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Число процессов-обработчиков апдейтов (больше 1 — только с STORAGE_BACKEND=sqlite)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Служебный чат для рассылок (например, закрытый канал с ботом-админом): пост отправляется туда
+# один раз, а получателям уходит copy_message. Без него пост отправляется каждому целиком
+BROADCAST_STAGING_CHAT_ID = int(os.getenv("BROADCAST_STAGING_CHAT_ID", "0")) or None
 BOT_USERNAME = "yakmodsbot"  # Имя бота в Telegram
 OWNER_ID = 7388744796  # Создатель бота
 admins = {7388744796}  # Множество админов (создатель по умолчанию)
@@ -46,9 +86,19 @@ CATEGORIES = {
     "all": "📂 Все моды"
 }
 
+MODS_PER_PAGE = 8  # Модов на странице каталога
+MANAGE_PER_PAGE = 10  # Модов на странице управления
+
 SUGGESTION_COOLDOWN = 60  # 5 минут в секундах
 MAX_SUGGESTIONS_PER_USER = 10  # Максимум предложений до бана
 
+FSM_TTL = 24 * 3600  # Через сколько секунд незавершенный диалог (добавление мода и т.п.) сбрасывается
+FSM_CACHE_SIZE = 1000  # Состояний FSM в памяти процесса
+FSM_SWEEP_INTERVAL = 3600  # Как часто удалять брошенные состояния из хранилища
+DRAFT_TTL = 24 * 3600  # Через сколько секунд неподтвержденный черновик поста удаляется вместе с превью
+MAX_DRAFTS = 50  # Больше черновиков не храним: лишние удаляются, начиная с самых старых
+DRAFT_SWEEP_INTERVAL = 600  # Как часто искать брошенные черновики
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -63,17 +113,229 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
-dp = Dispatcher()
+class StorageFSM(BaseStorage):
+    """FSM-хранилище поверх общего `storage`: состояние переживает перезапуск и видно всем процессам"""
+
+    def __init__(self, ttl: float, cache_size: int, sweep_interval: float):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.sweep_interval = sweep_interval
+        # Апдейты пользователя всегда попадают в один процесс (см. run_front),
+        # поэтому записи в кеше не расходятся с базой
+        self._cache = OrderedDict()  # {key: (state, data, updated_at)}
+        self._task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _get(self, key: str) -> tuple:
+        """Запись (state, data) из кеша или хранилища; брошенные дольше ttl считаются пустыми"""
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = await storage.get_fsm(key)
+        else:
+            self._cache.move_to_end(key)
+        state, data, updated_at = entry
+        if (state is not None or data) and updated_at < time.time() - self.ttl:
+            # Запись удалит очистка (prune_fsm), пользователь начинает с чистого листа
+            state, data = None, {}
+        self._put(key, state, data, updated_at)
+        return state, data
+
+    def _put(self, key: str, state, data: dict, updated_at: float):
+        self._cache[key] = (state, data, updated_at)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def set_state(self, key: StorageKey, state=None):
+        key = self._key(key)
+        state = state.state if isinstance(state, State) else state
+        _, data = await self._get(key)
+        await storage.set_fsm_state(key, state)
+        self._put(key, state, data, time.time())
+
+    async def get_state(self, key: StorageKey):
+        state, _ = await self._get(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict):
+        key = self._key(key)
+        state, _ = await self._get(key)
+        data = dict(data)
+        await storage.set_fsm_data(key, data)
+        self._put(key, state, data, time.time())
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, data = await self._get(self._key(key))
+        return dict(data)
+
+    async def update_data(self, key: StorageKey, data: dict) -> dict:
+        """Дополняет данные без лишнего копирования: одно чтение (обычно из кеша) и одна запись"""
+        key = self._key(key)
+        state, current = await self._get(key)
+        current = {**current, **data}
+        await storage.set_fsm_data(key, current)
+        self._put(key, state, current, time.time())
+        return dict(current)
+
+    async def prune(self):
+        """Удаляет состояния, брошенные дольше ttl"""
+        before = time.time() - self.ttl
+        for key in [key for key, entry in self._cache.items() if entry[2] < before]:
+            del self._cache[key]
+        try:
+            removed = await storage.prune_fsm(before)
+        except Exception as e:
+            logger.error(f"Ошибка очистки состояний FSM: {e}")
+            return
+        if removed:
+            logger.info(f"Удалено брошенных состояний FSM: {removed}")
+
+    async def _run(self):
+        while True:
+            await self.prune()
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._cache.clear()
+
+    async def close(self):
+        """Хранилище закрывается в on_shutdown"""
+
+
+fsm_storage = StorageFSM(FSM_TTL, FSM_CACHE_SIZE, FSM_SWEEP_INTERVAL)
+# FSM-мидлварь подключается вручную после ограничителя частоты (см. ThrottlingMiddleware)
+dp = Dispatcher(storage=fsm_storage, disable_fsm=True)
+
+
+class BotContext:
+    """Общие данные бота, которые не нужно запрашивать на каждый апдейт"""
+
+    def __init__(self):
+        # До первого get_me используем имя из настроек
+        self.username = BOT_USERNAME
+        self.id = None
+
+    async def refresh(self):
+        """Перечитывает профиль бота из Telegram (при запуске и по требованию)"""
+        me = await bot.get_me()
+        if me.username != self.username:
+            # В готовых клавиатурах зашито имя бота
+            render_cache.clear()
+            inline_cache.clear()
+        self.username = me.username
+        self.id = me.id
+        return me
+
+
+bot_context = BotContext()
 
 # Хранилища данных
+# Пользователи и кулдауны предложений живут только в хранилище (см. `storage`),
+# баны, админы и черновики — в памяти с записью в хранилище
 posts = {}  # {post_id: {data, downloads: 0}}
-users = set()  # Все пользователи
 banned_users = set()  # Забаненные пользователи
-suggestion_cooldowns = {}  # {user_id: last_time}
 suggestion_violations = {}  # {user_id: count}
 
-# Черновики и правки: новые посты и незавершенные изменения
-drafts = {}   # {post_id: data}  (не публикуемые пока)
+
+class DraftStore:
+    """Черновики новых постов: живут ttl секунд, не больше max_size штук (лишние — с самых старых)"""
+
+    def __init__(self, ttl: float, max_size: int, sweep_interval: float):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # {post_id: data} от старых к новым
+        self._expires = {}  # {post_id: когда черновик считается брошенным}
+        self._task = None
+
+    def __contains__(self, post_id: str) -> bool:
+        return post_id in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, post_id: str):
+        return self._data.get(post_id)
+
+    def _put(self, post_id: str, data: dict, ttl: float = None):
+        self._data[post_id] = data
+        self._data.move_to_end(post_id)
+        self._expires[post_id] = data.get('created_at', time.time()) + (ttl or self.ttl)
+
+    async def add(self, post_id: str, data: dict, ttl: float = None):
+        """Добавляет черновик; при переполнении удаляет самые старые"""
+        self._put(post_id, data, ttl)
+        await self._trim()
+
+    async def _trim(self):
+        while len(self._data) > self.max_size:
+            oldest = next(iter(self._data))
+            logger.info(f"Черновик {oldest} вытеснен: превышен лимит {self.max_size}")
+            await self.discard(oldest)
+
+    def load(self, saved: dict):
+        """Черновики из хранилища (при запуске); просроченные удалит первая очистка"""
+        for post_id, data in sorted(saved.items(), key=lambda item: item[1].get('created_at', 0)):
+            self._put(post_id, data)
+
+    def pop(self, post_id: str):
+        """Забирает черновик (при публикации); превью остаются на совести вызывающего"""
+        self._expires.pop(post_id, None)
+        return self._data.pop(post_id, None)
+
+    async def discard(self, post_id: str):
+        """Удаляет черновик вместе с превью-сообщениями и записью в хранилище"""
+        data = self.pop(post_id)
+        if data is None:
+            return
+        for chat_id, msg_id in data.get('preview_messages', []):
+            try:
+                await bot.delete_message(chat_id, msg_id)
+            except (TelegramBadRequest, TelegramForbiddenError):
+                # Превью уже удалено или бот больше не видит чат
+                pass
+        render_cache.invalidate(post_id)
+        try:
+            await storage.delete_draft(post_id)
+        except Exception as e:
+            logger.error(f"Ошибка удаления черновика {post_id}: {e}")
+
+    async def sweep(self):
+        """Удаляет черновики, брошенные дольше ttl"""
+        now = time.time()
+        expired = [post_id for post_id, expires in self._expires.items() if expires <= now]
+        for post_id in expired:
+            await self.discard(post_id)
+        if expired:
+            logger.info(f"Удалено брошенных черновиков: {len(expired)}")
+        # После загрузки из хранилища черновиков может оказаться больше лимита
+        await self._trim()
+
+    async def _run(self):
+        while True:
+            await self.sweep()
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# Черновики и правки: новые посты и незавершенные изменения (не публикуемые пока)
+drafts = DraftStore(DRAFT_TTL, MAX_DRAFTS, DRAFT_SWEEP_INTERVAL)
 
 
 # FSM состояния
@@ -98,155 +360,2477 @@ class AddAdmin(StatesGroup):
     waiting_admin_id = State()
 
 
+# =====================
+# ИДЕНТИФИКАТОРЫ ПОСТОВ
+# =====================
+
+# Посты нумеруются по порядку, номер записывается в base62: "1", "a", "Z", "10", ...
+# Раньше ключом был UUID — он остается в post['aliases'], чтобы старые ссылки открывались
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def encode_base62(number: int) -> str:
+    digits = []
+    while True:
+        number, rem = divmod(number, 62)
+        digits.append(BASE62[rem])
+        if not number:
+            return "".join(reversed(digits))
+
+
+def decode_base62(text: str) -> int:
+    number = 0
+    for char in text:
+        number = number * 62 + BASE62.index(char)
+    return number
+
+
+def is_legacy_post_id(post_id: str) -> bool:
+    """Ключ поста старого формата (UUID)"""
+    return len(post_id) == 36 and post_id.count("-") == 4
+
+
+def last_post_seq(post_ids) -> int:
+    """Наибольший номер среди коротких id"""
+    return max((decode_base62(pid) for pid in post_ids if not is_legacy_post_id(pid)), default=0)
+
+
+def alias_post(post: dict, old_id: str, new_id: str) -> dict:
+    """Переносит пост на новый id, запоминая старый"""
+    post['aliases'] = [*post.get('aliases', []), old_id]
+    if 'post_id' in post:
+        post['post_id'] = new_id
+    return post
+
+
+class PostIdIndex:
+    """Старые id постов в обе стороны: старый -> текущий (для ссылок) и текущий -> старые"""
+
+    def __init__(self):
+        self._current = {}  # {старый id: id поста}
+        self._aliases = {}  # {id поста: [старые id]}
+
+    def add(self, post_id: str, post: dict):
+        self.remove(post_id)
+        aliases = post.get('aliases')
+        if aliases:
+            self._aliases[post_id] = list(aliases)
+            for alias in aliases:
+                self._current[alias] = post_id
+
+    def remove(self, post_id: str):
+        for alias in self._aliases.pop(post_id, ()):
+            self._current.pop(alias, None)
+
+    def resolve(self, post_id: str) -> str:
+        """Текущий id поста по любому из его id"""
+        return self._current.get(post_id, post_id)
+
+    def aliases(self, post_id: str) -> list:
+        return self._aliases.get(post_id, [])
+
+    def clear(self):
+        self._current.clear()
+        self._aliases.clear()
+
+
+post_ids = PostIdIndex()
+
+
 # ФАЙЛ ДЛЯ ХРАНЕНИЯ ПОСТОВ
 POSTS_FILE = "posts.json"
+# Журнал скачиваний: одна короткая строка "post_id<TAB>delta" на каждое скачивание.
+# Снимок posts.json переписывается только при сжатии журнала или при правке постов.
+DOWNLOADS_JOURNAL = "downloads.journal"
+DOWNLOADS_JOURNAL_OLD = DOWNLOADS_JOURNAL + ".old"
+JOURNAL_COMPACT_INTERVAL = 60  # Как часто сжимать журнал в снимок (сек)
+
+_journal_file = None  # Открытый на дозапись журнал
+_journal_records = 0  # Записей в журнале с момента последнего снимка
+_journal_rotations = 0  # Счетчик ротаций журнала
+# Поколение журнала: пишется заголовком "#<TAB>номер" в начало файла и растет при каждой ротации.
+# Снимок помнит последнее вошедшее в него поколение — такие записи при загрузке не доигрываются.
+JOURNAL_GEN_KEY = "journal_generation"
+_journal_generation = 1  # Поколение текущего журнала
+_snapshot_lock = threading.Lock()
+_snapshot_seq = 0  # Номер последнего сериализованного снимка
+_written_seq = 0  # Номер последнего записанного на диск снимка
+_compactor_task = None
+# Последний выданный номер поста хранится в снимке под этим ключом (id постов — base62, не совпадут)
+POST_SEQ_KEY = "post_seq"
+_post_seq = 0  # Последний выданный номер поста
+
+
+def _open_journal():
+    """Открывает журнал скачиваний на дозапись (лениво)"""
+    global _journal_file
+    if _journal_file is None:
+        _journal_file = open(DOWNLOADS_JOURNAL, "a", encoding="utf-8")
+        if _journal_file.tell() == 0:
+            _journal_file.write(f"#\t{_journal_generation}\n")
+    return _journal_file
+
+
+def _rotate_journal():
+    """Переносит текущий журнал в .old и начинает новый"""
+    global _journal_file, _journal_records, _journal_rotations, _journal_generation
+    if _journal_file is not None:
+        _journal_file.close()
+        _journal_file = None
+    if os.path.exists(DOWNLOADS_JOURNAL):
+        if os.path.exists(DOWNLOADS_JOURNAL_OLD):
+            # Прошлое сжатие не дошло до конца — дописываем к старому журналу
+            with open(DOWNLOADS_JOURNAL, "r", encoding="utf-8") as src, \
+                    open(DOWNLOADS_JOURNAL_OLD, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(DOWNLOADS_JOURNAL)
+        else:
+            os.replace(DOWNLOADS_JOURNAL, DOWNLOADS_JOURNAL_OLD)
+    _journal_records = 0
+    _journal_rotations += 1
+    _journal_generation += 1
+
+
+def _drop_rotated_journal():
+    """Удаляет старый журнал, когда его записи уже попали в снимок"""
+    try:
+        os.remove(DOWNLOADS_JOURNAL_OLD)
+    except FileNotFoundError:
+        pass
+
+
+def _dump_posts() -> tuple:
+    """Сериализует `posts` и выдает номер снимка"""
+    global _snapshot_seq
+    _snapshot_seq += 1
+    # Номер сохраняется, чтобы id удаленных постов не выдавались снова после перезапуска.
+    # Снимок снимается сразу после ротации: все прежние поколения журнала в нем уже учтены.
+    snapshot = {**posts, POST_SEQ_KEY: _post_seq, JOURNAL_GEN_KEY: _journal_generation - 1}
+    # Несброшенный прирост еще попадет в журнал — в снимке его быть не должно
+    pending = {pid: delta for pid, delta in download_counter.pending().items() if pid in posts}
+    for pid, delta in pending.items():
+        snapshot[pid] = {**posts[pid], 'downloads': posts[pid].get('downloads', 0) - delta}
+    return json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")), _snapshot_seq
+
+
+def _write_snapshot(payload: str, seq: int):
+    """Атомарно записывает снимок на диск (более старый снимок не перетирает новый)"""
+    global _written_seq
+    with _snapshot_lock:
+        if seq <= _written_seq:
+            return
+        tmp_path = POSTS_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, POSTS_FILE)
+        _written_seq = seq
+
 
 def save_posts():
-    """Сохраняет `posts` в JSON-файл"""
+    """Сохраняет полный снимок `posts` в JSON-файл и обнуляет журнал скачиваний"""
     try:
-        with open(POSTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(posts, f, ensure_ascii=False, indent=2)
+        _rotate_journal()
+        payload, seq = _dump_posts()
+        _write_snapshot(payload, seq)
+        _drop_rotated_journal()
     except Exception as e:
         logger.error(f"Не удалось сохранить posts: {e}")
 
 
+def append_download_journal(deltas: dict):
+    """Дописывает в журнал пачку записей о скачиваниях одной записью на диск"""
+    global _journal_records
+    try:
+        journal = _open_journal()
+        journal.write("".join(f"{post_id}\t{delta}\n" for post_id, delta in deltas.items()))
+        journal.flush()
+        _journal_records += len(deltas)
+    except Exception as e:
+        logger.error(f"Ошибка записи в журнал скачиваний: {e}")
+
+
+def _replay_journal(snapshot_generation: int) -> int:
+    """Применяет к `posts` записи журналов, не попавшие в снимок"""
+    replayed = 0
+    for path in (DOWNLOADS_JOURNAL_OLD, DOWNLOADS_JOURNAL):
+        if not os.path.exists(path):
+            continue
+        # Записи без заголовка (журнал старой версии) доигрываются всегда
+        generation = None
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                # Оборванная при падении запись пропускается
+                if len(parts) != 2 or not parts[1].isdigit():
+                    continue
+                if parts[0] == "#":
+                    # При дописывании в .old заголовки поколений идут и посреди файла
+                    generation = int(parts[1])
+                    continue
+                if generation is not None and generation <= snapshot_generation:
+                    # Снимок заменили, а .old удалить не успели — эти скачивания уже в снимке
+                    continue
+                post = posts.get(parts[0])
+                if post is None:
+                    continue
+                post['downloads'] = post.get('downloads', 0) + int(parts[1])
+                replayed += 1
+    return replayed
+
+
 def load_posts():
-    """Загружает `posts` из JSON-файла (если есть)"""
-    global posts
+    """Загружает `posts` из JSON-файла (если есть) и доигрывает журнал скачиваний"""
+    global posts, _post_seq, _journal_generation
     if not os.path.exists(POSTS_FILE):
         return
+    snapshot_generation = 0
     try:
         with open(POSTS_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
             if isinstance(data, dict):
+                # В снимках старых версий номера нет — берем наибольший из id
+                saved_seq = data.pop(POST_SEQ_KEY, 0)
+                snapshot_generation = data.pop(JOURNAL_GEN_KEY, 0)
                 posts = data
+                _post_seq = max(_post_seq, saved_seq, last_post_seq(posts))
     except Exception as e:
         logger.error(f"Не удалось загрузить posts: {e}")
+        return
+    _journal_generation = max(_journal_generation, snapshot_generation + 1)
+    journals = any(os.path.exists(path) for path in (DOWNLOADS_JOURNAL_OLD, DOWNLOADS_JOURNAL))
+    try:
+        replayed = _replay_journal(snapshot_generation)
+    except Exception as e:
+        logger.error(f"Не удалось прочитать журнал скачиваний: {e}")
+        return
+    if replayed:
+        logger.info(f"Из журнала восстановлено скачиваний: {replayed}")
+    migrated = _migrate_legacy_ids()
+    if migrated:
+        logger.info(f"Постам со старыми UUID выданы короткие id: {migrated}")
+    if journals or migrated:
+        # Сразу сворачиваем журнал в свежий снимок, чтобы новые записи не дописывались к старым поколениям
+        save_posts()
 
 
-def admin_menu():
-    """Клавиатура администратора"""
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📂 Моды", callback_data="mods_list")],
-        [InlineKeyboardButton(text="➕ Добавить пост", callback_data="add_post")],
-        [InlineKeyboardButton(text="👥 Управление админами", callback_data="manage_admins")],
-        [InlineKeyboardButton(text="⚙️ Управление", callback_data="manage_mods")],
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")]
-    ])
-    return kb
+def _migrate_legacy_ids() -> int:
+    """Переводит посты с UUID-ключами на короткие id (журнал к этому моменту уже доигран)"""
+    global posts, _post_seq
+    legacy = sorted((pid for pid in posts if is_legacy_post_id(pid)), key=lambda pid: posts[pid].get('created_at', 0))
+    if not legacy:
+        return 0
+    new_ids = {}
+    for old_id in legacy:
+        _post_seq += 1
+        new_ids[old_id] = encode_base62(_post_seq)
+    posts = {
+        new_ids[pid] if pid in new_ids else pid: alias_post(post, pid, new_ids[pid]) if pid in new_ids else post
+        for pid, post in posts.items()
+    }
+    return len(legacy)
+
+
+async def compact_downloads_journal():
+    """Фоновое сжатие журнала скачиваний в снимок posts.json"""
+    while True:
+        await asyncio.sleep(JOURNAL_COMPACT_INTERVAL)
+        if not _journal_records:
+            continue
+        try:
+            _rotate_journal()
+            rotation = _journal_rotations
+            payload, seq = _dump_posts()
+            # Запись на диск не блокирует event loop
+            await asyncio.to_thread(_write_snapshot, payload, seq)
+            # Если за время записи журнал снова ротировали, в .old могли попасть
+            # записи, которых нет в нашем снимке — удалит их следующий save_posts
+            if rotation == _journal_rotations:
+                _drop_rotated_journal()
+        except Exception as e:
+            logger.error(f"Ошибка сжатия журнала скачиваний: {e}")
 
 
-def main_menu():
-    """Клавиатура обычного пользователя"""
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📂 Просмотреть моды", callback_data="mods_list")],
-        [InlineKeyboardButton(text="💡 Предложить идею", callback_data="suggest_idea")]
-    ])
-    return kb
+# =====================
+# ХРАНИЛИЩЕ
+# =====================
 
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | json
+DB_FILE = os.getenv("DB_FILE", "yakmods.db")
 
-def cancel_inline_kb():
-    """Кнопка отмены для inline prompts"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_post")]
-    ])
 
+class Storage(ABC):
+    """Базовый интерфейс хранилища постов, пользователей, банов, админов и черновиков"""
 
-def notify_menu():
-    """Кнопки уведомления при публикации"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Уведомить всех", callback_data="notify_yes")],
-        [InlineKeyboardButton(text="❌ Не уведомлять", callback_data="notify_no")]
-    ])
+    async def open(self):
+        """Подготовка хранилища при запуске"""
 
+    async def close(self):
+        """Освобождение ресурсов при остановке"""
 
-def download_keyboard(bot_username: str, post_id: str):
-    """Кнопка скачивания/предпросмотра для превью"""
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬇️ Скачать", url=f"https://t.me/{bot_username}?start=download_{post_id}")],
-        [InlineKeyboardButton(text=f"@{bot_username}", url=f"https://t.me/{bot_username}")]
-    ])
-    return kb
+    @abstractmethod
+    async def load_posts(self) -> dict:
+        ...
 
+    @abstractmethod
+    async def next_post_id(self) -> str:
+        """Короткий id для нового поста (не повторяется)"""
 
-def subscribe_keyboard(bot_username: str, post_id: str, missing: list):
-    """Клавиатура с ссылками на отсутствующие каналы и deep-link кнопкой проверки"""
-    buttons = []
-    for ch in missing:
-        # Allow both @name and full URL
-        ch_name = ch if ch.startswith("@") else f"@{ch}"
-        buttons.append([InlineKeyboardButton(text=ch_name, url=f"https://t.me/{ch_name.lstrip('@')}")])
-    # Используем deep link, чтобы пользователь открыл бота и проверка выполнялась в приватном чате
-    buttons.append([InlineKeyboardButton(text="✅ Проверить подписки", url=f"https://t.me/{bot_username}?start=check_{post_id}")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    @abstractmethod
+    async def save_post(self, post_id: str, post: dict):
+        ...
 
+    @abstractmethod
+    async def delete_post(self, post_id: str):
+        ...
 
-def confirm_menu():
-    """Кнопки подтверждения/отмены публикации при предпросмотре"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Опубликовать", callback_data="confirm_post")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_post")]
-    ])
+    @abstractmethod
+    async def add_downloads(self, deltas: dict, events: list = ()):
+        """Прибавляет пачку приростов {post_id: delta}, сохраняет события (post_id, user_id, ts, source) и их агрегаты"""
+
+    @abstractmethod
+    async def load_download_events(self, since: float, after_id: int = 0) -> list:
+        """События (id, post_id, user_id, ts, source) с момента since и после события after_id, по id"""
+
+    @abstractmethod
+    async def prune_download_events(self, before: float):
+        ...
+
+    @abstractmethod
+    async def load_download_rollups(self, cutoffs: dict) -> tuple:
+        """Агрегаты [(post_id, шаг, корзина, скачиваний)] с корзин cutoffs {шаг: корзина} и id последнего события"""
+
+    @abstractmethod
+    async def prune_download_rollups(self, cutoffs: dict):
+        """Удаляет корзины раньше cutoffs {шаг: корзина}"""
+
+    @abstractmethod
+    async def load_sketches(self) -> dict:
+        """Скетчи уникальных скачавших: {ключ: регистры}"""
+
+    @abstractmethod
+    async def save_sketches(self, sketches: dict):
+        ...
+
+    @abstractmethod
+    async def delete_sketches(self, keys: list):
+        ...
+
+    @abstractmethod
+    async def catalog_version(self) -> int:
+        """Номер изменения каталога: растет при каждой записи или удалении поста"""
+
+    @abstractmethod
+    async def load_catalog_changes(self, version: int) -> tuple:
+        """Изменения каталога после version: (текущий номер, {post_id: пост}, [id удаленных])"""
+
+    @abstractmethod
+    async def downloads_version(self) -> int:
+        """Номер записи счетчиков: растет при каждом сбросе скачиваний"""
+
+    @abstractmethod
+    async def load_download_changes(self, version: int) -> tuple:
+        """Счетчики, изменившиеся после version: (текущий номер, {post_id: downloads})"""
+
+    @abstractmethod
+    async def get_fsm(self, key: str) -> tuple:
+        """Состояние и данные FSM: (state, data, updated_at)"""
+
+    @abstractmethod
+    async def set_fsm_state(self, key: str, state: str):
+        ...
+
+    @abstractmethod
+    async def set_fsm_data(self, key: str, data: dict):
+        ...
+
+    @abstractmethod
+    async def prune_fsm(self, before: float) -> int:
+        """Удаляет состояния FSM, не менявшиеся с момента before; возвращает их число"""
+
+    @abstractmethod
+    async def add_user(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def remove_user(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def count_users(self) -> int:
+        ...
+
+    @abstractmethod
+    async def get_users_after(self, after_id: int, limit: int) -> list:
+        """Следующая пачка id пользователей по возрастанию, начиная после `after_id`"""
+
+    async def iter_users(self, batch_size: int = 1000, after_id: int = 0):
+        """Перебирает пользователей пачками, не загружая всех в память"""
+        while True:
+            batch = await self.get_users_after(after_id, batch_size)
+            if not batch:
+                return
+            yield batch
+            after_id = batch[-1]
+
+    @abstractmethod
+    async def load_banned(self) -> set:
+        ...
+
+    @abstractmethod
+    async def set_banned(self, user_id: int, banned: bool):
+        ...
+
+    @abstractmethod
+    async def load_admins(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def save_admin(self, user_id: int, username: str = None):
+        ...
+
+    @abstractmethod
+    async def delete_admin(self, user_id: int):
+        ...
+
+    @abstractmethod
+    async def get_cooldown(self, user_id: int) -> float:
+        ...
+
+    @abstractmethod
+    async def set_cooldown(self, user_id: int, last_time: float):
+        ...
+
+    @abstractmethod
+    async def load_drafts(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def save_draft(self, post_id: str, data: dict):
+        ...
+
+    @abstractmethod
+    async def delete_draft(self, post_id: str):
+        ...
+
+    @abstractmethod
+    async def create_broadcast(self, post_id: str, chat_id: int) -> int:
+        """Создает задание рассылки и возвращает его id"""
+
+    @abstractmethod
+    async def save_broadcast(self, record: dict):
+        ...
+
+    @abstractmethod
+    async def load_active_broadcasts(self) -> list:
+        """Задания рассылки в статусах running и paused"""
+
+
+class JsonStorage(Storage):
+    """Прежний формат: посты в posts.json + журнал скачиваний, остальное только в памяти"""
+
+    def __init__(self):
+        self._users = set()
+        self._banned = set()
+        self._admins = {}
+        self._cooldowns = {}
+        self._drafts = {}
+        self._broadcasts = {}
+        self._events = deque()  # [(id, post_id, user_id, ts, source)] только за горизонт графиков
+        self._event_seq = 0
+        self._rollups = Counter()  # {(post_id, шаг, корзина): скачиваний}, как и события — только в памяти
+        self._sketches = {}
+        self._fsm = {}  # {key: (state, data, updated_at)}
+        self._catalog_version = 0
+        self._post_versions = {}  # {post_id: номер изменения каталога, с которым пост записан или удален}
+        self._downloads_version = 0
+        self._download_versions = {}  # {post_id: номер сброса, изменившего счетчик}
+
+    async def open(self):
+        global _compactor_task
+        # Фоновое сжатие журнала скачиваний
+        _compactor_task = asyncio.create_task(compact_downloads_journal())
+
+    async def close(self):
+        if _compactor_task is not None:
+            _compactor_task.cancel()
+        # Финальный снимок: журнал скачиваний сворачивается в posts.json
+        save_posts()
+
+    async def load_posts(self) -> dict:
+        load_posts()
+        return posts
+
+    async def next_post_id(self) -> str:
+        global _post_seq
+        # Черновик мог получить номер уже после последнего снимка
+        _post_seq = max(_post_seq, last_post_seq(self._drafts)) + 1
+        return encode_base62(_post_seq)
+
+    async def save_post(self, post_id: str, post: dict):
+        self._catalog_version += 1
+        self._post_versions[post_id] = self._catalog_version
+        save_posts()
+
+    async def delete_post(self, post_id: str):
+        self._catalog_version += 1
+        self._post_versions[post_id] = self._catalog_version
+        self._sketches.pop(f"post:{post_id}", None)
+        save_posts()
+
+    async def add_downloads(self, deltas: dict, events: list = ()):
+        append_download_journal(deltas)
+        self._downloads_version += 1
+        for post_id in deltas:
+            self._download_versions[post_id] = self._downloads_version
+        for event in events:
+            self._event_seq += 1
+            self._events.append((self._event_seq, *event))
+        for post_id, step, slot, count in rollup_rows(events):
+            self._rollups[(post_id, step, slot)] += count
+        # События живут только в памяти и нужны лишь для графиков — старше горизонта не храним
+        horizon = time.time() - ROLLUP_HORIZON
+        while self._events and self._events[0][3] < horizon:
+            self._events.popleft()
+
+    async def load_download_events(self, since: float, after_id: int = 0) -> list:
+        return [event for event in self._events if event[0] > after_id and event[3] >= since]
+
+    async def prune_download_events(self, before: float):
+        self._events = deque(event for event in self._events if event[3] >= before)
+
+    async def load_download_rollups(self, cutoffs: dict) -> tuple:
+        rows = [(*key, count) for key, count in self._rollups.items() if key[2] >= cutoffs[key[1]]]
+        rows.sort(key=lambda row: (row[1], row[2]))
+        return rows, self._event_seq
+
+    async def prune_download_rollups(self, cutoffs: dict):
+        self._rollups = Counter({key: count for key, count in self._rollups.items() if key[2] >= cutoffs[key[1]]})
+
+    async def load_sketches(self) -> dict:
+        return dict(self._sketches)
+
+    async def save_sketches(self, sketches: dict):
+        self._sketches.update(sketches)
+
+    async def delete_sketches(self, keys: list):
+        for key in keys:
+            self._sketches.pop(key, None)
+
+    async def catalog_version(self) -> int:
+        return self._catalog_version
+
+    async def load_catalog_changes(self, version: int) -> tuple:
+        ids = [post_id for post_id, v in self._post_versions.items() if v > version]
+        changed = {post_id: posts[post_id] for post_id in ids if post_id in posts}
+        return self._catalog_version, changed, [post_id for post_id in ids if post_id not in posts]
+
+    async def downloads_version(self) -> int:
+        return self._downloads_version
+
+    async def load_download_changes(self, version: int) -> tuple:
+        counts = {
+            post_id: posts[post_id].get('downloads', 0)
+            for post_id, v in self._download_versions.items() if v > version and post_id in posts
+        }
+        return self._downloads_version, counts
+
+    async def get_fsm(self, key: str) -> tuple:
+        state, data, updated_at = self._fsm.get(key, (None, {}, 0))
+        return state, dict(data), updated_at
+
+    async def set_fsm_state(self, key: str, state: str):
+        self._set_fsm(key, state, self._fsm.get(key, (None, {}, 0))[1])
+
+    async def set_fsm_data(self, key: str, data: dict):
+        self._set_fsm(key, self._fsm.get(key, (None, {}, 0))[0], dict(data))
+
+    def _set_fsm(self, key: str, state: str, data: dict):
+        if state is None and not data:
+            self._fsm.pop(key, None)
+        else:
+            self._fsm[key] = (state, data, time.time())
+
+    async def prune_fsm(self, before: float) -> int:
+        stale = [key for key, entry in self._fsm.items() if entry[2] < before]
+        for key in stale:
+            del self._fsm[key]
+        return len(stale)
+
+    async def add_user(self, user_id: int):
+        self._users.add(user_id)
+
+    async def remove_user(self, user_id: int):
+        self._users.discard(user_id)
+
+    async def count_users(self) -> int:
+        return len(self._users)
+
+    async def get_users_after(self, after_id: int, limit: int) -> list:
+        return heapq.nsmallest(limit, (u for u in self._users if u > after_id))
+
+    async def load_banned(self) -> set:
+        return set(self._banned)
+
+    async def set_banned(self, user_id: int, banned: bool):
+        if banned:
+            self._banned.add(user_id)
+        else:
+            self._banned.discard(user_id)
+
+    async def load_admins(self) -> dict:
+        return dict(self._admins)
+
+    async def save_admin(self, user_id: int, username: str = None):
+        self._admins[user_id] = username
+
+    async def delete_admin(self, user_id: int):
+        self._admins.pop(user_id, None)
+
+    async def get_cooldown(self, user_id: int) -> float:
+        return self._cooldowns.get(user_id)
+
+    async def set_cooldown(self, user_id: int, last_time: float):
+        self._cooldowns[user_id] = last_time
+
+    async def load_drafts(self) -> dict:
+        return dict(self._drafts)
+
+    async def save_draft(self, post_id: str, data: dict):
+        self._drafts[post_id] = data
+
+    async def delete_draft(self, post_id: str):
+        self._drafts.pop(post_id, None)
+
+    async def create_broadcast(self, post_id: str, chat_id: int) -> int:
+        job_id = len(self._broadcasts) + 1
+        self._broadcasts[job_id] = {
+            'id': job_id, 'post_id': post_id, 'chat_id': chat_id, 'status': "running",
+            'cursor': 0, 'delivered': 0, 'failed': 0, 'blocked': 0,
+        }
+        return job_id
+
+    async def save_broadcast(self, record: dict):
+        self._broadcasts[record['id']] = dict(record)
+
+    async def load_active_broadcasts(self) -> list:
+        return [dict(r) for r in self._broadcasts.values() if r['status'] in ("running", "paused")]
+
+
+class SQLiteStorage(Storage):
+    """Хранилище в SQLite (WAL). Запросы выполняются в отдельном потоке и не блокируют event loop"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS posts (
+            id TEXT PRIMARY KEY,
+            category TEXT,
+            data TEXT NOT NULL,
+            downloads INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0,
+            downloads_version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS posts_category ON posts(category);
+        CREATE TABLE IF NOT EXISTS deleted_posts (
+            id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            joined_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS banned (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT
+        );
+        CREATE TABLE IF NOT EXISTS cooldowns (
+            user_id INTEGER PRIMARY KEY,
+            last_time REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS drafts (
+            post_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id TEXT NOT NULL,
+            chat_id INTEGER,
+            status TEXT NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            staging_chat_id INTEGER,
+            staging_message_id INTEGER,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS broadcasts_status ON broadcasts(status);
+        CREATE TABLE IF NOT EXISTS download_events (
+            post_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            source TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS download_events_ts ON download_events(ts);
+        CREATE TABLE IF NOT EXISTS download_rollups (
+            step INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            post_id TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (step, slot, post_id)
+        );
+        CREATE TABLE IF NOT EXISTS download_sketches (
+            key TEXT PRIMARY KEY,
+            registers BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL DEFAULT 0
+        );
+    """
+
+    SQL_UPSERT_POST = (
+        "INSERT INTO posts (id, category, data, downloads) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET category = excluded.category, data = excluded.data"
+    )
+    # Номер изменения ставится на строку, чтобы другие процессы забирали только изменившиеся посты
+    SQL_STAMP_POST = "UPDATE posts SET version = (SELECT value FROM meta WHERE key = 'catalog_version') WHERE id = ?"
+    SQL_ADD_TOMBSTONE = (
+        "INSERT OR REPLACE INTO deleted_posts (id, version) "
+        "VALUES (?, (SELECT value FROM meta WHERE key = 'catalog_version'))"
+    )
+    SQL_ADD_DOWNLOADS = (
+        "UPDATE posts SET downloads = downloads + ?, "
+        "downloads_version = (SELECT value FROM meta WHERE key = 'downloads_version') WHERE id = ?"
+    )
+    SQL_BUMP_DOWNLOADS = (
+        "INSERT INTO meta (key, value) VALUES ('downloads_version', 1) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+    )
+    SQL_ADD_DOWNLOAD_EVENT = "INSERT INTO download_events (post_id, user_id, ts, source) VALUES (?, ?, ?, ?)"
+    SQL_ADD_ROLLUP = (
+        "INSERT INTO download_rollups (post_id, step, slot, count) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(step, slot, post_id) DO UPDATE SET count = count + excluded.count"
+    )
+    SQL_ADD_USER = "INSERT OR IGNORE INTO users (user_id, joined_at) VALUES (?, ?)"
+    SQL_USERS_AFTER = "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+    SQL_BUMP_CATALOG = (
+        "INSERT INTO meta (key, value) VALUES ('catalog_version', 1) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        # Один поток на одно соединение: запросы выполняются строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _call(self, func, *args):
+        """Выполняет синхронную функцию в потоке хранилища"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _execute(self, sql: str, params: tuple = ()):
+        self._conn.execute(sql, params)
+
+    def _insert(self, sql: str, params: tuple = ()) -> int:
+        return self._conn.execute(sql, params).lastrowid
+
+    def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        return self._conn.execute(sql, params).fetchall()
+
+    def _fetchone(self, sql: str, params: tuple = ()):
+        return self._conn.execute(sql, params).fetchone()
+
+    def _executemany(self, sql: str, rows):
+        """Пакетная запись одной транзакцией"""
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(sql, rows)
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _transaction(self, *statements):
+        """Несколько запросов [(sql, params)] одной транзакцией"""
+        self._conn.execute("BEGIN")
+        try:
+            for sql, params in statements:
+                self._conn.execute(sql, params)
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _merge_sketches_sync(self, sketches: dict):
+        """Объединяет скетчи с уже записанными (их могли пополнить другие процессы)"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, registers in sketches.items():
+                row = self._conn.execute("SELECT registers FROM download_sketches WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    registers = bytes(map(max, registers, row[0]))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO download_sketches (key, registers) VALUES (?, ?)", (key, registers)
+                )
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _add_downloads_sync(self, deltas: list, events: list, rollups: list):
+        """Счетчики, события и агрегаты скачиваний одной транзакцией"""
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.execute(self.SQL_BUMP_DOWNLOADS)
+            self._conn.executemany(self.SQL_ADD_DOWNLOADS, deltas)
+            self._conn.executemany(self.SQL_ADD_DOWNLOAD_EVENT, events)
+            self._conn.executemany(self.SQL_ADD_ROLLUP, rollups)
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _meta_int(self, key: str) -> int:
+        row = self._fetchone("SELECT value FROM meta WHERE key = ?", (key,))
+        return int(row[0]) if row else 0
+
+    @staticmethod
+    def _load_post(data: str, downloads: int) -> dict:
+        post = json.loads(data)
+        post['downloads'] = downloads
+        return post
+
+    def _catalog_changes_sync(self, version: int) -> tuple:
+        """Посты и удаления после version из одного снимка базы"""
+        self._conn.execute("BEGIN")
+        try:
+            current = self._meta_int('catalog_version')
+            rows = self._fetchall("SELECT id, data, downloads FROM posts WHERE version > ?", (version,))
+            deleted = self._fetchall("SELECT id FROM deleted_posts WHERE version > ?", (version,))
+        finally:
+            self._conn.execute("COMMIT")
+        changed = {post_id: self._load_post(data, downloads) for post_id, data, downloads in rows}
+        return current, changed, [post_id for (post_id,) in deleted]
+
+    def _download_changes_sync(self, version: int) -> tuple:
+        """Счетчики после version из одного снимка базы"""
+        self._conn.execute("BEGIN")
+        try:
+            current = self._meta_int('downloads_version')
+            rows = self._fetchall("SELECT id, downloads FROM posts WHERE downloads_version > ?", (version,))
+        finally:
+            self._conn.execute("COMMIT")
+        return current, dict(rows)
+
+    def _load_rollups_sync(self, cutoffs: dict) -> tuple:
+        """Агрегаты и id последнего события из одного снимка базы"""
+        self._conn.execute("BEGIN")
+        try:
+            rows = []
+            for step, slot in cutoffs.items():
+                rows += self._fetchall(
+                    "SELECT post_id, step, slot, count FROM download_rollups WHERE step = ? AND slot >= ? ORDER BY slot",
+                    (step, slot)
+                )
+            last_event_id = self._fetchone("SELECT max(rowid) FROM download_events")[0] or 0
+        finally:
+            self._conn.execute("COMMIT")
+        return rows, last_event_id
+
+    @staticmethod
+    def _post_row(post_id: str, post: dict) -> tuple:
+        # Счетчик хранится отдельной колонкой, чтобы скачивание не переписывало весь пост
+        data = {k: v for k, v in post.items() if k != 'downloads'}
+        return (
+            post_id,
+            post.get('category'),
+            json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+            post.get('downloads', 0),
+        )
+
+    def _open_sync(self):
+        # Автокоммит; пакетные операции сами открывают транзакцию
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Базу могут одновременно писать несколько процессов (BOT_WORKERS > 1)
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(self.SCHEMA)
+        self._conn = conn
+        self._add_missing_columns()
+        self._migrate_json()
+        self._migrate_post_ids()
+        self._migrate_rollups()
+
+    # Колонки, добавленные после первой версии схемы: {таблица: {колонка: объявление}}
+    ADDED_COLUMNS = {
+        "broadcasts": {
+            "staging_chat_id": "INTEGER",
+            "staging_message_id": "INTEGER",
+        },
+        "fsm": {
+            "updated_at": "REAL NOT NULL DEFAULT 0",
+        },
+        "posts": {
+            "version": "INTEGER NOT NULL DEFAULT 0",
+            "downloads_version": "INTEGER NOT NULL DEFAULT 0",
+        },
+    }
+    # Индексы по добавленным колонкам: в старой базе их можно создать только после ALTER TABLE
+    ADDED_INDEXES = """
+        CREATE INDEX IF NOT EXISTS posts_version ON posts(version);
+        CREATE INDEX IF NOT EXISTS posts_downloads_version ON posts(downloads_version);
+    """
+    # Заполнение добавленных колонок у существующих строк: {(таблица, колонка): запрос}
+    BACKFILL_COLUMNS = {
+        # Иначе все старые состояния FSM сочтутся просроченными при первой же очистке
+        ("fsm", "updated_at"): "UPDATE fsm SET updated_at = strftime('%s', 'now') WHERE updated_at = 0",
+    }
+
+    def _add_missing_columns(self):
+        """Дополняет таблицы из старых версий базы новыми колонками"""
+        for table, columns in self.ADDED_COLUMNS.items():
+            existing = {row[1] for row in self._fetchall(f"PRAGMA table_info({table})")}
+            for column, decl in columns.items():
+                if column not in existing:
+                    self._execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+                    backfill = self.BACKFILL_COLUMNS.get((table, column))
+                    if backfill:
+                        self._execute(backfill)
+        self._conn.executescript(self.ADDED_INDEXES)
+
+    def _migrate_json(self):
+        """Однократный перенос постов из posts.json (вместе с журналом скачиваний)"""
+        if self._fetchone("SELECT value FROM meta WHERE key = 'json_migrated'"):
+            return
+        load_posts()
+        if posts:
+            self._executemany(self.SQL_UPSERT_POST, [self._post_row(pid, p) for pid, p in posts.items()])
+            logger.info(f"Перенесено постов из {POSTS_FILE}: {len(posts)}")
+        if _post_seq:
+            # Номера удаленных из JSON постов тоже не должны выдаваться снова
+            self._execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('post_seq', ?)", (str(_post_seq),))
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', '1')")
+
+    def _last_post_seq(self) -> int:
+        """Последний выданный номер поста (вызывается внутри транзакции)"""
+        row = self._fetchone("SELECT value FROM meta WHERE key = 'post_seq'")
+        if row:
+            return int(row[0])
+        # База до коротких id или после переноса из posts.json
+        return last_post_seq(pid for (pid,) in self._fetchall("SELECT id FROM posts"))
+
+    def _migrate_post_ids(self):
+        """Переводит посты с UUID-ключами на короткие id вместе со счетчиками, событиями и рассылками"""
+        # Процессы-обработчики открывают базу одновременно — переносит тот, кто первым взял блокировку
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._fetchall("SELECT id, data FROM posts WHERE length(id) = 36")
+            legacy = sorted(
+                ((pid, json.loads(data)) for pid, data in rows if is_legacy_post_id(pid)),
+                key=lambda row: row[1].get('created_at', 0)
+            )
+            if legacy:
+                seq = self._last_post_seq()
+                id_map = []
+                for old_id, post in legacy:
+                    seq += 1
+                    new_id = encode_base62(seq)
+                    id_map.append((old_id, new_id))
+                    self._conn.execute(
+                        "UPDATE posts SET id = ?, data = ? WHERE id = ?",
+                        (new_id, json.dumps(alias_post(post, old_id, new_id), ensure_ascii=False, separators=(",", ":")), old_id)
+                    )
+                self._conn.execute("CREATE TEMP TABLE post_id_map (old_id TEXT PRIMARY KEY, new_id TEXT NOT NULL)")
+                self._conn.executemany("INSERT INTO post_id_map (old_id, new_id) VALUES (?, ?)", id_map)
+                # Одним проходом по каждой таблице, а не запросом на каждый пост
+                for table in ("download_events", "broadcasts"):
+                    self._conn.execute(
+                        f"UPDATE {table} SET post_id = (SELECT new_id FROM post_id_map WHERE old_id = post_id) "
+                        "WHERE post_id IN (SELECT old_id FROM post_id_map)"
+                    )
+                self._conn.execute(
+                    "UPDATE download_sketches SET key = 'post:' || "
+                    "(SELECT new_id FROM post_id_map WHERE 'post:' || old_id = key) "
+                    "WHERE key IN (SELECT 'post:' || old_id FROM post_id_map)"
+                )
+                self._conn.execute("DROP TABLE post_id_map")
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('post_seq', ?)", (str(seq),))
+                self._conn.execute(self.SQL_BUMP_CATALOG)
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        if legacy:
+            logger.info(f"Постам со старыми UUID выданы короткие id: {len(legacy)}")
+
+    def _migrate_rollups(self):
+        """Однократно строит агрегаты из событий, записанных до их появления (GROUP BY на каждый шаг)"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not self._fetchone("SELECT value FROM meta WHERE key = 'rollups_migrated'"):
+                for step, slot in rollup_cutoffs(time.time()).items():
+                    self._conn.execute(
+                        "INSERT INTO download_rollups (post_id, step, slot, count) "
+                        "SELECT post_id, ?, CAST(ts / ? AS INTEGER) AS bucket, COUNT(*) FROM download_events "
+                        "WHERE ts >= ? GROUP BY post_id, bucket",
+                        (step, step, slot * step)
+                    )
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('rollups_migrated', '1')")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _next_post_seq_sync(self) -> int:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = self._last_post_seq() + 1
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('post_seq', ?)", (str(seq),))
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return seq
+
+    async def open(self):
+        await self._call(self._open_sync)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._call(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    async def load_posts(self) -> dict:
+        rows = await self._call(self._fetchall, "SELECT id, data, downloads FROM posts")
+        return {post_id: self._load_post(data, downloads) for post_id, data, downloads in rows}
+
+    async def next_post_id(self) -> str:
+        return encode_base62(await self._call(self._next_post_seq_sync))
+
+    async def save_post(self, post_id: str, post: dict):
+        await self._call(
+            self._transaction,
+            (self.SQL_UPSERT_POST, self._post_row(post_id, post)),
+            (self.SQL_BUMP_CATALOG, ()),
+            (self.SQL_STAMP_POST, (post_id,))
+        )
+
+    async def delete_post(self, post_id: str):
+        await self._call(
+            self._transaction,
+            ("DELETE FROM posts WHERE id = ?", (post_id,)),
+            ("DELETE FROM download_sketches WHERE key = ?", (f"post:{post_id}",)),
+            (self.SQL_BUMP_CATALOG, ()),
+            (self.SQL_ADD_TOMBSTONE, (post_id,))
+        )
+
+    async def add_downloads(self, deltas: dict, events: list = ()):
+        rows = [(delta, post_id) for post_id, delta in deltas.items()]
+        await self._call(self._add_downloads_sync, rows, list(events), rollup_rows(events))
+
+    async def load_download_events(self, since: float, after_id: int = 0) -> list:
+        return await self._call(
+            self._fetchall,
+            "SELECT rowid, post_id, user_id, ts, source FROM download_events "
+            "WHERE rowid > ? AND ts >= ? ORDER BY rowid",
+            (after_id, since)
+        )
+
+    async def prune_download_events(self, before: float):
+        await self._call(self._execute, "DELETE FROM download_events WHERE ts < ?", (before,))
+
+    async def load_download_rollups(self, cutoffs: dict) -> tuple:
+        return await self._call(self._load_rollups_sync, cutoffs)
+
+    async def prune_download_rollups(self, cutoffs: dict):
+        await self._call(
+            self._executemany,
+            "DELETE FROM download_rollups WHERE step = ? AND slot < ?",
+            list(cutoffs.items())
+        )
+
+    async def load_sketches(self) -> dict:
+        rows = await self._call(self._fetchall, "SELECT key, registers FROM download_sketches")
+        return {key: bytes(registers) for key, registers in rows}
+
+    async def save_sketches(self, sketches: dict):
+        await self._call(self._merge_sketches_sync, sketches)
+
+    async def delete_sketches(self, keys: list):
+        await self._call(self._executemany, "DELETE FROM download_sketches WHERE key = ?", [(key,) for key in keys])
+
+    async def catalog_version(self) -> int:
+        return await self._call(self._meta_int, 'catalog_version')
+
+    async def load_catalog_changes(self, version: int) -> tuple:
+        return await self._call(self._catalog_changes_sync, version)
+
+    async def downloads_version(self) -> int:
+        return await self._call(self._meta_int, 'downloads_version')
+
+    async def load_download_changes(self, version: int) -> tuple:
+        return await self._call(self._download_changes_sync, version)
+
+    async def get_fsm(self, key: str) -> tuple:
+        row = await self._call(self._fetchone, "SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,))
+        if row is None:
+            return None, {}, 0
+        return row[0], json.loads(row[1]), row[2]
+
+    # Пустые записи (после state.clear()) не храним
+    SQL_DROP_EMPTY_FSM = "DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'"
+
+    async def set_fsm_state(self, key: str, state: str):
+        await self._call(
+            self._transaction,
+            ("INSERT INTO fsm (key, state, updated_at) VALUES (?, ?, ?) "
+             "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+             (key, state, time.time())),
+            (self.SQL_DROP_EMPTY_FSM, (key,))
+        )
+
+    async def set_fsm_data(self, key: str, data: dict):
+        await self._call(
+            self._transaction,
+            ("INSERT INTO fsm (key, data, updated_at) VALUES (?, ?, ?) "
+             "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+             (key, json.dumps(data, ensure_ascii=False, separators=(",", ":")), time.time())),
+            (self.SQL_DROP_EMPTY_FSM, (key,))
+        )
+
+    def _prune_fsm_sync(self, before: float) -> int:
+        return self._conn.execute("DELETE FROM fsm WHERE updated_at < ?", (before,)).rowcount
+
+    async def prune_fsm(self, before: float) -> int:
+        return await self._call(self._prune_fsm_sync, before)
+
+    async def add_user(self, user_id: int):
+        await self._call(self._execute, self.SQL_ADD_USER, (user_id, time.time()))
+
+    async def remove_user(self, user_id: int):
+        await self._call(self._execute, "DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    async def count_users(self) -> int:
+        row = await self._call(self._fetchone, "SELECT COUNT(*) FROM users")
+        return row[0]
+
+    async def get_users_after(self, after_id: int, limit: int) -> list:
+        rows = await self._call(self._fetchall, self.SQL_USERS_AFTER, (after_id, limit))
+        return [row[0] for row in rows]
+
+    async def load_banned(self) -> set:
+        rows = await self._call(self._fetchall, "SELECT user_id FROM banned")
+        return {row[0] for row in rows}
+
+    async def set_banned(self, user_id: int, banned: bool):
+        if banned:
+            await self._call(self._execute, "INSERT OR IGNORE INTO banned (user_id) VALUES (?)", (user_id,))
+        else:
+            await self._call(self._execute, "DELETE FROM banned WHERE user_id = ?", (user_id,))
+
+    async def load_admins(self) -> dict:
+        rows = await self._call(self._fetchall, "SELECT user_id, username FROM admins")
+        return dict(rows)
+
+    async def save_admin(self, user_id: int, username: str = None):
+        await self._call(
+            self._execute,
+            "INSERT INTO admins (user_id, username) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username",
+            (user_id, username)
+        )
+
+    async def delete_admin(self, user_id: int):
+        await self._call(self._execute, "DELETE FROM admins WHERE user_id = ?", (user_id,))
+
+    async def get_cooldown(self, user_id: int) -> float:
+        row = await self._call(self._fetchone, "SELECT last_time FROM cooldowns WHERE user_id = ?", (user_id,))
+        return row[0] if row else None
+
+    async def set_cooldown(self, user_id: int, last_time: float):
+        await self._call(
+            self._execute,
+            "INSERT OR REPLACE INTO cooldowns (user_id, last_time) VALUES (?, ?)",
+            (user_id, last_time)
+        )
+
+    async def load_drafts(self) -> dict:
+        rows = await self._call(self._fetchall, "SELECT post_id, data FROM drafts")
+        return {post_id: json.loads(data) for post_id, data in rows}
+
+    async def save_draft(self, post_id: str, data: dict):
+        await self._call(
+            self._execute,
+            "INSERT OR REPLACE INTO drafts (post_id, data, updated_at) VALUES (?, ?, ?)",
+            (post_id, json.dumps(data, ensure_ascii=False, separators=(",", ":")), time.time())
+        )
+
+    async def delete_draft(self, post_id: str):
+        await self._call(self._execute, "DELETE FROM drafts WHERE post_id = ?", (post_id,))
+
+    async def create_broadcast(self, post_id: str, chat_id: int) -> int:
+        return await self._call(
+            self._insert,
+            "INSERT INTO broadcasts (post_id, chat_id, status, updated_at) VALUES (?, ?, 'running', ?)",
+            (post_id, chat_id, time.time())
+        )
+
+    async def save_broadcast(self, record: dict):
+        await self._call(
+            self._execute,
+            "UPDATE broadcasts SET status = ?, cursor = ?, delivered = ?, failed = ?, blocked = ?, "
+            "staging_chat_id = ?, staging_message_id = ?, updated_at = ? WHERE id = ?",
+            (record['status'], record['cursor'], record['delivered'], record['failed'], record['blocked'],
+             record.get('staging_chat_id'), record.get('staging_message_id'), time.time(), record['id'])
+        )
+
+    async def load_active_broadcasts(self) -> list:
+        rows = await self._call(
+            self._fetchall,
+            "SELECT id, post_id, chat_id, status, cursor, delivered, failed, blocked, "
+            "staging_chat_id, staging_message_id FROM broadcasts "
+            "WHERE status IN ('running', 'paused') ORDER BY id"
+        )
+        keys = ('id', 'post_id', 'chat_id', 'status', 'cursor', 'delivered', 'failed', 'blocked',
+                'staging_chat_id', 'staging_message_id')
+        return [dict(zip(keys, row)) for row in rows]
+
+
+def create_storage() -> Storage:
+    """Создает хранилище по переменной окружения STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "json":
+        return JsonStorage()
+    return SQLiteStorage(DB_FILE)
+
+
+storage = create_storage()
+
+
+# =====================
+# СЧЕТЧИКИ СКАЧИВАНИЙ
+# =====================
+
+DOWNLOADS_FLUSH_INTERVAL = 5  # Период сброса счетчиков скачиваний в хранилище (сек)
+
+
+class DownloadCounter:
+    """Счетчики скачиваний: итог сразу в `posts`, прирост копится в памяти и сбрасывается пачками"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending = {}  # {post_id: прирост, еще не записанный в хранилище}
+        self._events = []  # [(post_id, user_id, ts, source)], еще не записанные в хранилище
+        self._in_flight = {}  # Пачка, которая пишется в хранилище прямо сейчас
+        self._task = None
+
+    def incr(self, post_id: str, post: dict, event: tuple):
+        post['downloads'] = post.get('downloads', 0) + 1
+        self._pending[post_id] = self._pending.get(post_id, 0) + 1
+        self._events.append(event)
+
+    def pending(self) -> dict:
+        """Прирост, еще не записанный в хранилище (включая пачку, которая пишется сейчас)"""
+        pending = dict(self._in_flight)
+        for post_id, delta in self._pending.items():
+            pending[post_id] = pending.get(post_id, 0) + delta
+        return pending
+
+    async def flush(self):
+        """Записывает накопленный прирост одной пачкой"""
+        if self._pending:
+            await self._flush_downloads()
+        sketches = unique_downloaders.take_dirty()
+        if not sketches:
+            return
+        try:
+            await storage.save_sketches(sketches)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения скетчей уникальных: {e}")
+            unique_downloaders.mark_dirty(sketches)
+
+    async def _flush_downloads(self):
+        # Подмена словаря атомарна для event loop: новые скачивания копятся уже в свежем
+        batch, self._pending = self._pending, {}
+        events, self._events = self._events, []
+        self._in_flight = batch
+        try:
+            await storage.add_downloads(batch, events)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения счетчиков скачиваний: {e}")
+            # Возвращаем прирост, чтобы записать его при следующем сбросе
+            for post_id, delta in batch.items():
+                self._pending[post_id] = self._pending.get(post_id, 0) + delta
+            self._events[:0] = events
+        finally:
+            self._in_flight = {}
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+            # Старые события удаляет один процесс, остальным это ничего не дает
+            if worker_index in (None, 0) and time.monotonic() - last_prune >= ANALYTICS_PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                await prune_download_events()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает периодический сброс и записывает остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+download_counter = DownloadCounter(DOWNLOADS_FLUSH_INTERVAL)
+
+
+def record_download(post_id: str, post: dict, user_id: int, source: str):
+    """Засчитывает скачивание (в хранилище попадет при ближайшем сбросе)"""
+    now = time.time()
+    download_counter.incr(post_id, post, (post_id, user_id, now, source))
+    # Позиция в сортировке "Популярные" (пересчитается при показе), в топах за период и в графиках
+    catalog_index.touch(post_id, post)
+    unique_downloaders.record(post_id, user_id, now)
+    if worker_index is None:
+        leaderboard.record(post_id, now=now)
+        download_analytics.record(post_id, post.get('category'), now)
+    else:
+        # Окна топов и графики пополняются из общей ленты событий (см. sync_shared_state)
+        leaderboard.add_post(post_id, post)
+
+
+# =====================
+# ИНДЕКСЫ КАТАЛОГА
+# =====================
+
+class OrderedIndex:
+    """Отсортированный список (ключ, post_id): позиция ищется бинарным поиском, страница — срез"""
+
+    def __init__(self, key_func):
+        self._key_func = key_func
+        self._entries = []  # [(key, post_id)] по возрастанию
+        self._key_of = {}  # {post_id: key}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, post_id: str, post: dict):
+        """Добавляет пост или переставляет его, если изменился ключ сортировки"""
+        key = self._key_func(post)
+        if post_id in self._key_of:
+            if self._key_of[post_id] == key:
+                return
+            self.remove(post_id)
+        insort(self._entries, (key, post_id))
+        self._key_of[post_id] = key
+
+    def remove(self, post_id: str):
+        if post_id not in self._key_of:
+            return
+        key = self._key_of.pop(post_id)
+        i = bisect_left(self._entries, (key, post_id))
+        if i < len(self._entries) and self._entries[i][1] == post_id:
+            del self._entries[i]
+
+    def slice(self, offset: int, limit: int) -> list:
+        """Страница id постов: O(размер страницы)"""
+        return [post_id for _, post_id in self._entries[offset:offset + limit]]
+
+
+# Порядки сортировки: {код: (название, ключ)}
+SORT_ORDERS = {
+    "new": ("🆕 Новые", lambda p: -p.get('created_at', 0)),
+    "top": ("🔥 Популярные", lambda p: -p.get('downloads', 0)),
+    "abc": ("🔤 А-Я", lambda p: p.get('title', '').casefold()),
+}
+DEFAULT_ORDER = "new"
+
+
+class CatalogIndex:
+    """Вторичные индексы каталога: для каждой категории и для "all" — упорядоченные списки по каждому порядку"""
+
+    def __init__(self):
+        self._scopes = {}  # {scope: {order: OrderedIndex}}
+        self._category_of = {}  # {post_id: category}
+        self._stale = {}  # {post_id: post} — место в "Популярных" пересчитается при чтении страницы
+
+    def _scope(self, scope: str) -> dict:
+        indexes = self._scopes.get(scope)
+        if indexes is None:
+            indexes = {order: OrderedIndex(key) for order, (_, key) in SORT_ORDERS.items()}
+            self._scopes[scope] = indexes
+        return indexes
+
+    def clear(self):
+        self._scopes.clear()
+        self._category_of.clear()
+        self._stale.clear()
+
+    def add(self, post_id: str, post: dict):
+        """Добавляет пост или обновляет его позиции (смена категории, названия, скачиваний)"""
+        self._stale.pop(post_id, None)
+        category = post.get('category')
+        if post_id in self._category_of and self._category_of[post_id] != category:
+            self.remove(post_id)
+        self._category_of[post_id] = category
+        for scope in ("all", category):
+            for index in self._scope(scope).values():
+                index.add(post_id, post)
+
+    def touch(self, post_id: str, post: dict):
+        """Изменился счетчик скачиваний: пересортировка откладывается до показа страницы"""
+        if post_id in self._category_of:
+            self._stale[post_id] = post
+
+    def _refresh(self):
+        # Пачка скачиваний одного поста между показами — одна перестановка вместо сотен
+        stale, self._stale = self._stale, {}
+        for post_id, post in stale.items():
+            for scope in ("all", self._category_of[post_id]):
+                self._scopes[scope]["top"].add(post_id, post)
+
+    def remove(self, post_id: str):
+        self._stale.pop(post_id, None)
+        if post_id not in self._category_of:
+            return
+        category = self._category_of.pop(post_id)
+        for scope in ("all", category):
+            for index in self._scopes.get(scope, {}).values():
+                index.remove(post_id)
+
+    def count(self, scope: str) -> int:
+        indexes = self._scopes.get(scope)
+        return len(indexes[DEFAULT_ORDER]) if indexes else 0
+
+    def page(self, scope: str, order: str, offset: int, limit: int) -> list:
+        if self._stale:
+            self._refresh()
+        indexes = self._scopes.get(scope)
+        if not indexes:
+            return []
+        return indexes.get(order, indexes[DEFAULT_ORDER]).slice(offset, limit)
+
+
+catalog_index = CatalogIndex()
+
+
+class SearchIndex:
+    """Инвертированный индекс по названию, имени файла и категории: точные, префиксные и нечеткие совпадения"""
+
+    # Вес поля в ранжировании
+    FIELD_WEIGHTS = {"title": 3.0, "file_name": 1.0, "category": 1.0}
+    # Множитель по типу совпадения слова запроса
+    EXACT, PREFIX, FUZZY = 1.0, 0.7, 0.5
+    MIN_PREFIX = 2  # Префиксный поиск — от двух символов
+    MIN_FUZZY = 4  # Опечатки допускаем в словах от четырех символов
+
+    def __init__(self):
+        self._postings = {}  # {token: {post_id: вес}}
+        self._vocab = []  # Отсортированный словарь для префиксного поиска
+        self._deletes = {}  # {слово без одной буквы: {token}} для поиска с опечаткой
+        self._doc_tokens = {}  # {post_id: {token: вес}}
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        """Слова в нижнем регистре (кириллица и латиница), ё -> е, _ и точка — разделители"""
+        return re.findall(r"[^\W_]+", text.casefold().replace("ё", "е"))
+
+    @staticmethod
+    def _one_deletes(token: str) -> set:
+        return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+    def _doc_fields(self, post: dict) -> dict:
+        category = post.get('category', '')
+        return {
+            "title": post.get('title', ''),
+            "file_name": post.get('file_name', ''),
+            "category": f"{category} {CATEGORIES.get(category, '')}",
+        }
+
+    def _add_token(self, token: str, post_id: str, weight: float):
+        postings = self._postings.get(token)
+        if postings is None:
+            postings = self._postings[token] = {}
+            insort(self._vocab, token)
+            if len(token) >= self.MIN_FUZZY:
+                for variant in self._one_deletes(token):
+                    self._deletes.setdefault(variant, set()).add(token)
+        postings[post_id] = weight
+
+    def _remove_token(self, token: str, post_id: str):
+        postings = self._postings.get(token)
+        if postings is None:
+            return
+        postings.pop(post_id, None)
+        if postings:
+            return
+        del self._postings[token]
+        i = bisect_left(self._vocab, token)
+        if i < len(self._vocab) and self._vocab[i] == token:
+            del self._vocab[i]
+        if len(token) >= self.MIN_FUZZY:
+            for variant in self._one_deletes(token):
+                bucket = self._deletes.get(variant)
+                if bucket is not None:
+                    bucket.discard(token)
+                    if not bucket:
+                        del self._deletes[variant]
+
+    def clear(self):
+        self._postings.clear()
+        self._vocab.clear()
+        self._deletes.clear()
+        self._doc_tokens.clear()
+
+    def add(self, post_id: str, post: dict):
+        """Индексирует пост (при повторном вызове — переиндексирует только изменившиеся слова)"""
+        tokens = {}
+        for field, text in self._doc_fields(post).items():
+            weight = self.FIELD_WEIGHTS[field]
+            for token in self.tokenize(text):
+                if tokens.get(token, 0) < weight:
+                    tokens[token] = weight
+        old = self._doc_tokens.get(post_id, {})
+        for token in old.keys() - tokens.keys():
+            self._remove_token(token, post_id)
+        for token, weight in tokens.items():
+            if old.get(token) != weight:
+                self._add_token(token, post_id, weight)
+        self._doc_tokens[post_id] = tokens
+
+    def remove(self, post_id: str):
+        for token in self._doc_tokens.pop(post_id, {}):
+            self._remove_token(token, post_id)
+
+    @staticmethod
+    def _within_one_edit(a: str, b: str) -> bool:
+        """Расстояние Дамерау-Левенштейна не больше 1"""
+        if a == b:
+            return True
+        la, lb = len(a), len(b)
+        if abs(la - lb) > 1:
+            return False
+        i = 0
+        while i < min(la, lb) and a[i] == b[i]:
+            i += 1
+        if la == lb:
+            # Замена или перестановка соседних букв
+            return a[i + 1:] == b[i + 1:] or (a[i:i + 2] == b[i:i + 2][::-1] and a[i + 2:] == b[i + 2:])
+        # Вставка или удаление
+        return a[i + 1:] == b[i:] if la > lb else a[i:] == b[i + 1:]
+
+    def _matches(self, term: str) -> dict:
+        """Слова словаря, подходящие под слово запроса: {token: множитель совпадения}"""
+        found = {}
+        if term in self._postings:
+            found[term] = self.EXACT
+        if len(term) >= self.MIN_PREFIX:
+            i = bisect_left(self._vocab, term)
+            while i < len(self._vocab) and self._vocab[i].startswith(term):
+                found.setdefault(self._vocab[i], self.PREFIX)
+                i += 1
+        if len(term) >= self.MIN_FUZZY:
+            candidates = set(self._deletes.get(term, ()))
+            for variant in self._one_deletes(term):
+                candidates |= self._deletes.get(variant, set())
+                if variant in self._postings:
+                    candidates.add(variant)
+            for token in candidates:
+                if token not in found and self._within_one_edit(term, token):
+                    found[token] = self.FUZZY
+        return found
+
+    def search(self, query: str, limit: int = 10, among=None) -> list:
+        """Id постов по убыванию релевантности (при равенстве — по скачиваниям); among — искать только среди этих id"""
+        terms = list(dict.fromkeys(self.tokenize(query)))
+        if not terms:
+            return []
+        scores = {}
+        matched_terms = {}
+        for term in terms:
+            best = {}
+            for token, factor in self._matches(term).items():
+                postings = self._postings[token]
+                if among is not None:
+                    # Перебираем меньшее из двух множеств
+                    if len(among) < len(postings):
+                        postings = {pid: postings[pid] for pid in among if pid in postings}
+                    else:
+                        postings = {pid: w for pid, w in postings.items() if pid in among}
+                for post_id, weight in postings.items():
+                    score = weight * factor
+                    if score > best.get(post_id, 0):
+                        best[post_id] = score
+            for post_id, score in best.items():
+                scores[post_id] = scores.get(post_id, 0) + score
+                matched_terms[post_id] = matched_terms.get(post_id, 0) + 1
+        # Сначала посты, где нашлись все слова запроса
+        ranked = sorted(
+            scores,
+            key=lambda pid: (matched_terms[pid], scores[pid], posts.get(pid, {}).get('downloads', 0)),
+            reverse=True
+        )
+        return ranked[:limit]
+
+
+search_index = SearchIndex()
+
+
+LEADERBOARD_SIZE = 10  # Мест в общем топе на экране статистики
+WINDOW_TOP_SIZE = 5  # Мест в топах за период
+# Окна лидербордов: {код: (название, длина в часах)}
+LEADERBOARD_WINDOWS = {
+    "24h": ("за 24 часа", 24),
+    "7d": ("за 7 дней", 7 * 24),
+}
+
+
+class WindowedCounter:
+    """Скачивания за скользящее окно: почасовые корзины, итог окна и отсортированный топ"""
+
+    def __init__(self, hours: int):
+        self.hours = hours
+        self._buckets = deque()  # [(час, {post_id: скачиваний})] по возрастанию часа
+        self._counts = {}  # {post_id: скачиваний за окно}
+        self._top = OrderedIndex(lambda count: -count)
+        self.total = 0
+
+    def _sub(self, post_id: str, delta: int):
+        count = self._counts.get(post_id)
+        if count is None:
+            return
+        count -= delta
+        self.total -= delta
+        if count > 0:
+            self._counts[post_id] = count
+            self._top.add(post_id, count)
+        else:
+            del self._counts[post_id]
+            self._top.remove(post_id)
+
+    def _expire(self, hour: int):
+        # Корзины, вышедшие за окно, вычитаются целиком
+        while self._buckets and self._buckets[0][0] <= hour - self.hours:
+            _, bucket = self._buckets.popleft()
+            for post_id, delta in bucket.items():
+                self._sub(post_id, delta)
+
+    def add(self, post_id: str, delta: int, now: float):
+        hour = int(now // 3600)
+        if self._buckets:
+            # Корзины идут по возрастанию: запоздавшее событие попадает в последнюю
+            hour = max(hour, self._buckets[-1][0])
+        self._expire(hour)
+        if not self._buckets or self._buckets[-1][0] != hour:
+            self._buckets.append((hour, {}))
+        bucket = self._buckets[-1][1]
+        bucket[post_id] = bucket.get(post_id, 0) + delta
+        self._counts[post_id] = self._counts.get(post_id, 0) + delta
+        self._top.add(post_id, self._counts[post_id])
+        self.total += delta
+
+    def remove(self, post_id: str):
+        """Убирает удаленный пост (его записи в корзинах при истечении пропускаются)"""
+        count = self._counts.pop(post_id, None)
+        if count is not None:
+            self.total -= count
+            self._top.remove(post_id)
+
+    def top(self, limit: int, now: float) -> list:
+        """[(post_id, скачиваний за окно)] по убыванию"""
+        self._expire(int(now // 3600))
+        return [(post_id, self._counts[post_id]) for post_id in self._top.slice(0, limit)]
+
+    def clear(self):
+        self._buckets.clear()
+        self._counts.clear()
+        self._top = OrderedIndex(lambda count: -count)
+        self.total = 0
+
+
+class Leaderboard:
+    """Итог скачиваний и топы: общий (по индексу "Популярные") и за периоды"""
+
+    def __init__(self):
+        self.total = 0
+        self._downloads = {}  # {post_id: скачиваний, учтенных в total}
+        self.windows = {code: WindowedCounter(hours) for code, (_, hours) in LEADERBOARD_WINDOWS.items()}
+
+    def add_post(self, post_id: str, post: dict):
+        """Учитывает новый пост или расхождение счетчика после правки"""
+        downloads = post.get('downloads', 0)
+        self.total += downloads - self._downloads.get(post_id, 0)
+        self._downloads[post_id] = downloads
+
+    def remove_post(self, post_id: str):
+        self.total -= self._downloads.pop(post_id, 0)
+        for window in self.windows.values():
+            window.remove(post_id)
+
+    def record(self, post_id: str, delta: int = 1, now: float = None):
+        """Засчитывает скачивание в общий итог и во все окна"""
+        now = time.time() if now is None else now
+        self.total += delta
+        self._downloads[post_id] = self._downloads.get(post_id, 0) + delta
+        for window in self.windows.values():
+            window.add(post_id, delta, now)
+
+    def replay(self, post_id: str, ts: float, delta: int = 1):
+        """Восстанавливает окна из сохраненного события или часовой корзины (общий итог уже учтен в posts)"""
+        for window in self.windows.values():
+            window.add(post_id, delta, ts)
+
+    def top(self, limit: int) -> list:
+        return catalog_index.page("all", "top", 0, limit)
+
+    def window_top(self, code: str, limit: int) -> list:
+        return self.windows[code].top(limit, time.time())
+
+    def clear(self):
+        self.total = 0
+        self._downloads.clear()
+        for window in self.windows.values():
+            window.clear()
+
+
+leaderboard = Leaderboard()
+
+
+# =====================
+# АНАЛИТИКА СКАЧИВАНИЙ
+# =====================
+
+# Точки входа скачивания: {код: название}
+DOWNLOAD_SOURCES = {
+    "link": "🔗 Ссылка из канала",
+    "catalog": "📂 Каталог",
+    "button": "⬇️ Кнопка скачивания",
+    "recheck": "🔄 Повторная проверка",
+}
+# Разрешения графиков: {код: (название, шаг в секундах, число корзин)}
+ROLLUP_RESOLUTIONS = {
+    "minute": ("Минуты", 60, 60),
+    "hour": ("Часы", 3600, 48),
+    "day": ("Дни", 86400, 30),
+}
+ANALYTICS_RETENTION_DAYS = 90  # Сколько дней хранятся сырые события скачиваний
+ANALYTICS_PRUNE_INTERVAL = 3600  # Как часто удалять события старше срока хранения (сек)
+WINDOW_STEP = 3600  # Окна топов (WindowedCounter) собираются из часовых корзин
+# Сколько хранить агрегаты каждого шага (сек): глубина графика, а часовых — еще и самое длинное окно топа
+ROLLUP_KEEP = {step: step * size for _, step, size in ROLLUP_RESOLUTIONS.values()}
+ROLLUP_KEEP[WINDOW_STEP] = max(ROLLUP_KEEP.get(WINDOW_STEP, 0), max(h for _, h in LEADERBOARD_WINDOWS.values()) * 3600)
+ROLLUP_STEP_RESOLUTIONS = {step: res for res, (_, step, _) in ROLLUP_RESOLUTIONS.items()}
+
+
+class RollupSeries:
+    """Кольцевой массив счетчиков одного разрешения: корзина на каждый шаг времени"""
+
+    def __init__(self, step: int, size: int):
+        self.step = step
+        self.size = size
+        self._counts = array("I", bytes(4 * size))
+        self._head = None  # Номер последней корзины (ts // step)
+
+    def _advance(self, slot: int):
+        # Корзины между прошлой головой и новой обнуляются — их время прошло без скачиваний
+        if self._head is None or slot - self._head >= self.size:
+            self._counts = array("I", bytes(4 * self.size))
+        else:
+            for s in range(self._head + 1, slot + 1):
+                self._counts[s % self.size] = 0
+        self._head = slot
+
+    def add(self, ts: float, delta: int = 1):
+        slot = int(ts // self.step)
+        if self._head is None or slot > self._head:
+            self._advance(slot)
+        if slot > self._head - self.size:
+            self._counts[slot % self.size] += delta
+
+    def points(self, now: float) -> list:
+        """[(начало корзины, скачиваний)] от старых к новым, последняя — текущая"""
+        slot = int(now // self.step)
+        if self._head is None or slot > self._head:
+            self._advance(slot)
+        return [(s * self.step, self._counts[s % self.size]) for s in range(slot - self.size + 1, slot + 1)]
+
+
+class DownloadAnalytics:
+    """Агрегаты скачиваний по минутам/часам/дням: общий, по категориям и по модам"""
+
+    def __init__(self):
+        self._series = {}  # {ключ: {разрешение: RollupSeries}}
+
+    def _get(self, key: str) -> dict:
+        series = self._series.get(key)
+        if series is None:
+            series = {res: RollupSeries(step, size) for res, (_, step, size) in ROLLUP_RESOLUTIONS.items()}
+            self._series[key] = series
+        return series
+
+    def record(self, post_id: str, category: str, ts: float):
+        for key in ("all", f"cat:{category}", f"post:{post_id}"):
+            for series in self._get(key).values():
+                series.add(ts)
+
+    def restore(self, post_id: str, category: str, resolution: str, ts: float, count: int):
+        """Добавляет сохраненную корзину одного разрешения"""
+        for key in ("all", f"cat:{category}", f"post:{post_id}"):
+            self._get(key)[resolution].add(ts, count)
+
+    def forget_post(self, post_id: str):
+        """Убирает ряды удаленного мода (в категории и общем графике история остается)"""
+        self._series.pop(f"post:{post_id}", None)
+
+    def points(self, key: str, resolution: str, now: float) -> list:
+        return self._get(key)[resolution].points(now)
+
+    def clear(self):
+        self._series.clear()
+
+
+download_analytics = DownloadAnalytics()
+
+
+ROLLUP_HORIZON = max(step * size for _, step, size in ROLLUP_RESOLUTIONS.values())
+_events_cursor = 0  # id последнего учтенного события из хранилища
+
+
+def rollup_rows(events) -> list:
+    """Агрегаты пачки событий по всем шагам: [(post_id, шаг, корзина, скачиваний)]"""
+    counts = Counter()
+    for post_id, _, ts, _ in events:
+        for step in ROLLUP_KEEP:
+            counts[(post_id, step, int(ts // step))] += 1
+    return [(*key, count) for key, count in counts.items()]
+
+
+def rollup_cutoffs(now: float) -> dict:
+    """Первая хранимая корзина каждого шага: {шаг: корзина}"""
+    return {step: int((now - keep) // step) + 1 for step, keep in ROLLUP_KEEP.items()}
+
+
+def apply_download_events(events: list, with_uniques: bool = False):
+    """Пополняет окна топов и графики (и при необходимости уникальных) сохраненными событиями"""
+    global _events_cursor
+    for event_id, post_id, user_id, ts, source in events:
+        _events_cursor = event_id
+        post = posts.get(post_id)
+        if post is None:
+            continue
+        leaderboard.replay(post_id, ts)
+        download_analytics.record(post_id, post.get('category'), ts)
+        if with_uniques:
+            # Скетч уже записан процессом-источником — повторно не сохраняем
+            unique_downloaders.record(post_id, user_id, ts, persist=False)
+
+
+async def prune_download_events():
+    """Удаляет сырые события старше ANALYTICS_RETENTION_DAYS и агрегаты, вышедшие за графики и окна топов"""
+    now = time.time()
+    try:
+        await storage.prune_download_events(now - ANALYTICS_RETENTION_DAYS * 86400)
+        await storage.prune_download_rollups(rollup_cutoffs(now))
+    except Exception as e:
+        logger.error(f"Ошибка очистки событий скачиваний: {e}")
+
+
+async def load_download_history():
+    """Восстанавливает графики и окна топов из сохраненных агрегатов, не перебирая сырые события"""
+    global _events_cursor
+    await prune_download_events()
+    rollups, _events_cursor = await storage.load_download_rollups(rollup_cutoffs(time.time()))
+    for post_id, step, slot, count in rollups:
+        post = posts.get(post_id)
+        if post is None:
+            continue
+        if step == WINDOW_STEP:
+            leaderboard.replay(post_id, slot * step, count)
+        resolution = ROLLUP_STEP_RESOLUTIONS.get(step)
+        if resolution is not None:
+            download_analytics.restore(post_id, post.get('category'), resolution, slot * step, count)
+    logger.info(f"Загружено агрегатов скачиваний: {len(rollups)}")
+
+
+# =====================
+# УНИКАЛЬНЫЕ СКАЧИВАНИЯ
+# =====================
+
+HLL_PRECISION = 10  # 2^10 регистров = 1 КБ на скетч, погрешность ~3%
+UNIQUE_DAYS_KEPT = 30  # Сколько дневных скетчей хранить для оценок за период
+
+
+class HyperLogLog:
+    """Оценка числа уникальных пользователей в фиксированной памяти; скетчи объединяются"""
+
+    def __init__(self, registers: bytes = None):
+        self.m = 1 << HLL_PRECISION
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+
+    def add(self, user_id: int):
+        x = int.from_bytes(hashlib.blake2b(user_id.to_bytes(8, "little", signed=True), digest_size=8).digest(), "big")
+        index = x >> (64 - HLL_PRECISION)
+        # Ранг — позиция первой единицы в оставшихся битах
+        rest = x & ((1 << (64 - HLL_PRECISION)) - 1)
+        rank = (64 - HLL_PRECISION) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.m
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Малые значения: линейный подсчет по пустым регистрам
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class UniqueDownloaders:
+    """Скетчи уникальных скачавших: общий, по модам и по дням (для оценок за период)"""
+
+    def __init__(self):
+        self._sketches = {}  # {"all" | "post:<id>" | "day:<ГГГГММДД>": HyperLogLog}
+        self._dirty = set()  # Ключи, измененные после последней записи в хранилище
+
+    def load(self, sketches: dict):
+        self._sketches = {key: HyperLogLog(registers) for key, registers in sketches.items()}
+
+    def record(self, post_id: str, user_id: int, ts: float, persist: bool = True):
+        day = datetime.fromtimestamp(ts).strftime("%Y%m%d")
+        for key in ("all", f"post:{post_id}", f"day:{day}"):
+            sketch = self._sketches.get(key)
+            if sketch is None:
+                sketch = self._sketches[key] = HyperLogLog()
+            sketch.add(user_id)
+            if persist:
+                self._dirty.add(key)
+
+    def count(self, key: str) -> int:
+        sketch = self._sketches.get(key)
+        return sketch.count() if sketch else 0
+
+    def post_count(self, post_id: str) -> int:
+        return self.count(f"post:{post_id}")
+
+    def window_count(self, days: int, now: float) -> int:
+        """Уникальные за последние days дней: объединение дневных скетчей"""
+        merged = HyperLogLog()
+        for i in range(days):
+            sketch = self._sketches.get(f"day:{(datetime.fromtimestamp(now) - timedelta(days=i)).strftime('%Y%m%d')}")
+            if sketch:
+                merged.merge(sketch)
+        return merged.count()
+
+    def forget_post(self, post_id: str):
+        self._sketches.pop(f"post:{post_id}", None)
+        self._dirty.discard(f"post:{post_id}")
+
+    def expired_days(self, now: float) -> list:
+        """Дневные скетчи старше UNIQUE_DAYS_KEPT (удаляются из памяти)"""
+        oldest = (datetime.fromtimestamp(now) - timedelta(days=UNIQUE_DAYS_KEPT)).strftime("%Y%m%d")
+        expired = [key for key in self._sketches if key.startswith("day:") and key[4:] < oldest]
+        for key in expired:
+            del self._sketches[key]
+        return expired
+
+    def take_dirty(self) -> dict:
+        """Измененные скетчи для записи в хранилище"""
+        dirty = {key: bytes(self._sketches[key].registers) for key in self._dirty if key in self._sketches}
+        self._dirty.clear()
+        return dirty
+
+    def mark_dirty(self, keys):
+        self._dirty.update(keys)
+
+
+unique_downloaders = UniqueDownloaders()
+
+
+async def load_unique_downloaders():
+    """Загружает скетчи уникальных и удаляет устаревшие дневные"""
+    unique_downloaders.load(await storage.load_sketches())
+    expired = unique_downloaders.expired_days(time.time())
+    if expired:
+        await storage.delete_sketches(expired)
+
+
+def index_post(post_id: str, clear_inline: bool = True):
+    """Обновляет индексы после публикации или правки поста"""
+    catalog_index.add(post_id, posts[post_id])
+    search_index.add(post_id, posts[post_id])
+    post_ids.add(post_id, posts[post_id])
+    leaderboard.add_post(post_id, posts[post_id])
+    render_cache.invalidate(post_id)
+    if clear_inline:
+        inline_cache.clear()
+
+
+def unindex_post(post_id: str, clear_inline: bool = True):
+    """Убирает пост из индексов перед удалением"""
+    catalog_index.remove(post_id)
+    search_index.remove(post_id)
+    post_ids.remove(post_id)
+    leaderboard.remove_post(post_id)
+    download_analytics.forget_post(post_id)
+    unique_downloaders.forget_post(post_id)
+    render_cache.invalidate(post_id)
+    if clear_inline:
+        inline_cache.clear()
+
+
+def rebuild_indexes():
+    """Полностью перестраивает индексы (при запуске)"""
+    catalog_index.clear()
+    search_index.clear()
+    post_ids.clear()
+    leaderboard.clear()
+    download_analytics.clear()
+    for post_id in posts:
+        index_post(post_id)
+
+
+# =====================
+# CALLBACK-ДАННЫЕ
+# =====================
+
+# callback_data = <действие>:<аргумент>:<аргумент>; обработчик ищется по действию в словаре,
+# так что префиксы вроде cat_ и cat_browse_ больше не пересекаются
+CALLBACK_SEP = ":"
+CALLBACK_DATA_LIMIT = 64  # Ограничение Telegram на callback_data (байт)
+
+
+def pack_callback(action: str, *args) -> str:
+    """Собирает callback_data из действия и аргументов"""
+    data = CALLBACK_SEP.join((action, *map(str, args)))
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data}")
+    return data
+
+
+def unpack_int(value: str):
+    """Число из callback_data; None, если данные подделаны или испорчены"""
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def pack_id(post_id: str) -> str:
+    """UUID (предложения или поста из старых сообщений) в кнопке: 22 символа base64 вместо 36"""
+    try:
+        raw = uuid.UUID(post_id).bytes
+    except ValueError:
+        return post_id
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def unpack_id(packed: str) -> str:
+    """Обратное к pack_id; старый UUID поста (упакованный или из кнопки старого формата) переводится в его текущий id"""
+    if len(packed) == 22:
+        try:
+            packed = str(uuid.UUID(bytes=base64.urlsafe_b64decode(packed + "==")))
+        except ValueError:
+            return packed
+    return post_ids.resolve(packed)
+
+
+class CallbackRouter:
+    """Таблица {действие: обработчик} вместо цепочки фильтров F.data.startswith"""
+
+    def __init__(self):
+        self._routes = {}  # {действие: (обработчик, состояние FSM или None, нужен ли FSMContext, число аргументов)}
+        self._legacy = {}  # {префикс старого формата: (обработчик, нужен ли FSMContext)}
+
+    def route(self, action: str, state: State = None, args: int = 0, with_state: bool = False):
+        """Декоратор: обработчик получает (call[, state], *аргументы) — ровно args аргументов"""
+        def decorator(handler):
+            if action in self._routes:
+                raise ValueError(f"Действие {action} уже занято")
+            self._routes[action] = (handler, state, with_state, args)
+            return handler
+        return decorator
+
+    def legacy(self, prefix: str, with_state: bool = False):
+        """Декоратор для кнопок старого формата «<prefix><uuid>», еще живущих в чатах (убрать через релиз)"""
+        def decorator(handler):
+            self._legacy[prefix] = (handler, with_state)
+            return handler
+        return decorator
+
+    async def dispatch(self, call: CallbackQuery, state: FSMContext):
+        action, *args = (call.data or "").split(CALLBACK_SEP)
+        route = self._routes.get(action)
+        if route is None and not args:
+            for prefix, (handler, wants_state) in self._legacy.items():
+                if action.startswith(prefix):
+                    arg = action[len(prefix):]
+                    return await (handler(call, state, arg) if wants_state else handler(call, arg))
+        if route is None:
+            # Кнопки из старых сообщений (до смены формата) и неизвестные данные
+            return await call.answer("⌛ Кнопка устарела, откройте меню заново", show_alert=True)
+        handler, required_state, wants_state, nargs = route
+        if len(args) != nargs:
+            logger.warning(f"Некорректные callback-данные: {call.data!r}")
+            return await call.answer()
+        if required_state is not None and await state.get_state() != required_state.state:
+            return await call.answer()
+        if wants_state:
+            return await handler(call, state, *args)
+        return await handler(call, *args)
+
+
+callbacks = CallbackRouter()
+
+
+@dp.callback_query()
+async def route_callback(call: CallbackQuery, state: FSMContext):
+    """Единственный обработчик callback-запросов"""
+    await callbacks.dispatch(call, state)
+
+
+# =====================
+# КЛАВИАТУРЫ И ПОДПИСИ
+# =====================
+
+# Статичные меню собираются один раз
+ADMIN_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📂 Моды", callback_data="mods_list")],
+    [InlineKeyboardButton(text="➕ Добавить пост", callback_data="add_post")],
+    [InlineKeyboardButton(text="👥 Управление админами", callback_data="manage_admins")],
+    [InlineKeyboardButton(text="⚙️ Управление", callback_data="manage_mods")],
+    [InlineKeyboardButton(text="📬 Рассылки", callback_data="broadcasts")],
+    [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")],
+    [InlineKeyboardButton(text="📈 Аналитика", callback_data=pack_callback("an", "all", "hour", "all"))]
+])
+
+MAIN_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📂 Просмотреть моды", callback_data="mods_list")],
+    [InlineKeyboardButton(text="💡 Предложить идею", callback_data="suggest_idea")]
+])
+
+# Кнопка отмены для inline prompts
+CANCEL_INLINE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_post")]
+])
+
+# Кнопки уведомления при публикации
+NOTIFY_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Уведомить всех", callback_data=pack_callback("notify", "yes"))],
+    [InlineKeyboardButton(text="❌ Не уведомлять", callback_data=pack_callback("notify", "no"))]
+])
+
+# Кнопки подтверждения/отмены публикации при предпросмотре
+CONFIRM_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Опубликовать", callback_data="confirm_post")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_post")]
+])
+
+
+class RenderCache:
+    """Готовые подписи и клавиатуры постов: строятся один раз и сбрасываются при правке поста"""
+
+    def __init__(self):
+        self._entries = {}  # {post_id: {вид: подпись или клавиатура}}
+
+    def get(self, post_id: str, kind, build):
+        entries = self._entries.setdefault(post_id, {})
+        value = entries.get(kind)
+        if value is None:
+            value = entries[kind] = build()
+        return value
+
+    def invalidate(self, post_id: str):
+        self._entries.pop(post_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+render_cache = RenderCache()
+
+
+def _build_caption(post: dict, kind: str) -> str:
+    if kind == "announce":
+        return f"🆕 <b>Новый мод!</b>\n\n🔥 {post['title']}\n\n📥 Нажмите кнопку для скачивания"
+    caption = f"🔥 <b>{post['title']}</b>\n\n📥 Нажмите кнопку для скачивания"
+    if kind in ("file", "details") and "file" in post:
+        file_size_mb = post['file_size'] / (1024 * 1024)
+        caption += f"\n\n📦 Файл: {post['file_name']}\n💾 Размер: {file_size_mb:.2f} МБ"
+    elif kind == "details" and "link" in post:
+        caption += f"\n\n🔗 Ссылка: {post['link']}"
+    return caption
+
+
+def post_caption(post_id: str, post: dict, kind: str = "post") -> str:
+    """Подпись поста: post — карточка, file — с данными файла, details — с файлом или ссылкой, announce — рассылка"""
+    return render_cache.get(post_id, ("caption", kind), lambda: _build_caption(post, kind))
+
+
+def download_keyboard(post_id: str):
+    """Кнопка скачивания/предпросмотра для превью"""
+    def build():
+        bot_username = bot_context.username
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬇️ Скачать", url=f"https://t.me/{bot_username}?start=download_{post_id}")],
+            [InlineKeyboardButton(text=f"@{bot_username}", url=f"https://t.me/{bot_username}")]
+        ])
+    return render_cache.get(post_id, "download", build)
+
+
+def subscribe_keyboard(post_id: str, missing: list):
+    """Клавиатура с ссылками на отсутствующие каналы и deep-link кнопкой проверки"""
+    def build():
+        bot_username = bot_context.username
+        buttons = []
+        for ch in missing:
+            # Allow both @name and full URL
+            ch_name = ch if ch.startswith("@") else f"@{ch}"
+            buttons.append([InlineKeyboardButton(text=ch_name, url=f"https://t.me/{ch_name.lstrip('@')}")])
+        # Используем deep link, чтобы пользователь открыл бота и проверка выполнялась в приватном чате
+        buttons.append([InlineKeyboardButton(text="✅ Проверить подписки", url=f"https://t.me/{bot_username}?start=check_{post_id}")])
+        return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return render_cache.get(post_id, ("subscribe", tuple(missing)), build)
 
 
 def suggestion_review_menu(suggestion_id):
     """Меню для проверки предложения"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve_{suggestion_id}")],
-        [InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{suggestion_id}")]
+        [InlineKeyboardButton(text="✅ Одобрить", callback_data=pack_callback("approve", pack_id(suggestion_id)))],
+        [InlineKeyboardButton(text="❌ Отклонить", callback_data=pack_callback("reject", pack_id(suggestion_id)))]
     ])
 
 
-def mods_pagination(page=0, total_pages=1):
-    """Пагинация списка модов"""
-    buttons = []
+def mods_pagination(prefix: str, offset: int, total: int, page_size: int) -> list:
+    """Ряд кнопок навигации; callback_data = <prefix>:<смещение>"""
+    # Смещение, а не ключ последнего поста: страница — срез отсортированного списка в памяти (O(размер страницы)),
+    # номер страницы "n/N" считается из смещения, а ключ сортировки (название) не влезает в 64 байта callback_data
+    page = offset // page_size
+    total_pages = max(1, (total + page_size - 1) // page_size)
     nav_buttons = []
     
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"page_{page-1}"))
+        nav_buttons.append(InlineKeyboardButton(text="◀️", callback_data=pack_callback(prefix, offset - page_size)))
     
     nav_buttons.append(InlineKeyboardButton(text=f"{page+1}/{total_pages}", callback_data="page_info"))
     
     if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"page_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton(text="▶️", callback_data=pack_callback(prefix, offset + page_size)))
     
-    if nav_buttons:
-        buttons.append(nav_buttons)
-    
-    buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")])
-    
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return nav_buttons
+
+
+def sort_buttons(prefix: str, current: str) -> list:
+    """Ряд кнопок выбора сортировки; callback_data = <prefix>:<порядок>:0"""
+    return [
+        InlineKeyboardButton(
+            text=f"• {name}" if order == current else name,
+            callback_data=pack_callback(prefix, order, 0)
+        )
+        for order, (name, _) in SORT_ORDERS.items()
+    ]
 
 
 # =====================
 # Проверка подписки
 # =====================
 
-async def check_subscription(user_id: int, required_channels: list = None) -> tuple:
+SUBSCRIPTION_CACHE_SIZE = 50000  # Максимум пар (пользователь, канал) в кэше
+SUBSCRIPTION_POSITIVE_TTL = 600  # Сколько помним, что пользователь подписан (сек)
+SUBSCRIPTION_NEGATIVE_TTL = 30  # Сколько помним, что пользователь НЕ подписан (сек)
+
+MEMBER_STATUSES = ("member", "creator", "administrator")
+
+SUBSCRIPTION_CHECK_CONCURRENCY = 10  # Одновременных запросов get_chat_member на весь бот
+SUBSCRIPTION_CHECK_TIMEOUT = 5  # Таймаут одного запроса (сек)
+
+
+class SubscriptionCache:
+    """LRU-кэш результатов get_chat_member по паре (user_id, channel_id) с отдельными TTL"""
+
+    def __init__(self, maxsize: int, positive_ttl: float, negative_ttl: float):
+        self.maxsize = maxsize
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()  # {(user_id, channel_id): (is_member, expires_at)}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, channel_id: str):
+        """Возвращает закэшированный результат или None"""
+        key = (user_id, channel_id.lower())
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return is_member
+
+    def set(self, user_id: int, channel_id: str, is_member: bool):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        key = (user_id, channel_id.lower())
+        self._data[key] = (is_member, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id: int, channel_id: str):
+        self._data.pop((user_id, channel_id.lower()), None)
+
+    def stats_text(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits * 100 / total if total else 0
+        return f"{self.hits} попаданий / {self.misses} промахов ({rate:.0f}%), записей: {len(self._data)}"
+
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL)
+
+
+def resolve_channel_id(channel: str) -> str:
+    """Ключ из CHANNELS или имя канала -> @username"""
+    if channel in CHANNELS:
+        return CHANNELS[channel]
+    return channel if channel.startswith("@") else "@" + channel
+
+
+_subscription_semaphore = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
+
+
+async def fetch_membership(user_id: int, channel_id: str) -> bool:
+    """Один запрос get_chat_member с ограничением параллельности и таймаутом"""
+    try:
+        async with _subscription_semaphore:
+            member = await asyncio.wait_for(
+                bot.get_chat_member(channel_id, user_id),
+                timeout=SUBSCRIPTION_CHECK_TIMEOUT
+            )
+    except asyncio.TimeoutError:
+        logger.error(f"Таймаут проверки подписки на {channel_id}")
+        return False
+    except Exception as e:
+        # Ошибки не кэшируем: следующая проверка снова спросит Telegram
+        logger.error(f"Ошибка проверки подписки на {channel_id}: {e}")
+        return False
+    is_member = member.status in MEMBER_STATUSES
+    subscription_cache.set(user_id, channel_id, is_member)
+    return is_member
+
+
+async def check_subscription(user_id: int, required_channels: list = None, use_cache: bool = True) -> tuple:
     """Проверяет подписку пользователя на указанные каналы"""
+    # use_cache=False — принудительный запрос к Telegram (повторная проверка подписки),
+    # свежий результат все равно попадает в кэш
     if required_channels is None:
         required_channels = ["main"]
     
-    not_subscribed = []
+    results = {}  # {channel: is_member}
+    to_fetch = []
     
     for channel in required_channels:
-        # Если это ключ из CHANNELS, берем значение, иначе используем как есть
-        if channel in CHANNELS:
-            channel_id = CHANNELS[channel]
+        channel_id = resolve_channel_id(channel)
+        cached = subscription_cache.get(user_id, channel_id) if use_cache else None
+        if cached is not None:
+            results[channel] = cached
         else:
-            channel_id = channel if channel.startswith("@") else "@" + channel
-        
-        try:
-            member = await bot.get_chat_member(channel_id, user_id)
-            if member.status not in ["member", "creator", "administrator"]:
-                not_subscribed.append(channel)
-        except TelegramBadRequest as e:
-            logger.error(f"Ошибка проверки подписки на {channel_id}: {e}")
-            not_subscribed.append(channel)
+            to_fetch.append((channel, channel_id))
+    
+    # Все недостающие каналы проверяем одновременно: медленный канал не задерживает остальные
+    if to_fetch:
+        fetched = await asyncio.gather(*(fetch_membership(user_id, ch_id) for _, ch_id in to_fetch))
+        for (channel, _), is_member in zip(to_fetch, fetched):
+            results[channel] = is_member
+    
+    # Порядок отсутствующих каналов совпадает с порядком required_channels
+    not_subscribed = [channel for channel in required_channels if not results[channel]]
     
     return len(not_subscribed) == 0, not_subscribed
 
 
+@dp.chat_member()
+async def on_chat_member_update(update: ChatMemberUpdated):
+    """Сбрасывает кэш подписки, когда пользователь вступает в канал или выходит из него"""
+    if update.chat.username:
+        subscription_cache.invalidate(update.new_chat_member.user.id, f"@{update.chat.username}")
+
+
+# =====================
+# Публикация в каналы
+# =====================
+
+CHANNEL_CONCURRENCY = 5  # Одновременных запросов к каналам
+CHANNEL_MAX_RETRIES = 3  # Повторов после флуд-лимита или сетевой ошибки
+CHANNEL_RETRY_BASE_DELAY = 1  # Начальная пауза между повторами (сек), дальше удваивается
+
+_channel_semaphore = asyncio.Semaphore(CHANNEL_CONCURRENCY)
+
+
+async def call_with_retry(make_call, retry_network: bool = False):
+    """Выполняет запрос к API, повторяя его после RetryAfter (и сетевых ошибок, если retry_network)"""
+    # Отправку после сетевой ошибки не повторяем: Telegram мог уже принять запрос, и пост вышел бы дважды
+    delay = CHANNEL_RETRY_BASE_DELAY
+    for attempt in range(CHANNEL_MAX_RETRIES + 1):
+        try:
+            return await make_call()
+        except TelegramRetryAfter as e:
+            if attempt == CHANNEL_MAX_RETRIES:
+                raise
+            await asyncio.sleep(max(e.retry_after, delay))
+        except TelegramNetworkError:
+            if not retry_network or attempt == CHANNEL_MAX_RETRIES:
+                raise
+            await asyncio.sleep(delay)
+        delay *= 2
+
+
+async def run_for_channels(channel_ids: list, action, retry_network: bool = False) -> dict:
+    """Параллельно выполняет action(channel_id) для каждого канала; {channel_id: (ok, результат или ошибка)}"""
+    # retry_network — только для идемпотентных действий (правка сообщений)
+    async def run_one(channel_id):
+        try:
+            async with _channel_semaphore:
+                return True, await call_with_retry(lambda: action(channel_id), retry_network)
+        except Exception as e:
+            return False, e
+
+    results = await asyncio.gather(*(run_one(channel_id) for channel_id in channel_ids))
+    return dict(zip(channel_ids, results))
+
+
+def format_channel_results(results: dict) -> str:
+    """Итоги по каналам для сообщения админу"""
+    if not results:
+        return ""
+    lines = []
+    for channel_id, (ok, result) in results.items():
+        lines.append(f"✅ {channel_id}" if ok else f"❌ {channel_id}: {html.escape(str(result))[:100]}")
+    return "\n\n📢 <b>Каналы:</b>\n" + "\n".join(lines)
+
+
 # =====================
 # Проверка бана
 # =====================
@@ -256,10 +2840,10 @@ def is_banned(user_id: int) -> bool:
     return user_id in banned_users
 
 
-def check_suggestion_cooldown(user_id: int) -> tuple:
+async def check_suggestion_cooldown(user_id: int) -> tuple:
     """Проверяет кулдаун на предложения"""
-    if user_id in suggestion_cooldowns:
-        last_time = suggestion_cooldowns[user_id]
+    last_time = await storage.get_cooldown(user_id)
+    if last_time is not None:
         time_passed = time.time() - last_time
         
         if time_passed < SUGGESTION_COOLDOWN:
@@ -269,7 +2853,7 @@ def check_suggestion_cooldown(user_id: int) -> tuple:
     return True, 0
 
 
-def add_suggestion_violation(user_id: int):
+async def add_suggestion_violation(user_id: int):
     """Добавляет нарушение за спам предложениями"""
     if user_id not in suggestion_violations:
         suggestion_violations[user_id] = 0
@@ -278,6 +2862,7 @@ def add_suggestion_violation(user_id: int):
     
     if suggestion_violations[user_id] >= MAX_SUGGESTIONS_PER_USER:
         banned_users.add(user_id)
+        await storage.set_banned(user_id, True)
         return True
     
     return False
@@ -300,6 +2885,86 @@ def is_owner(user_id: int) -> bool:
     return user_id == OWNER_ID
 
 
+# =====================
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ
+# =====================
+
+# Token bucket на пользователя в каждой группе обработчиков: {группа: (запросов в секунду, запас)}
+THROTTLE_LIMITS = {
+    "download": (0.2, 5),  # Скачивание и проверка подписки (get_chat_member, запись счетчиков)
+    "browse": (2, 15),  # Листание каталога
+    "inline": (1, 10),  # Inline-поиск
+    "default": (1, 20),  # Все остальное
+}
+# Группы callback-действий; не перечисленные относятся к default
+THROTTLE_ACTIONS = {
+    "mod": "download",
+    "mods_list": "browse",
+    "all_mods": "browse",
+    "browse": "browse",
+    "page": "browse",
+    "page_info": "browse",
+}
+THROTTLE_MAX_KEYS = 50000  # Сколько пар (пользователь, группа) помнить, лишние — с давно неактивных
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает слишком частые апдейты пользователя до чтения FSM, фильтров и хендлеров (админов не ограничивает)"""
+
+    def __init__(self, limits: dict, max_keys: int):
+        self.limits = limits
+        self.max_keys = max_keys
+        # Процесс видит все апдейты своих пользователей (см. run_front), так что счетчики локальные
+        self._buckets = OrderedDict()  # {(user_id, группа): (токены, время обновления, предупрежден ли)}
+
+    @staticmethod
+    def group(event) -> str:
+        if isinstance(event, CallbackQuery):
+            return THROTTLE_ACTIONS.get((event.data or "").split(CALLBACK_SEP, 1)[0], "default")
+        if isinstance(event, InlineQuery):
+            return "inline"
+        if isinstance(event, Message) and (event.text or "").startswith(("/start download_", "/start check_")):
+            return "download"
+        return "default"
+
+    def allow(self, user_id: int, group: str) -> tuple:
+        """(пропустить ли апдейт, нужно ли сообщить об отказе)"""
+        rate, burst = self.limits[group]
+        key = (user_id, group)
+        now = time.monotonic()
+        tokens, updated, warned = self._buckets.pop(key, (burst, now, False))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now, False)
+            result = True, False
+        else:
+            # Об отказе сообщаем один раз за серию, остальные лишние апдейты просто отбрасываем
+            self._buckets[key] = (tokens, now, True)
+            result = False, not warned
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return result
+
+    async def __call__(self, handler, update, data):
+        # Пользователя уже определил UserContextMiddleware, состояние FSM еще не читалось
+        user = data.get("event_from_user")
+        if user is None or is_admin(user.id):
+            return await handler(update, data)
+        event = update.event
+        allowed, notify = self.allow(user.id, self.group(event))
+        if allowed:
+            return await handler(update, data)
+        if isinstance(event, CallbackQuery):
+            # Без ответа у пользователя будет крутиться индикатор загрузки на кнопке; текст — один раз за серию
+            await event.answer("⏳ Слишком часто, подождите немного" if notify else None)
+
+
+throttling = ThrottlingMiddleware(THROTTLE_LIMITS, THROTTLE_MAX_KEYS)
+dp.update.outer_middleware(throttling)
+# Состояние FSM (и запрос к хранилищу при промахе кэша) — только для пропущенных апдейтов
+dp.update.outer_middleware(dp.fsm)
+
+
 # =====================
 # START
 # =====================
@@ -314,7 +2979,7 @@ async def start_handler(message: Message):
     except Exception:
         return
     user_id = message.from_user.id
-    users.add(user_id)
+    await storage.add_user(user_id)
     
     # Проверка бана
     if is_banned(user_id):
@@ -329,6 +2994,9 @@ async def start_handler(message: Message):
         args = message.text.split()[1]
         if args.startswith("download_"):
             return await handle_download(message, args)
+        if args.startswith("check_"):
+            # Кнопка «✅ Проверить подписки»: проверяем подписку в обход кэша
+            return await handle_download(message, "download_" + args[len("check_"):], use_cache=False, source="recheck")
     
     text = (
         "🔥 <b>YAKMODS</b>\n\n"
@@ -341,23 +3009,23 @@ async def start_handler(message: Message):
             await message.answer_photo(
                 START_IMAGE,
                 caption=text,
-                reply_markup=admin_menu()
+                reply_markup=ADMIN_MENU
             )
         else:
             await message.answer_photo(
                 START_IMAGE,
                 caption=text,
-                reply_markup=main_menu()
+                reply_markup=MAIN_MENU
             )
     except Exception as e:
         logger.error(f"Ошибка отправки стартового сообщения: {e}")
         if is_admin(user_id):
-            await message.answer(text, reply_markup=admin_menu())
+            await message.answer(text, reply_markup=ADMIN_MENU)
         else:
-            await message.answer(text, reply_markup=main_menu())
+            await message.answer(text, reply_markup=MAIN_MENU)
 
 
-@dp.callback_query(F.data == "back_to_menu")
+@callbacks.route("back_to_menu")
 async def back_to_menu(call: CallbackQuery):
     """Возврат в главное меню"""
     text = (
@@ -370,18 +3038,18 @@ async def back_to_menu(call: CallbackQuery):
         if is_admin(call.from_user.id):
             await call.message.edit_caption(
                 caption=text,
-                reply_markup=admin_menu()
+                reply_markup=ADMIN_MENU
             )
         else:
             await call.message.edit_caption(
                 caption=text,
-                reply_markup=main_menu()
+                reply_markup=MAIN_MENU
             )
     except:
         if is_admin(call.from_user.id):
-            await call.message.answer(text, reply_markup=admin_menu())
+            await call.message.answer(text, reply_markup=ADMIN_MENU)
         else:
-            await call.message.answer(text, reply_markup=main_menu())
+            await call.message.answer(text, reply_markup=MAIN_MENU)
     
     await call.answer()
 
@@ -390,7 +3058,7 @@ async def back_to_menu(call: CallbackQuery):
 # СПИСОК МОДОВ
 # =====================
 
-@dp.callback_query(F.data == "mods_list")
+@callbacks.route("mods_list")
 async def show_mods_list(call: CallbackQuery):
     """Показывает список категорий модов"""
     if is_banned(call.from_user.id):
@@ -409,12 +3077,12 @@ async def show_mods_list(call: CallbackQuery):
     # Показываем категории
     buttons = []
     for cat_key, cat_name in CATEGORIES.items():
-        # Подсчитываем количество модов в каждой категории
-        cat_count = len([p for p in posts.values() if p.get('category') == cat_key]) if cat_key != 'all' else len(posts)
+        # Количество модов в категории берется из индекса
+        cat_count = catalog_index.count(cat_key)
         if cat_count > 0 or cat_key == 'all':
             buttons.append([InlineKeyboardButton(
                 text=f"{cat_name} ({cat_count})",
-                callback_data=f"cat_browse_{cat_key}" if cat_key != 'all' else "all_mods"
+                callback_data=pack_callback("browse", cat_key) if cat_key != 'all' else "all_mods"
             )])
     
     buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")])
@@ -426,43 +3094,22 @@ async def show_mods_list(call: CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("cat_browse_"))
-async def browse_category(call: CallbackQuery):
+@callbacks.route("browse", args=1)
+async def browse_category(call: CallbackQuery, category: str):
     """Просмотр модов в категории"""
     if is_banned(call.from_user.id):
         return await call.answer("🚫 Вы заблокированы", show_alert=True)
     
-    category = call.data.replace("cat_browse_", "")
-    
-    # Фильтруем посты по категории
-    cat_posts = {pid: p for pid, p in posts.items() if p.get('category') == category}
     
-    if not cat_posts:
+    if not catalog_index.count(category):
         await call.answer("📂 В этой категории пока нет модов", show_alert=True)
         return
     
-    # Показываем список модов категории
-    buttons = []
-    for post_id, post_data in list(cat_posts.items())[:10]:
-        title = post_data.get('title', 'Без названия')
-        downloads = post_data.get('downloads', 0)
-        buttons.append([InlineKeyboardButton(
-            text=f"📥 {title} ({downloads}⬇️)",
-            callback_data=f"get_mod_{post_id}"
-        )])
-    
-    buttons.append([InlineKeyboardButton(text="🏠 Назад", callback_data="mods_list")])
-    
-    cat_name = CATEGORIES.get(category, "Моды")
-    await call.message.answer(
-        f"📂 <b>{cat_name}</b>\n\n"
-        f"Всего модов: {len(cat_posts)}\n\n",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
-    )
+    await show_mods_page(call.message, category)
     await call.answer()
 
 
-@dp.callback_query(F.data == "all_mods")
+@callbacks.route("all_mods")
 async def show_all_mods(call: CallbackQuery):
     """Показывает все моды"""
     if is_banned(call.from_user.id):
@@ -472,59 +3119,53 @@ async def show_all_mods(call: CallbackQuery):
         await call.answer("📂 Пока нет доступных модов", show_alert=True)
         return
     
-    await show_mods_page(call.message, 0, delete_prev=False)
+    await show_mods_page(call.message, "all")
+    await call.answer()
+
+
+@callbacks.route("page_info")
+async def page_info(call: CallbackQuery):
+    """Кнопка с номером страницы ничего не делает"""
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("page_"))
-async def page_navigation(call: CallbackQuery):
-    """Навигация по страницам модов"""
-    if call.data == "page_info":
+@callbacks.route("page", args=3)
+async def page_navigation(call: CallbackQuery, scope: str, order: str, offset: str):
+    """Навигация по страницам модов: page:<категория>:<порядок>:<смещение>"""
+    offset = unpack_int(offset)
+    if offset is None:
         return await call.answer()
-    
-    page = int(call.data.split("_")[1])
-    await show_mods_page(call.message, page, edit=True)
+    await show_mods_page(call.message, scope, order, offset, edit=True)
     await call.answer()
 
 
-async def show_mods_page(message: Message, page: int, edit: bool = False, delete_prev: bool = True):
-    """Отображает страницу со списком модов"""
-    posts_list = list(posts.items())
-    posts_per_page = 5
-    total_pages = (len(posts_list) + posts_per_page - 1) // posts_per_page
-    
-    start_idx = page * posts_per_page
-    end_idx = start_idx + posts_per_page
-    page_posts = posts_list[start_idx:end_idx]
+async def show_mods_page(message: Message, scope: str, order: str = DEFAULT_ORDER, offset: int = 0,
+                         edit: bool = False):
+    """Отображает страницу со списком модов категории (или всех модов)"""
+    total = catalog_index.count(scope)
+    offset = max(0, min(offset, (total - 1) // MODS_PER_PAGE * MODS_PER_PAGE)) if total else 0
+    page_ids = catalog_index.page(scope, order, offset, MODS_PER_PAGE)
     
-    text = f"📂 <b>Список модов</b> (Страница {page + 1}/{total_pages})\n\n"
+    cat_name = CATEGORIES.get(scope, "📂 Моды")
+    text = f"<b>{cat_name}</b>\n\nВсего модов: {total}\n\n"
     
     buttons = []
-    for post_id, post_data in page_posts:
+    for post_id in page_ids:
+        post_data = posts[post_id]
         title = post_data.get('title', 'Без названия')
         downloads = post_data.get('downloads', 0)
+        unique = unique_downloaders.post_count(post_id)
         
-        text += f"• {title} (⬇️ {downloads})\n"
+        text += f"• {title} (⬇️ {downloads} · 👤 ~{unique})\n"
         
         buttons.append([InlineKeyboardButton(
             text=f"📥 {title}",
-            callback_data=f"get_mod_{post_id}"
+            callback_data=pack_callback("mod", pack_id(post_id))
         )])
     
-    # Добавляем навигацию
-    nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"page_{page-1}"))
-    
-    nav_buttons.append(InlineKeyboardButton(text=f"{page+1}/{total_pages}", callback_data="page_info"))
-    
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"page_{page+1}"))
-    
-    if nav_buttons:
-        buttons.append(nav_buttons)
-    
-    buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")])
+    buttons.append(sort_buttons(pack_callback("page", scope), order))
+    buttons.append(mods_pagination(pack_callback("page", scope, order), offset, total, MODS_PER_PAGE))
+    buttons.append([InlineKeyboardButton(text="🏠 Назад", callback_data="mods_list")])
     
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -537,13 +3178,13 @@ async def show_mods_page(message: Message, page: int, edit: bool = False, delete
         await message.answer(text, reply_markup=kb)
 
 
-@dp.callback_query(F.data.startswith("get_mod_"))
-async def get_mod_details(call: CallbackQuery):
+@callbacks.route("mod", args=1)
+async def get_mod_details(call: CallbackQuery, packed_id: str):
     """Показывает детали мода и отправляет его"""
     if is_banned(call.from_user.id):
         return await call.answer("🚫 Вы заблокированы", show_alert=True)
     
-    post_id = call.data.replace("get_mod_", "")
+    post_id = unpack_id(packed_id)
     post = posts.get(post_id)
     
     if not post:
@@ -554,31 +3195,188 @@ async def get_mod_details(call: CallbackQuery):
     is_subscribed, missing = await check_subscription(call.from_user.id, required_channels)
     
     if not is_subscribed:
-        bot_username = (await bot.get_me()).username
         await call.message.answer(
             "⚠️ <b>Требуется подписка</b>\n\n"
             "Для скачивания этого мода подпишитесь на указанные каналы:",
-            reply_markup=subscribe_keyboard(bot_username, post_id, missing)
+            reply_markup=subscribe_keyboard(post_id, missing)
         )
         return await call.answer()
     
     # Увеличиваем счетчик скачиваний
-    post['downloads'] = post.get('downloads', 0) + 1
-    try:
-        save_posts()
-    except Exception as e:
-        logger.error(f"Ошибка сохранения счетчика скачиваний: {e}")
+    record_download(post_id, post, call.from_user.id, "catalog")
     
     # Отправляем мод
     await send_file_to_user(call.message, post)
     await call.answer("✅ Мод отправлен!")
 
 
+# =====================
+# ПОИСК
+# =====================
+
+SEARCH_RESULTS_LIMIT = 10  # Результатов в ответе на /search
+INLINE_RESULTS_LIMIT = 20  # Результатов на странице inline-выдачи
+INLINE_MAX_RESULTS = 50  # Глубина inline-выдачи (все страницы)
+INLINE_CACHE_SIZE = 1000  # Префиксов в кэше inline-выдачи
+INLINE_PREFIX_LEN = 3  # Длина префикса, по которому кэшируются кандидаты inline-выдачи
+INLINE_CACHE_TIME = 300  # Сколько секунд Telegram кэширует ответ на inline-запрос
+
+
+def search_results_kb(post_ids: list):
+    """Кнопки с найденными модами"""
+    buttons = []
+    for post_id in post_ids:
+        post = posts[post_id]
+        buttons.append([InlineKeyboardButton(
+            text=f"📥 {post.get('title', 'Без названия')} ({post.get('downloads', 0)}⬇️)",
+            callback_data=pack_callback("mod", pack_id(post_id))
+        )])
+    buttons.append([InlineKeyboardButton(text="📂 Все категории", callback_data="mods_list")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.message(Command("search"))
+async def search_command(message: Message, command: CommandObject):
+    """Поиск модов: /search <запрос>"""
+    if message.chat.type != "private":
+        return
+    if is_banned(message.from_user.id):
+        return await message.answer("🚫 Вы заблокированы")
+    
+    query = (command.args or "").strip()
+    if not query:
+        return await message.answer(
+            "🔎 <b>Поиск модов</b>\n\n"
+            "Напишите запрос после команды, например:\n"
+            "<code>/search ганпак</code>\n\n"
+            f"💡 Или в любом чате: <code>@{bot_context.username} запрос</code>"
+        )
+    
+    found = [post_id for post_id in search_index.search(query, SEARCH_RESULTS_LIMIT) if post_id in posts]
+    if not found:
+        return await message.answer(f"🔎 По запросу «{html.escape(query)}» ничего не найдено")
+    
+    await message.answer(
+        f"🔎 <b>Найдено по запросу «{html.escape(query)}»:</b>",
+        reply_markup=search_results_kb(found)
+    )
+
+
+class InlineResultCache:
+    """LRU-кэш кандидатов inline-выдачи по нормализованному префиксу запроса"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # {prefix: ({post_id}, expires_at)}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(SearchIndex.tokenize(text))
+
+    def get(self, prefix: str):
+        entry = self._data.get(prefix)
+        if entry is None:
+            self.misses += 1
+            return None
+        results, expires_at = entry
+        if expires_at < time.monotonic():
+            # Счётчики скачиваний и порядок «популярных» устаревают без правок каталога
+            del self._data[prefix]
+            self.misses += 1
+            return None
+        self._data.move_to_end(prefix)
+        self.hits += 1
+        return results
+
+    def set(self, prefix: str, candidates: set):
+        self._data[prefix] = (candidates, time.monotonic() + self.ttl)
+        self._data.move_to_end(prefix)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        # Вызывается при любом изменении каталога: выдача могла поменяться
+        self._data.clear()
+
+
+inline_cache = InlineResultCache(INLINE_CACHE_SIZE, INLINE_CACHE_TIME)
+
+
+def inline_result(post_id: str, post: dict):
+    """Карточка мода для inline-выдачи из сохранённого file_id"""
+    title = post.get('title', 'Без названия')
+    caption = post_caption(post_id, post)
+    description = f"{CATEGORIES.get(post.get('category'), '📦')} · ⬇️ {post.get('downloads', 0)}"
+    kb = download_keyboard(post_id)
+    media_id = post.get("media")
+    media_type = post.get("media_type", "photo")
+    
+    if not media_id:
+        return InlineQueryResultArticle(
+            id=post_id, title=title, description=description,
+            input_message_content=InputTextMessageContent(message_text=caption),
+            reply_markup=kb
+        )
+    if media_type == "video":
+        return InlineQueryResultCachedVideo(
+            id=post_id, video_file_id=media_id, title=title, description=description,
+            caption=caption, reply_markup=kb
+        )
+    elif media_type == "animation":
+        return InlineQueryResultCachedMpeg4Gif(
+            id=post_id, mpeg4_file_id=media_id, title=title,
+            caption=caption, reply_markup=kb
+        )
+    else:  # photo
+        return InlineQueryResultCachedPhoto(
+            id=post_id, photo_file_id=media_id, title=title, description=description,
+            caption=caption, reply_markup=kb
+        )
+
+
+def inline_results(query: str) -> list:
+    """Id постов inline-выдачи: кандидаты ищутся один раз на префикс и сужаются по мере ввода"""
+    if not query:
+        # Пустой запрос — самые популярные моды
+        found = catalog_index.page("all", "top", 0, INLINE_MAX_RESULTS)
+        return [post_id for post_id in found if post_id in posts]
+    
+    prefix = query[:INLINE_PREFIX_LEN]
+    candidates = inline_cache.get(prefix)
+    if candidates is None:
+        candidates = set(search_index.search(prefix, limit=None))
+        inline_cache.set(prefix, candidates)
+    found = search_index.search(query, INLINE_MAX_RESULTS, among=candidates)
+    if not found and query != prefix:
+        # Опечатка в первых буквах: нечеткие совпадения могли не попасть в кандидаты префикса
+        found = search_index.search(query, INLINE_MAX_RESULTS)
+    return [post_id for post_id in found if post_id in posts]
+
+
+@dp.inline_query()
+async def inline_search(query: InlineQuery):
+    """Inline-режим: @бот запрос — карточки модов в любом чате"""
+    if is_banned(query.from_user.id):
+        return await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+    
+    found = inline_results(InlineResultCache.normalize(query.query))
+    
+    # Листание выдачи: offset — позиция следующей страницы
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    page = [inline_result(post_id, posts[post_id]) for post_id in found[offset:offset + INLINE_RESULTS_LIMIT]]
+    next_offset = str(offset + INLINE_RESULTS_LIMIT) if offset + INLINE_RESULTS_LIMIT < len(found) else ""
+    
+    await query.answer(page, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
+
 # =====================
 # АДМИН: Добавление поста
 # =====================
 
-@dp.callback_query(F.data == "add_post")
+@callbacks.route("add_post", with_state=True)
 async def add_post_start(call: CallbackQuery, state: FSMContext):
     """Начало процесса добавления поста"""
     if not is_admin(call.from_user.id):
@@ -590,7 +3388,7 @@ async def add_post_start(call: CallbackQuery, state: FSMContext):
         await call.message.delete()
     except:
         pass
-    await call.message.answer("📸 Отправьте фото, видео или гифку для поста", reply_markup=cancel_inline_kb())
+    await call.message.answer("📸 Отправьте фото, видео или гифку для поста", reply_markup=CANCEL_INLINE_KB)
     await call.answer()
 
 
@@ -606,28 +3404,22 @@ async def process_media_photo(message: Message, state: FSMContext):
         
         if post_id not in posts:
             await state.clear()
-            return await message.answer("❌ Мод не найден", reply_markup=admin_menu())
+            return await message.answer("❌ Мод не найден", reply_markup=ADMIN_MENU)
         
         # Обновляем медиа в посте
         posts[post_id]['media'] = photo_id
         posts[post_id]['media_type'] = 'photo'
         
-        # Синхронизируем с каналами
-        await sync_mod_to_channels(post_id, posts[post_id])
-        
-        # Сохраняем
-        try:
-            save_posts()
-        except Exception:
-            pass
+        # Сохраняем и синхронизируем с каналами
+        channel_results = await commit_post_edit(post_id)
         
         await state.clear()
-        await message.answer("✅ <b>Фото обновлено!</b>", reply_markup=admin_menu())
+        await message.answer(f"✅ <b>Фото обновлено!</b>{format_channel_results(channel_results)}", reply_markup=ADMIN_MENU)
     else:
         # Режим создания нового поста
         await state.update_data(media=photo_id, media_type="photo")
         await state.set_state(AddPost.title)
-        await message.answer("📝 Введите название поста:", reply_markup=cancel_inline_kb())
+        await message.answer("📝 Введите название поста:", reply_markup=CANCEL_INLINE_KB)
 
 
 @dp.message(AddPost.media, F.video)
@@ -642,28 +3434,22 @@ async def process_media_video(message: Message, state: FSMContext):
         
         if post_id not in posts:
             await state.clear()
-            return await message.answer("❌ Мод не найден", reply_markup=admin_menu())
+            return await message.answer("❌ Мод не найден", reply_markup=ADMIN_MENU)
         
         # Обновляем медиа в посте
         posts[post_id]['media'] = video_id
         posts[post_id]['media_type'] = 'video'
         
-        # Синхронизируем с каналами
-        await sync_mod_to_channels(post_id, posts[post_id])
-        
-        # Сохраняем
-        try:
-            save_posts()
-        except Exception:
-            pass
+        # Сохраняем и синхронизируем с каналами
+        channel_results = await commit_post_edit(post_id)
         
         await state.clear()
-        await message.answer("✅ <b>Видео обновлено!</b>", reply_markup=admin_menu())
+        await message.answer(f"✅ <b>Видео обновлено!</b>{format_channel_results(channel_results)}", reply_markup=ADMIN_MENU)
     else:
         # Режим создания нового поста
         await state.update_data(media=video_id, media_type="video")
         await state.set_state(AddPost.title)
-        await message.answer("📝 Введите название поста:", reply_markup=cancel_inline_kb())
+        await message.answer("📝 Введите название поста:", reply_markup=CANCEL_INLINE_KB)
 
 
 @dp.message(AddPost.media, F.animation)
@@ -678,28 +3464,22 @@ async def process_media_animation(message: Message, state: FSMContext):
         
         if post_id not in posts:
             await state.clear()
-            return await message.answer("❌ Мод не найден", reply_markup=admin_menu())
+            return await message.answer("❌ Мод не найден", reply_markup=ADMIN_MENU)
         
         # Обновляем медиа в посте
         posts[post_id]['media'] = animation_id
         posts[post_id]['media_type'] = 'animation'
         
-        # Синхронизируем с каналами
-        await sync_mod_to_channels(post_id, posts[post_id])
-        
-        # Сохраняем
-        try:
-            save_posts()
-        except Exception:
-            pass
+        # Сохраняем и синхронизируем с каналами
+        channel_results = await commit_post_edit(post_id)
         
         await state.clear()
-        await message.answer("✅ <b>Гифка обновлена!</b>", reply_markup=admin_menu())
+        await message.answer(f"✅ <b>Гифка обновлена!</b>{format_channel_results(channel_results)}", reply_markup=ADMIN_MENU)
     else:
         # Режим создания нового поста
         await state.update_data(media=animation_id, media_type="animation")
         await state.set_state(AddPost.title)
-        await message.answer("📝 Введите название поста:", reply_markup=cancel_inline_kb())
+        await message.answer("📝 Введите название поста:", reply_markup=CANCEL_INLINE_KB)
 
 
 @dp.message(AddPost.media)
@@ -714,13 +3494,17 @@ async def process_title(message: Message, state: FSMContext):
     if len(message.text) > 200:
         return await message.answer("❌ Название слишком длинное (макс. 200 символов)")
     
+    # Правка названия существующего мода идет через то же состояние
+    if (await state.get_data()).get('edit_post_id'):
+        return await process_edit_title(message, state)
+    
     await state.update_data(title=message.text)
     await state.set_state(AddPost.file)
     
     await message.answer(
         "📦 Отправьте файл (документ) или ссылку для скачивания:\n\n"
         "💡 Совет: Для ссылок используйте прямые ссылки на файлы"
-        , reply_markup=cancel_inline_kb()
+        , reply_markup=CANCEL_INLINE_KB
     )
 
 
@@ -729,25 +3513,30 @@ async def process_file(message: Message, state: FSMContext):
     """Обработка файла или ссылки"""
     data = await state.get_data()
     
-    # Сохраняем файл или ссылку
+    # Правка файла существующего мода идет через то же состояние
+    if data.get('edit_post_id'):
+        return await process_edit_file(message, state)
+    
+    # Сохраняем файл или ссылку (в FSM пишем только новые поля)
     if message.document:
-        data["file"] = message.document.file_id
-        data["file_name"] = message.document.file_name
-        data["file_size"] = message.document.file_size
+        await state.update_data(
+            file=message.document.file_id,
+            file_name=message.document.file_name,
+            file_size=message.document.file_size
+        )
     elif message.text:
         if not message.text.startswith(("http://", "https://")):
             return await message.answer("❌ Ссылка должна начинаться с http:// или https://")
-        data["link"] = message.text
+        await state.update_data(link=message.text)
     else:
         return await message.answer("❌ Отправьте документ или текстовую ссылку!")
     
-    await state.update_data(**data)
     await state.set_state(AddPost.category)
     
     # Показываем выбор категории
     buttons = []
     for cat_key, cat_name in list(CATEGORIES.items())[:-1]:  # Все кроме "все"
-        buttons.append([InlineKeyboardButton(text=cat_name, callback_data=f"cat_{cat_key}")])
+        buttons.append([InlineKeyboardButton(text=cat_name, callback_data=pack_callback("post_cat", cat_key))])
     
     buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_post")])
     
@@ -757,11 +3546,9 @@ async def process_file(message: Message, state: FSMContext):
     )
 
 
-@dp.callback_query(F.data.startswith("cat_"), AddPost.category)
-async def process_category(call: CallbackQuery, state: FSMContext):
+@callbacks.route("post_cat", AddPost.category, args=1, with_state=True)
+async def process_category(call: CallbackQuery, state: FSMContext, category: str):
     """Обработка выбора категории"""
-    category = call.data.replace("cat_", "")
-    
     if category not in CATEGORIES:
         return await call.answer("❌ Неверная категория", show_alert=True)
     
@@ -820,35 +3607,37 @@ async def process_channels(message: Message, state: FSMContext):
     await message.answer(
         f"✅ <b>Выбранные каналы:</b>\n{', '.join(selected_channels)}\n\n"
         "📬 <b>Уведомить всех пользователей о новом посте?</b>",
-        reply_markup=notify_menu()
+        reply_markup=NOTIFY_MENU
     )
 
 
-@dp.callback_query(F.data.startswith("channel_"), AddPost.channels)
-async def toggle_channel(call: CallbackQuery, state: FSMContext):
+@callbacks.route("channel", AddPost.channels, args=1, with_state=True)
+async def toggle_channel(call: CallbackQuery, state: FSMContext, channel: str):
     """Обработчик отключен - используется текстовый ввод"""
     await call.answer("Используйте текстовый ввод для выбора каналов", show_alert=True)
 
 
-@dp.callback_query(F.data == "channels_done", AddPost.channels)
+@callbacks.route("channels_done", AddPost.channels, with_state=True)
 async def channels_done(call: CallbackQuery, state: FSMContext):
     """Обработчик отключен - используется текстовый ввод"""
     await call.answer("Используйте текстовый ввод для выбора каналов", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith("notify_"), AddPost.notify)
-async def process_notify(call: CallbackQuery, state: FSMContext):
+@callbacks.route("notify", AddPost.notify, args=1, with_state=True)
+async def process_notify(call: CallbackQuery, state: FSMContext, answer: str):
     """Обработка выбора уведомлений"""
-    notify = call.data == "notify_yes"
-    await state.update_data(notify_users=notify)
+    notify = answer == "yes"
+    # Проверяем наличие медиа до выдачи номера и создания черновика
+    if "media" not in await state.get_data():
+        await call.answer("❌ Медиа не найдено! Начните создание поста с начала.", show_alert=True)
+        await state.clear()
+        return
     
-    data = await state.get_data()
-    post_id = str(uuid.uuid4())
-    data["post_id"] = post_id
-    data["downloads"] = 0
+    post_id = await storage.next_post_id()
+    # Одна запись в FSM: дописываем только новые поля, update_data вернет данные целиком
+    data = await state.update_data(notify_users=notify, post_id=post_id, downloads=0, created_at=time.time())
     # Сохраняем как черновик (не публикуем до подтверждения)
-    drafts[post_id] = data
-    await state.update_data(**data)
+    await drafts.add(post_id, data)
     
     try:
         await call.message.delete()
@@ -856,23 +3645,12 @@ async def process_notify(call: CallbackQuery, state: FSMContext):
         pass
     
     # Показываем превью
-    bot_username = (await bot.get_me()).username
-    preview_kb = download_keyboard(bot_username, post_id)
-    
-    caption = f"🔥 <b>{data['title']}</b>\n\n📥 Нажмите кнопку для скачивания"
+    preview_kb = download_keyboard(post_id)
     
-    if "file" in data:
-        file_size_mb = data['file_size'] / (1024 * 1024)
-        caption += f"\n\n📦 Файл: {data['file_name']}\n💾 Размер: {file_size_mb:.2f} МБ"
+    caption = post_caption(post_id, data, "file")
     
     selected_channels = data.get('selected_channels', [])
     
-    # Проверяем наличие медиа
-    if "media" not in data:
-        await call.answer("❌ Медиа не найдено! Начните создание поста с начала.", show_alert=True)
-        await state.clear()
-        return
-    
     # Отправляем медиа в зависимости от типа
     media_id = data.get("media")
     media_type = data.get("media_type", "photo")
@@ -897,16 +3675,20 @@ async def process_notify(call: CallbackQuery, state: FSMContext):
         f"📢 Каналы: {', '.join(selected_channels)}\n"
         f"📬 Уведомления: {notify_text}\n\n"
         "Проверьте все данные и выберите действие:",
-        reply_markup=confirm_menu()
+        reply_markup=CONFIRM_MENU
     )
     preview_message_ids.append((preview_text_msg.chat.id, preview_text_msg.message_id))
 
     # Сохраняем ID превью в черновике (чтобы удалить при отмене или публикации)
-    drafts[post_id]['preview_messages'] = preview_message_ids
+    data['preview_messages'] = preview_message_ids
+    try:
+        await storage.save_draft(post_id, data)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения черновика {post_id}: {e}")
     await call.answer()
 
 
-@dp.callback_query(F.data == "confirm_post")
+@callbacks.route("confirm_post", with_state=True)
 async def confirm_publication(call: CallbackQuery, state: FSMContext):
     """Публикация поста в каналы"""
     if not is_admin(call.from_user.id):
@@ -916,78 +3698,79 @@ async def confirm_publication(call: CallbackQuery, state: FSMContext):
     post_id = data.get("post_id")
 
     # Получаем черновик (если есть). Если черновика нет — пытаемся взять из опубликованных.
-    draft = drafts.pop(post_id, None)
+    draft = drafts.pop(post_id)
+    if draft is None and post_id not in posts:
+        # Черновик удален по сроку или вытеснен более новыми — публиковать нечего
+        await call.answer("⌛ Черновик устарел, создайте пост заново", show_alert=True)
+        await state.clear()
+        return
     if draft is not None:
         data = draft
+        try:
+            await storage.delete_draft(post_id)
+        except Exception as e:
+            logger.error(f"Ошибка удаления черновика {post_id}: {e}")
     else:
         data = posts.get(post_id, data)
     
-    bot_username = (await bot.get_me()).username
-    kb = download_keyboard(bot_username, post_id)
+    kb = download_keyboard(post_id)
     
-    caption = f"🔥 <b>{data['title']}</b>\n\n📥 Нажмите кнопку для скачивания"
+    caption = post_caption(post_id, data)
     
     selected_channels = data.get('selected_channels', [])
-    published_count = 0
     
     # Инициализируем словарь для хранения message_id в каналах
     if 'published' not in data:
         data['published'] = {}
     
-    # Публикуем в выбранные каналы
-    for channel_name in selected_channels:
-        # Если это ключ из CHANNELS, берем значение, иначе используем как есть
-        if channel_name in CHANNELS:
-            channel_id = CHANNELS[channel_name]
-        else:
-            channel_id = channel_name if channel_name.startswith("@") else "@" + channel_name
-        
-        try:
-            media_id = data.get("media")
-            media_type = data.get("media_type", "photo")
-            
-            msg = None
-            if media_type == "video":
-                msg = await bot.send_video(channel_id, video=media_id, caption=caption, reply_markup=kb)
-            elif media_type == "animation":
-                msg = await bot.send_animation(channel_id, animation=media_id, caption=caption, reply_markup=kb)
-            else:  # photo
-                msg = await bot.send_photo(channel_id, photo=media_id, caption=caption, reply_markup=kb)
-            
+    media_id = data.get("media")
+    media_type = data.get("media_type", "photo")
+    
+    async def publish(channel_id):
+        if media_type == "video":
+            return await bot.send_video(channel_id, video=media_id, caption=caption, reply_markup=kb)
+        elif media_type == "animation":
+            return await bot.send_animation(channel_id, animation=media_id, caption=caption, reply_markup=kb)
+        else:  # photo
+            return await bot.send_photo(channel_id, photo=media_id, caption=caption, reply_markup=kb)
+    
+    # Публикуем во все выбранные каналы параллельно
+    channel_ids = list(dict.fromkeys(resolve_channel_id(name) for name in selected_channels))
+    channel_results = await run_for_channels(channel_ids, publish)
+    
+    published_count = 0
+    for channel_id, (ok, result) in channel_results.items():
+        if ok:
             # Сохраняем message_id для возможного редактирования
-            if msg:
-                data['published'][channel_id] = msg.message_id
-            
+            data['published'][channel_id] = result.message_id
             published_count += 1
-        except Exception as e:
-            logger.error(f"Ошибка публикации в {channel_id}: {e}")
+        else:
+            logger.error(f"Ошибка публикации в {channel_id}: {result}")
     
-    # Уведомляем пользователей если нужно
-    if data.get('notify_users', False):
-        notified = await notify_all_users(data, post_id)
-        await call.message.answer(
-            f"✅ <b>Пост опубликован!</b>\n\n"
-            f"📢 Опубликовано в каналов: {published_count}\n"
-            f"📬 Уведомлено пользователей: {notified}\n"
-            f"📊 ID поста: <code>{post_id}</code>",
-            reply_markup=admin_menu()
-        )
-    else:
-        await call.message.answer(
-            f"✅ <b>Пост опубликован!</b>\n\n"
-            f"📢 Опубликовано в каналов: {published_count}\n"
-            f"📊 ID поста: <code>{post_id}</code>",
-            reply_markup=admin_menu()
-        )
+    notify = data.get('notify_users', False)
+    notify_text = "📬 Рассылка запущена, прогресс — в следующем сообщении\n" if notify else ""
+    await call.message.answer(
+        f"✅ <b>Пост опубликован!</b>\n\n"
+        f"📢 Опубликовано в каналов: {published_count} из {len(channel_ids)}\n"
+        f"{notify_text}"
+        f"📊 ID поста: <code>{post_id}</code>"
+        f"{format_channel_results(channel_results)}",
+        reply_markup=ADMIN_MENU
+    )
     
     await state.clear()
     # Если был черновик — переносим в опубликованные и сохраняем
     if post_id not in posts and draft is not None:
         posts[post_id] = data
+        index_post(post_id)
         try:
-            save_posts()
-        except Exception:
-            pass
+            await storage.save_post(post_id, data)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения поста {post_id}: {e}")
+
+    # Рассылка идет в фоне отдельным заданием, которое переживает перезапуск
+    if notify:
+        await notify_all_users(data, post_id, report_chat_id=call.message.chat.id)
 
     # Удаляем превью-сообщения, если остались (берём из черновика или из поста)
     preview_msgs = []
@@ -1004,52 +3787,516 @@ async def confirm_publication(call: CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-async def notify_all_users(post_data, post_id):
-    """Уведомляет всех пользователей о новом посте"""
-    bot_username = (await bot.get_me()).username
-    kb = download_keyboard(bot_username, post_id)
-    
-    caption = f"🆕 <b>Новый мод!</b>\n\n🔥 {post_data['title']}\n\n📥 Нажмите кнопку для скачивания"
-    
-    notified = 0
-    for user_id in users:
-        if not is_admin(user_id) and not is_banned(user_id):
+# =====================
+# РАССЫЛКА
+# =====================
+
+BROADCAST_RATE = 25  # Сообщений в секунду на весь бот (лимит Telegram ~30/с)
+BROADCAST_WORKERS = 8  # Одновременных отправителей
+BROADCAST_MAX_RETRIES = 3  # Повторов после RetryAfter
+BROADCAST_PROGRESS_INTERVAL = 5  # Как часто обновлять прогресс у админа (сек)
+BROADCAST_CHECKPOINT_INTERVAL = 5  # Как часто сохранять курсор рассылки (сек)
+CHAT_MIN_INTERVAL = 1.0  # Не чаще одного сообщения в секунду в один чат
+# Callback-действия управления рассылками: при BOT_WORKERS > 1 их получает процесс 0,
+# который один выполняет все рассылки (и держит общий лимит отправки)
+BROADCAST_ACTIONS = ("broadcasts", "bc")
+
+
+class RateLimiter:
+    """Token bucket на весь бот + минимальный интервал между сообщениями в один чат"""
+
+    def __init__(self, rate: float, capacity: float = None, chat_interval: float = CHAT_MIN_INTERVAL,
+                 max_chats: int = 10000):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.chat_interval = chat_interval
+        self.max_chats = max_chats
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next = OrderedDict()  # {chat_id: когда можно писать снова}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Глобальная пауза после ответа RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _wait_chat(self, chat_id):
+        now = time.monotonic()
+        wait = max(0.0, self._chat_next.get(chat_id, 0.0) - now)
+        # Слот резервируется до сна, чтобы параллельные отправки в тот же чат встали в очередь
+        self._chat_next[chat_id] = now + wait + self.chat_interval
+        self._chat_next.move_to_end(chat_id)
+        while len(self._chat_next) > self.max_chats:
+            self._chat_next.popitem(last=False)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def acquire(self, chat_id=None):
+        """Ждет разрешения на отправку одного сообщения"""
+        if chat_id is not None:
+            await self._wait_chat(chat_id)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Лимит на весь бот: рассылки идут только в одном процессе (см. owns_broadcasts)
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+_background_tasks = set()
+
+
+def spawn_background(coro):
+    """Запускает фоновую задачу и держит на нее ссылку до завершения"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+BROADCAST_STATUSES = {
+    "running": "▶️ идет",
+    "paused": "⏸ на паузе",
+    "cancelled": "⛔ отменена",
+    "done": "✅ завершена",
+    "failed": "❌ прервана из-за ошибки",
+}
+
+
+class Broadcast:
+    """Задание рассылки поста: пул воркеров с учетом лимитов Telegram и курсором по пользователям"""
+
+    def __init__(self, job_id: int, post_id: str, post_data: dict, chat_id: int = None,
+                 status: str = "running", cursor: int = 0, delivered: int = 0, failed: int = 0, blocked: int = 0,
+                 staging_chat_id: int = None, staging_message_id: int = None):
+        self.job_id = job_id
+        self.post_id = post_id
+        self.post_data = post_data
+        self.chat_id = chat_id  # Куда отчитываться о прогрессе
+        self.status = status
+        # Курсор: все пользователи с id <= cursor уже обработаны
+        self.cursor = cursor
+        self.delivered = delivered
+        self.failed = failed
+        self.blocked = blocked
+        # Сообщение-образец, которое копируется каждому получателю
+        self.staging_chat_id = staging_chat_id
+        self.staging_message_id = staging_message_id
+        self.total = 0
+        self.finished = False
+        self._kb = None
+        self._caption = None
+        self._in_flight = OrderedDict()  # {user_id: обработан ли} в порядке выдачи
+        self._stage_lock = asyncio.Lock()
+        self._restaged = False
+        self._resumed = asyncio.Event()
+        if status != "paused":
+            self._resumed.set()
+        self._task = None
+
+    @classmethod
+    def from_record(cls, record: dict, post_data: dict):
+        return cls(
+            record['id'], record['post_id'], post_data, record.get('chat_id'),
+            status=record['status'], cursor=record['cursor'],
+            delivered=record['delivered'], failed=record['failed'], blocked=record['blocked'],
+            staging_chat_id=record.get('staging_chat_id'), staging_message_id=record.get('staging_message_id')
+        )
+
+    def to_record(self) -> dict:
+        return {
+            'id': self.job_id,
+            'post_id': self.post_id,
+            'chat_id': self.chat_id,
+            'status': self.status,
+            'cursor': self.cursor,
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'staging_chat_id': self.staging_chat_id,
+            'staging_message_id': self.staging_message_id,
+        }
+
+    async def save(self):
+        """Сохраняет состояние задания (курсор и счетчики) в хранилище"""
+        try:
+            await storage.save_broadcast(self.to_record())
+        except Exception as e:
+            logger.error(f"Не удалось сохранить рассылку #{self.job_id}: {e}")
+
+    def pause(self):
+        if self.status == "running":
+            self.status = "paused"
+            self._resumed.clear()
+
+    def resume(self):
+        if self.status == "paused":
+            self.status = "running"
+            self._resumed.set()
+
+    def cancel(self):
+        if self.status in ("running", "paused"):
+            self.status = "cancelled"
+            # Будим воркеров, стоящих на паузе, чтобы они разобрали очередь
+            self._resumed.set()
+
+    async def _send_media(self, chat_id: int):
+        """Полная отправка поста: медиа + подпись + клавиатура"""
+        media_id = self.post_data.get("media")
+        media_type = self.post_data.get("media_type", "photo")
+
+        if media_type == "video":
+            return await bot.send_video(chat_id, video=media_id, caption=self._caption, reply_markup=self._kb)
+        elif media_type == "animation":
+            return await bot.send_animation(chat_id, animation=media_id, caption=self._caption, reply_markup=self._kb)
+        else:  # photo
+            return await bot.send_photo(chat_id, photo=media_id, caption=self._caption, reply_markup=self._kb)
+
+    async def _stage(self):
+        """Один раз отправляет пост в staging-чат; дальше получателям уходит copy_message"""
+        if self.staging_message_id is not None:
+            return
+        chat_id = BROADCAST_STAGING_CHAT_ID
+        if chat_id is None:
+            return
+        try:
+            msg = await self._send_media(chat_id)
+        except Exception as e:
+            logger.error(f"Не удалось подготовить образец рассылки #{self.job_id}: {e}")
+            return
+        self.staging_chat_id = chat_id
+        self.staging_message_id = msg.message_id
+        await self.save()
+
+    async def _restage(self, lost_message_id: int):
+        """Образец удалили из staging-чата: готовим новый один раз, потом шлем медиа каждому"""
+        async with self._stage_lock:
+            if self.staging_message_id != lost_message_id:
+                # Другой воркер уже заменил образец
+                return
+            logger.warning(f"Образец рассылки #{self.job_id} не найден")
+            self.staging_chat_id = None
+            self.staging_message_id = None
+            if not self._restaged:
+                self._restaged = True
+                await self._stage()
+            if self.staging_message_id is None:
+                await self.save()
+
+    async def _send(self, user_id: int):
+        staged = self.staging_message_id
+        if staged is None:
+            # Без образца — прежний путь с отправкой медиа каждому
+            await self._send_media(user_id)
+            return
+        # Подпись уже в образце, запрос содержит только ссылку на сообщение и готовую клавиатуру
+        try:
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=self.staging_chat_id,
+                message_id=staged,
+                reply_markup=self._kb
+            )
+        except TelegramBadRequest as e:
+            if "message to copy not found" not in str(e).lower():
+                raise
+            await self._restage(staged)
+            await self._send(user_id)
+
+    async def _deliver(self, user_id: int):
+        """Отправка одному пользователю с повтором после RetryAfter"""
+        for _ in range(BROADCAST_MAX_RETRIES + 1):
+            await broadcast_limiter.acquire(user_id)
             try:
-                media_id = post_data.get("media")
-                media_type = post_data.get("media_type", "photo")
-
-                if media_type == "video":
-                    await bot.send_video(user_id, video=media_id, caption=caption, reply_markup=kb)
-                elif media_type == "animation":
-                    await bot.send_animation(user_id, animation=media_id, caption=caption, reply_markup=kb)
-                else:  # photo
-                    await bot.send_photo(user_id, photo=media_id, caption=caption, reply_markup=kb)
-
-                notified += 1
-                await asyncio.sleep(0.05)  # Защита от флуда
+                await self._send(user_id)
+                self.delivered += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Флуд-лимит при рассылке, пауза {e.retry_after} с")
+                broadcast_limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота — больше ему не пишем
+                self.blocked += 1
+                try:
+                    await storage.remove_user(user_id)
+                except Exception as e:
+                    logger.error(f"Не удалось удалить пользователя {user_id}: {e}")
+                return
             except Exception as e:
                 logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
-    
-    return notified
+                self.failed += 1
+                return
+        self.failed += 1
+
+    def _mark_done(self, user_id: int):
+        """Сдвигает курсор по непрерывному префиксу обработанных пользователей"""
+        self._in_flight[user_id] = True
+        while self._in_flight:
+            first_id, done = next(iter(self._in_flight.items()))
+            if not done:
+                break
+            self._in_flight.popitem(last=False)
+            self.cursor = first_id
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            await self._resumed.wait()
+            if self.status != "cancelled":
+                await self._deliver(user_id)
+            self._mark_done(user_id)
+
+    async def _produce(self, queue: asyncio.Queue):
+        # Пользователи читаются из хранилища пачками после курсора, очередь ограничена
+        async for batch in storage.iter_users(after_id=self.cursor):
+            for user_id in batch:
+                await self._resumed.wait()
+                if self.status == "cancelled":
+                    return
+                if is_admin(user_id) or is_banned(user_id):
+                    continue
+                self._in_flight[user_id] = False
+                await queue.put(user_id)
+
+    async def _checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            await self.save()
+
+    async def run(self):
+        queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 4)
+        workers = []
+        checkpointer = None
+        try:
+            self._kb = download_keyboard(self.post_id)
+            self._caption = post_caption(self.post_id, self.post_data, "announce")
+            self.total = await storage.count_users()
+            await self._stage()
+
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_WORKERS)]
+            checkpointer = asyncio.create_task(self._checkpoint_loop())
+            await self._produce(queue)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            # Бот останавливается: задание продолжится с курсора после перезапуска
+            await self.save()
+            raise
+        except Exception:
+            # Иначе запись осталась бы running и задание молча перезапускалось бы при каждом старте
+            self.status = "failed"
+            self.finished = True
+            await self.save()
+            raise
+        finally:
+            if checkpointer is not None:
+                checkpointer.cancel()
+            for worker in workers:
+                worker.cancel()
+        if self.status != "cancelled":
+            self.status = "done"
+        self.finished = True
+        await self.save()
+
+    def status_text(self) -> str:
+        done = self.delivered + self.failed + self.blocked
+        return (
+            f"📬 <b>Рассылка #{self.job_id}</b>: {BROADCAST_STATUSES.get(self.status, self.status)}\n\n"
+            f"📊 Обработано: {done} из ~{self.total}\n"
+            f"✅ Доставлено: {self.delivered}\n"
+            f"❌ Ошибок: {self.failed}\n"
+            f"🚫 Заблокировали бота: {self.blocked}"
+        )
+
+
+def broadcast_controls(broadcast: Broadcast):
+    """Кнопки управления рассылкой"""
+    if broadcast.finished or broadcast.status not in ("running", "paused"):
+        return None
+    if broadcast.status == "running":
+        toggle = InlineKeyboardButton(text="⏸ Пауза", callback_data=pack_callback("bc", "pause", broadcast.job_id))
+    else:
+        toggle = InlineKeyboardButton(text="▶️ Продолжить", callback_data=pack_callback("bc", "resume", broadcast.job_id))
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text="⛔ Отменить", callback_data=pack_callback("bc", "cancel", broadcast.job_id))]
+    ])
+
+
+active_broadcasts = {}  # {job_id: Broadcast}
+
+
+async def report_broadcast_progress(broadcast: Broadcast):
+    """Периодически обновляет у админа сообщение с прогрессом рассылки"""
+    last_text = broadcast.status_text()
+    try:
+        status_msg = await bot.send_message(broadcast.chat_id, last_text, reply_markup=broadcast_controls(broadcast))
+    except Exception as e:
+        logger.error(f"Не удалось отправить прогресс рассылки: {e}")
+        return
+    while True:
+        text = broadcast.status_text()
+        if text != last_text:
+            try:
+                await bot.edit_message_text(
+                    text,
+                    chat_id=broadcast.chat_id,
+                    message_id=status_msg.message_id,
+                    reply_markup=broadcast_controls(broadcast)
+                )
+                last_text = text
+            except Exception:
+                pass
+        if broadcast.finished:
+            return
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+
+
+async def run_broadcast(broadcast: Broadcast):
+    """Выполняет задание рассылки вместе с отчетом о прогрессе"""
+    reporter = None
+    if broadcast.chat_id is not None:
+        reporter = asyncio.create_task(report_broadcast_progress(broadcast))
+    try:
+        await broadcast.run()
+        logger.info(f"Рассылка #{broadcast.job_id}: доставлено {broadcast.delivered}, ошибок {broadcast.failed}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка рассылки #{broadcast.job_id}: {e}")
+        if broadcast.chat_id is not None:
+            try:
+                await bot.send_message(
+                    broadcast.chat_id,
+                    f"❌ <b>Рассылка #{broadcast.job_id} прервана</b>\n\n"
+                    f"Ошибка: {html.escape(str(e))}\n"
+                    f"Доставлено до остановки: {broadcast.delivered}"
+                )
+            except Exception as send_error:
+                logger.error(f"Не удалось сообщить об ошибке рассылки: {send_error}")
+    finally:
+        active_broadcasts.pop(broadcast.job_id, None)
+        if reporter is not None:
+            if broadcast.finished:
+                await reporter
+            else:
+                reporter.cancel()
+
+
+def owns_broadcasts() -> bool:
+    """Выполняет ли этот процесс рассылки (единственный процесс или процесс 0)"""
+    return worker_index in (None, 0)
+
+
+def launch_broadcast(broadcast: Broadcast):
+    """Регистрирует задание и запускает его в фоне"""
+    active_broadcasts[broadcast.job_id] = broadcast
+    broadcast._task = spawn_background(run_broadcast(broadcast))
+
+
+async def notify_all_users(post_data, post_id, report_chat_id: int = None):
+    """Уведомляет всех пользователей о новом посте (создает задание рассылки)"""
+    job_id = await storage.create_broadcast(post_id, report_chat_id)
+    if not owns_broadcasts():
+        # Задание из хранилища подхватит процесс 0 (см. sync_shared_state)
+        logger.info(f"Рассылка #{job_id} передана процессу 0")
+        return None
+    broadcast = Broadcast(job_id, post_id, post_data, report_chat_id)
+    launch_broadcast(broadcast)
+    return broadcast
+
+
+async def resume_broadcasts(startup: bool = True):
+    """Запускает незавершенные рассылки из хранилища: после перезапуска и созданные другими процессами"""
+    for record in await storage.load_active_broadcasts():
+        if record['id'] in active_broadcasts:
+            continue
+        post = posts.get(record['post_id'])
+        if post is None:
+            if not startup:
+                # Пост мог еще не дойти до этого процесса — попробуем при следующей синхронизации
+                continue
+            # Пост удален — продолжать нечего
+            record['status'] = "cancelled"
+            await storage.save_broadcast(record)
+            continue
+        broadcast = Broadcast.from_record(record, post)
+        launch_broadcast(broadcast)
+        if startup:
+            logger.info(f"Рассылка #{broadcast.job_id} продолжена с пользователя {broadcast.cursor}")
+        else:
+            logger.info(f"Рассылка #{broadcast.job_id} принята от другого процесса")
+
+
+async def stop_broadcasts():
+    """Останавливает рассылки при выключении, сохраняя курсор"""
+    tasks = [b._task for b in active_broadcasts.values() if b._task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@callbacks.route("broadcasts")
+async def list_broadcasts(call: CallbackQuery):
+    """Список активных рассылок с кнопками управления"""
+    if not is_admin(call.from_user.id):
+        return await call.answer("❌ Доступ запрещен", show_alert=True)
+
+    if not active_broadcasts:
+        return await call.answer("📬 Активных рассылок нет", show_alert=True)
+
+    for broadcast in list(active_broadcasts.values()):
+        await call.message.answer(broadcast.status_text(), reply_markup=broadcast_controls(broadcast))
+    await call.answer()
+
+
+@callbacks.route("bc", args=2)
+async def broadcast_control(call: CallbackQuery, action: str, job_id: str):
+    """Пауза, продолжение и отмена рассылки"""
+    if not is_admin(call.from_user.id):
+        return await call.answer("❌ Доступ запрещен", show_alert=True)
 
+    broadcast = active_broadcasts.get(unpack_int(job_id))
+    if broadcast is None or broadcast.finished:
+        return await call.answer("📬 Рассылка уже завершена", show_alert=True)
 
+    if action == "pause":
+        broadcast.pause()
+        answer = "⏸ Рассылка на паузе"
+    elif action == "resume":
+        broadcast.resume()
+        answer = "▶️ Рассылка продолжена"
+    else:
+        broadcast.cancel()
+        answer = "⛔ Рассылка отменена"
+    await broadcast.save()
 
+    try:
+        await call.message.edit_text(broadcast.status_text(), reply_markup=broadcast_controls(broadcast))
+    except Exception:
+        pass
+    await call.answer(answer)
 
 
-@dp.callback_query(F.data == "cancel_post")
+@callbacks.route("cancel_post", with_state=True)
 async def cancel_post(call: CallbackQuery, state: FSMContext):
     """Отмена создания поста"""
     data = await state.get_data()
     post_id = data.get("post_id")
     # Если это черновик — удаляем только черновик
     if post_id and post_id in drafts:
-        preview_msgs = drafts[post_id].get('preview_messages', [])
-        for chat_id, msg_id in preview_msgs:
-            try:
-                await bot.delete_message(chat_id, msg_id)
-            except:
-                pass
-        del drafts[post_id]
+        await drafts.discard(post_id)
 
     # Если же пост уже опубликован — удаляем его из публикаций
     elif post_id and post_id in posts:
@@ -1059,14 +4306,15 @@ async def cancel_post(call: CallbackQuery, state: FSMContext):
                 await bot.delete_message(chat_id, msg_id)
             except:
                 pass
+        unindex_post(post_id)
         del posts[post_id]
         try:
-            save_posts()
-        except Exception:
-            pass
+            await storage.delete_post(post_id)
+        except Exception as e:
+            logger.error(f"Ошибка удаления поста {post_id}: {e}")
     
     await state.clear()
-    await call.message.answer("❌ Создание поста отменено", reply_markup=admin_menu())
+    await call.message.answer("❌ Создание поста отменено", reply_markup=ADMIN_MENU)
     await call.answer()
 
 
@@ -1074,13 +4322,13 @@ async def cancel_post(call: CallbackQuery, state: FSMContext):
 # РЕДАКТИРОВАНИЕ МОДОВ
 # =====================
 
-@dp.callback_query(F.data.startswith("edit_mod_"))
-async def show_mod_edit_menu(call: CallbackQuery):
+@callbacks.route("edit", args=1)
+async def show_mod_edit_menu(call: CallbackQuery, packed_id: str):
     """Показывает меню редактирования мода"""
     if not is_admin(call.from_user.id):
         return await call.answer("❌ Доступ запрещен", show_alert=True)
     
-    post_id = call.data.replace("edit_mod_", "")
+    post_id = unpack_id(packed_id)
     
     if post_id not in posts:
         return await call.answer("❌ Мод не найден", show_alert=True)
@@ -1098,14 +4346,16 @@ async def show_mod_edit_menu(call: CallbackQuery):
 📦 Тип: {file_type}
 📢 Каналы: {channels}
 ⬇️ Скачиваний: {post.get('downloads', 0)}
+👤 Уникальных: ~{unique_downloaders.post_count(post_id)}
 
 Выберите что редактировать:
 """.strip()
     
     buttons = [
-        [InlineKeyboardButton(text="✏️ Название", callback_data=f"edit_title_{post_id}")],
-        [InlineKeyboardButton(text="📦 Файл/Ссылка", callback_data=f"edit_file_{post_id}")],
-        [InlineKeyboardButton(text="📸 Фото/Видео", callback_data=f"edit_media_{post_id}")],
+        [InlineKeyboardButton(text="✏️ Название", callback_data=pack_callback("edit_title", pack_id(post_id)))],
+        [InlineKeyboardButton(text="📦 Файл/Ссылка", callback_data=pack_callback("edit_file", pack_id(post_id)))],
+        [InlineKeyboardButton(text="📸 Фото/Видео", callback_data=pack_callback("edit_media", pack_id(post_id)))],
+        [InlineKeyboardButton(text="📈 Аналитика", callback_data=pack_callback("an", "post", "day", pack_id(post_id)))],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="manage_mods")]
     ]
     
@@ -1117,10 +4367,10 @@ async def show_mod_edit_menu(call: CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("edit_title_"))
-async def edit_title_start(call: CallbackQuery, state: FSMContext):
+@callbacks.route("edit_title", args=1, with_state=True)
+async def edit_title_start(call: CallbackQuery, state: FSMContext, packed_id: str):
     """Начало редактирования названия модов"""
-    post_id = call.data.replace("edit_title_", "")
+    post_id = unpack_id(packed_id)
     
     if post_id not in posts:
         return await call.answer("❌ Мод не найден", show_alert=True)
@@ -1136,15 +4386,15 @@ async def edit_title_start(call: CallbackQuery, state: FSMContext):
     await call.message.answer(
         "📝 Введите новое название для мода:\n\n"
         "(максимум 200 символов)",
-        reply_markup=cancel_inline_kb()
+        reply_markup=CANCEL_INLINE_KB
     )
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("edit_file_"))
-async def edit_file_start(call: CallbackQuery, state: FSMContext):
+@callbacks.route("edit_file", args=1, with_state=True)
+async def edit_file_start(call: CallbackQuery, state: FSMContext, packed_id: str):
     """Начало редактирования файла мода"""
-    post_id = call.data.replace("edit_file_", "")
+    post_id = unpack_id(packed_id)
     
     if post_id not in posts:
         return await call.answer("❌ Мод не найден", show_alert=True)
@@ -1159,15 +4409,15 @@ async def edit_file_start(call: CallbackQuery, state: FSMContext):
     
     await call.message.answer(
         "📦 Отправьте новый файл или ссылку для скачивания:",
-        reply_markup=cancel_inline_kb()
+        reply_markup=CANCEL_INLINE_KB
     )
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("edit_media_"))
-async def edit_media_start(call: CallbackQuery, state: FSMContext):
+@callbacks.route("edit_media", args=1, with_state=True)
+async def edit_media_start(call: CallbackQuery, state: FSMContext, packed_id: str):
     """Начало редактирования медиа мода"""
-    post_id = call.data.replace("edit_media_", "")
+    post_id = unpack_id(packed_id)
     
     if post_id not in posts:
         return await call.answer("❌ Мод не найден", show_alert=True)
@@ -1182,54 +4432,58 @@ async def edit_media_start(call: CallbackQuery, state: FSMContext):
     
     await call.message.answer(
         "📸 Отправьте новое фото, видео или гифку:",
-        reply_markup=cancel_inline_kb()
+        reply_markup=CANCEL_INLINE_KB
     )
     await call.answer()
 
 
-async def sync_mod_to_channels(post_id: str, post_data: dict):
+async def sync_mod_to_channels(post_id: str, post_data: dict) -> dict:
     """Синхронизирует изменения мода в все каналы где он был опубликован"""
-    bot_username = (await bot.get_me()).username
-    kb = download_keyboard(bot_username, post_id)
-    
-    caption = f"🔥 <b>{post_data['title']}</b>\n\n📥 Нажмите кнопку для скачивания"
+    kb = download_keyboard(post_id)
     
-    if "file" in post_data:
-        file_size_mb = post_data['file_size'] / (1024 * 1024)
-        caption += f"\n\n📦 Файл: {post_data['file_name']}\n💾 Размер: {file_size_mb:.2f} МБ"
+    caption = post_caption(post_id, post_data, "file")
     
     # Получаем список каналов где был опубликован
     published = post_data.get('published', {})
     
-    for channel_id, message_id in published.items():
-        try:
-            media_id = post_data.get("media")
-            media_type = post_data.get("media_type", "photo")
-            
-            # Пытаемся обновить существующее сообщение
-            if media_type == "video":
-                await bot.edit_message_media(
-                    chat_id=channel_id,
-                    message_id=message_id,
-                    media=InputMediaVideo(media=media_id, caption=caption, parse_mode=ParseMode.HTML),
-                    reply_markup=kb
-                )
-            elif media_type == "animation":
-                await bot.edit_message_media(
-                    chat_id=channel_id,
-                    message_id=message_id,
-                    media=InputMediaAnimation(media=media_id, caption=caption, parse_mode=ParseMode.HTML),
-                    reply_markup=kb
-                )
-            else:  # photo
-                await bot.edit_message_media(
-                    chat_id=channel_id,
-                    message_id=message_id,
-                    media=InputMediaPhoto(media=media_id, caption=caption, parse_mode=ParseMode.HTML),
-                    reply_markup=kb
-                )
-        except Exception as e:
-            logger.error(f"Ошибка обновления поста в канале {channel_id}: {e}")
+    media_id = post_data.get("media")
+    media_type = post_data.get("media_type", "photo")
+    
+    if media_type == "video":
+        media = InputMediaVideo(media=media_id, caption=caption, parse_mode=ParseMode.HTML)
+    elif media_type == "animation":
+        media = InputMediaAnimation(media=media_id, caption=caption, parse_mode=ParseMode.HTML)
+    else:  # photo
+        media = InputMediaPhoto(media=media_id, caption=caption, parse_mode=ParseMode.HTML)
+    
+    async def edit(channel_id):
+        # Пытаемся обновить существующее сообщение
+        return await bot.edit_message_media(
+            chat_id=channel_id,
+            message_id=published[channel_id],
+            media=media,
+            reply_markup=kb
+        )
+    
+    # Все каналы обновляются параллельно
+    # Правка идемпотентна — ее можно повторять и после сетевых ошибок
+    results = await run_for_channels(list(published), edit, retry_network=True)
+    for channel_id, (ok, error) in results.items():
+        if not ok:
+            logger.error(f"Ошибка обновления поста в канале {channel_id}: {error}")
+    return results
+
+
+async def commit_post_edit(post_id: str) -> dict:
+    """Переиндексирует и сохраняет правку поста, затем обновляет его в каналах"""
+    post = posts[post_id]
+    index_post(post_id)
+    # Сохраняем до правки в каналах: пока она идет, синхронизация может подменить пост в `posts`
+    try:
+        await storage.save_post(post_id, post)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения поста {post_id}: {e}")
+    return await sync_mod_to_channels(post_id, post)
 
 
 # =====================
@@ -1237,7 +4491,7 @@ async def sync_mod_to_channels(post_id: str, post_data: dict):
 # =====================
 
 
-@dp.callback_query(F.data == "manage_mods")
+@callbacks.route("manage_mods")
 async def manage_mods(call: CallbackQuery):
     """Управление модами"""
     if not is_admin(call.from_user.id):
@@ -1252,61 +4506,77 @@ async def manage_mods(call: CallbackQuery):
         await call.message.answer(
             "📂 <b>Управление модами</b>\n\n"
             "Нет доступных модов для управления.",
-            reply_markup=admin_menu()
+            reply_markup=ADMIN_MENU
         )
         return await call.answer()
     
+    await show_manage_page(call.message, DEFAULT_ORDER, 0)
+    await call.answer()
+
+
+@callbacks.route("mpage", args=2)
+async def manage_page_navigation(call: CallbackQuery, order: str, offset: str):
+    """Навигация по страницам управления модами: mpage:<порядок>:<смещение>"""
+    if not is_admin(call.from_user.id):
+        return await call.answer("❌ Доступ запрещен", show_alert=True)
+    
+    offset = unpack_int(offset)
+    if offset is None:
+        return await call.answer()
+    await show_manage_page(call.message, order, offset)
+    await call.answer()
+
+
+async def show_manage_page(message: Message, order: str, offset: int):
+    """Страница списка модов с кнопками редактирования и удаления"""
+    total = len(posts)
+    offset = max(0, min(offset, (total - 1) // MANAGE_PER_PAGE * MANAGE_PER_PAGE)) if total else 0
+    
     # Показываем список модов с опциями
     buttons = []
-    for post_id, post_data in list(posts.items())[:10]:  # Первые 10
-        title = post_data.get('title', 'Без названия')[:20]  # Обрезаем название
+    for post_id in catalog_index.page("all", order, offset, MANAGE_PER_PAGE):
+        title = posts[post_id].get('title', 'Без названия')[:20]  # Обрезаем название
         buttons.append([
-            InlineKeyboardButton(text=f"📄 {title}", callback_data=f"get_mod_{post_id}"),
-            InlineKeyboardButton(text="✏️", callback_data=f"edit_mod_{post_id}"),
-            InlineKeyboardButton(text="🗑️", callback_data=f"delete_mod_{post_id}")
+            InlineKeyboardButton(text=f"📄 {title}", callback_data=pack_callback("mod", pack_id(post_id))),
+            InlineKeyboardButton(text="✏️", callback_data=pack_callback("edit", pack_id(post_id))),
+            InlineKeyboardButton(text="🗑️", callback_data=pack_callback("delete", pack_id(post_id)))
         ])
     
+    buttons.append(sort_buttons("mpage", order))
+    buttons.append(mods_pagination(pack_callback("mpage", order), offset, total, MANAGE_PER_PAGE))
     buttons.append([InlineKeyboardButton(text="🏠 Меню", callback_data="back_to_menu")])
     
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     
-    total = len(posts)
-    
+    text = (
+        f"📂 <b>Управление модами</b>\n\n"
+        f"Всего модов: {total}\n\n"
+        "Нажмите на кнопки для редактирования или удаления:"
+    )
     try:
-        await call.message.edit_text(
-            f"📂 <b>Управление модами</b>\n\n"
-            f"Всего модов: {total}\n\n"
-            "Нажмите на кнопки для редактирования или удаления:",
-            reply_markup=kb
-        )
+        await message.edit_text(text, reply_markup=kb)
     except:
-        await call.message.answer(
-            f"📂 <b>Управление модами</b>\n\n"
-            f"Всего модов: {total}\n\n"
-            "Нажмите на кнопки для редактирования или удаления:",
-            reply_markup=kb
-        )
-    
-    await call.answer()
+        await message.answer(text, reply_markup=kb)
 
 
-@dp.callback_query(F.data.startswith("delete_mod_"))
-async def delete_mod(call: CallbackQuery):
+@callbacks.route("delete", args=1)
+async def delete_mod(call: CallbackQuery, packed_id: str):
     """Удаление мода"""
     if not is_admin(call.from_user.id):
         return await call.answer("❌ Доступ запрещен", show_alert=True)
     
-    post_id = call.data.replace("delete_mod_", "")
+    post_id = unpack_id(packed_id)
     
     if post_id not in posts:
         return await call.answer("❌ Мод не найден", show_alert=True)
     
     post_title = posts[post_id].get('title', 'Неизвестный мод')
+    unindex_post(post_id)
     del posts[post_id]
     try:
-        save_posts()
-    except Exception:
-        pass
+        await storage.delete_post(post_id)
+    except Exception as e:
+        logger.error(f"Ошибка удаления поста {post_id}: {e}")
     
     try:
         await call.message.delete()
@@ -1337,181 +4607,187 @@ async def delete_mod(call: CallbackQuery):
 
 
 
-@dp.message(AddPost.title)
 async def process_edit_title(message: Message, state: FSMContext):
-    """Сохранение названия для нового поста или редактирование существующего"""
-    data = await state.get_data()
+    """Редактирование названия существующего мода (вызывается из process_title)"""
+    post_id = (await state.get_data())['edit_post_id']
     
-    # Режим редактирования
-    if data.get('edit_post_id'):
-        post_id = data['edit_post_id']
-        
-        if post_id not in posts:
-            await state.clear()
-            return await message.answer("❌ Мод не найден", reply_markup=admin_menu())
-        
-        # Обновляем название в посте
-        posts[post_id]['title'] = message.text
-        
-        # Синхронизируем с каналами
-        await sync_mod_to_channels(post_id, posts[post_id])
-        
-        # Сохраняем
-        try:
-            save_posts()
-        except Exception:
-            pass
-        
+    if post_id not in posts:
         await state.clear()
-        await message.answer(
-            f"✅ <b>Название обновлено!</b>\n\n"
-            f"Новое название: <code>{message.text}</code>",
-            reply_markup=admin_menu()
-        )
-    else:
-        # Режим создания нового поста
-        await state.update_data(title=message.text)
-        await state.set_state(AddPost.file)
-        await message.answer(
-            "📦 Отправьте файл (документ) или ссылку для скачивания:\n\n"
-            "💡 Совет: Для ссылок используйте прямые ссылки на файлы",
-            reply_markup=cancel_inline_kb()
-        )
+        return await message.answer("❌ Мод не найден", reply_markup=ADMIN_MENU)
+    
+    # Обновляем название в посте
+    posts[post_id]['title'] = message.text
+    
+    # Сохраняем и синхронизируем с каналами
+    channel_results = await commit_post_edit(post_id)
+    
+    await state.clear()
+    await message.answer(
+        f"✅ <b>Название обновлено!</b>\n\n"
+        f"Новое название: <code>{message.text}</code>"
+        f"{format_channel_results(channel_results)}",
+        reply_markup=ADMIN_MENU
+    )
 
 
-@dp.message(AddPost.file)
 async def process_edit_file(message: Message, state: FSMContext):
-    """Сохранение файла/ссылки для нового поста или редактирование существующего"""
-    data = await state.get_data()
+    """Редактирование файла/ссылки существующего мода (вызывается из process_file)"""
+    post_id = (await state.get_data())['edit_post_id']
     
     if message.document:
-        data["file"] = message.document.file_id
-        data["file_name"] = message.document.file_name
-        data["file_size"] = message.document.file_size
+        fields = {
+            "file": message.document.file_id,
+            "file_name": message.document.file_name,
+            "file_size": message.document.file_size,
+        }
     elif message.text:
         if not message.text.startswith(("http://", "https://")):
             return await message.answer("❌ Ссылка должна начинаться с http:// или https://")
-        data["link"] = message.text
+        fields = {"link": message.text}
     else:
         return await message.answer("❌ Отправьте документ или текстовую ссылку!")
     
-    # Режим редактирования
-    if data.get('edit_post_id'):
-        post_id = data['edit_post_id']
-        
-        if post_id not in posts:
-            await state.clear()
-            return await message.answer("❌ Мод не найден", reply_markup=admin_menu())
-        
-        # Обновляем файл/ссылку в посте
-        posts[post_id].update(data)
-        
-        # Синхронизируем с каналами
-        await sync_mod_to_channels(post_id, posts[post_id])
-        
-        # Сохраняем
-        try:
-            save_posts()
-        except Exception:
-            pass
-        
-        await state.clear()
-        await message.answer(
-            f"✅ <b>Файл обновлен!</b>",
-            reply_markup=admin_menu()
-        )
-    else:
-        # Режим создания нового поста
-        await state.update_data(**data)
-        await state.set_state(AddPost.channels)
-        
-        await message.answer(
-            "📢 <b>Укажите каналы для публикации</b>\n\n"
-            "Напишите названия каналов через пробел.\n"
-            "Можно указывать с @ или без:\n"
-            "Пример: @YAKMODS \n"
-            "или: YAKMODS\n\n"
-            "Или напишите 'все' для публикации во все стандартные каналы.",
-            reply_markup=cancel_inline_kb()
-        )
-
-
-@dp.message(AddPost.channels)
-async def process_edit_channels(message: Message, state: FSMContext):
-    """Сохранение каналов для нового поста"""
-    data = await state.get_data()
-    text = message.text.strip()
-
-    # Проверяем нажата ли кнопка отмены
-    if text == "❌ Отмена":
+    if post_id not in posts:
         await state.clear()
-        return await message.answer("❌ Действие отменено", reply_markup=admin_menu() if is_admin(message.from_user.id) else main_menu())
-
-    selected_channels = []
-
-    # Проверяем "все" для стандартных каналов
-    if text.lower() == "все":
-        selected_channels = list(CHANNELS.values())
-    else:
-        # Парсим введённые каналы
-        channel_names = text.split()
-        for channel_name in channel_names:
-            # Убираем @ если есть и приводим к правильному формату
-            channel_name = channel_name.strip()
-            if not channel_name.startswith("@"):
-                channel_name = "@" + channel_name
-
-            # Проверяем что это похоже на валидный канал
-            if len(channel_name) < 2 or not channel_name[1:].replace("_", "").isalnum():
-                return await message.answer(
-                    f"❌ Некорректный формат канала: <code>{channel_name}</code>\n\n"
-                    "Канал должен содержать буквы, цифры и подчеркивания.\n"
-                    "Пример: @my_channel или my_channel"
-                )
-
-            selected_channels.append(channel_name)
-
-    if not selected_channels:
-        return await message.answer(
-            "❌ Вы не указали ни одного канала!\n\n"
-            "Напишите названия каналов через пробел, например:\n"
-            "@YAKMODS"
-        )
-
-    await state.update_data(selected_channels=selected_channels, required_channels=selected_channels)
-    await state.set_state(AddPost.notify)
-
+        return await message.answer("❌ Мод не найден", reply_markup=ADMIN_MENU)
+    
+    # Обновляем файл/ссылку в посте (прежний вариант убираем целиком)
+    post = posts[post_id]
+    for key in ("file", "file_name", "file_size", "link"):
+        post.pop(key, None)
+    post.update(fields)
+    
+    # Сохраняем и синхронизируем с каналами
+    channel_results = await commit_post_edit(post_id)
+    
+    await state.clear()
     await message.answer(
-        f"✅ <b>Выбранные каналы:</b>\n{', '.join(selected_channels)}\n\n"
-        "📬 <b>Уведомить всех пользователей о новом посте?</b>",
-        reply_markup=notify_menu()
+        f"✅ <b>Файл обновлен!</b>{format_channel_results(channel_results)}",
+        reply_markup=ADMIN_MENU
     )
 
 
-@dp.callback_query(F.data == "stats")
+@callbacks.route("stats")
 async def show_stats(call: CallbackQuery):
     """Показывает статистику бота"""
     if not is_admin(call.from_user.id):
         return await call.answer("❌ Доступ запрещен", show_alert=True)
     
-    total_downloads = sum(post.get('downloads', 0) for post in posts.values())
+    total_users = await storage.count_users()
     
-    # Топ 5 модов по скачиваниям
-    top_mods = sorted(posts.items(), key=lambda x: x[1].get('downloads', 0), reverse=True)[:5]
+    # Общий топ по скачиваниям
+    top_mods = [posts[post_id] for post_id in leaderboard.top(LEADERBOARD_SIZE)]
     top_text = "\n".join([f"{i+1}. {post['title']}: {post.get('downloads', 0)} ⬇️" 
-                          for i, (_, post) in enumerate(top_mods)])
+                          for i, post in enumerate(top_mods)])
+    
+    # Топы за период
+    windows_text = ""
+    for code, (label, _) in LEADERBOARD_WINDOWS.items():
+        window_top = [(posts[post_id], count) for post_id, count in leaderboard.window_top(code, WINDOW_TOP_SIZE)
+                      if post_id in posts]
+        lines = "\n".join(f"{i+1}. {post['title']}: {count} ⬇️" for i, (post, count) in enumerate(window_top))
+        windows_text += (
+            f"📈 <b>Топ {label}</b> (всего {leaderboard.windows[code].total} ⬇️):\n"
+            f"{lines if lines else 'Нет данных'}\n\n"
+        )
     
     stats_text = (
         "📊 <b>Статистика бота</b>\n\n"
         f"📝 Всего постов: {len(posts)}\n"
-        f"👥 Всего пользователей: {len(users)}\n"
-        f"⬇️ Всего скачиваний: {total_downloads}\n"
-        f"🚫 Заблокировано: {len(banned_users)}\n\n"
-        f"🏆 <b>Топ 5 модов:</b>\n{top_text if top_text else 'Нет данных'}\n\n"
+        f"👥 Всего пользователей: {total_users}\n"
+        f"⬇️ Всего скачиваний: {leaderboard.total}\n"
+        f"👤 Уникальных скачавших: ~{unique_downloaders.count('all')} "
+        f"(за 7 дней: ~{unique_downloaders.window_count(7, time.time())})\n"
+        f"🚫 Заблокировано: {len(banned_users)}\n"
+        f"🗂 Кэш подписок: {subscription_cache.stats_text()}\n\n"
+        f"🏆 <b>Топ {LEADERBOARD_SIZE} модов:</b>\n{top_text if top_text else 'Нет данных'}\n\n"
+        f"{windows_text}"
         f"⚡️ Статус: Активен"
     )
     
-    await call.message.answer(stats_text, reply_markup=admin_menu())
+    await call.message.answer(stats_text, reply_markup=ADMIN_MENU)
+    await call.answer()
+
+
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+ANALYTICS_TABLE_ROWS = 12  # Последних корзин в таблице под графиком
+# Подписи корзин для каждого разрешения
+ROLLUP_LABELS = {"minute": "%H:%M", "hour": "%d.%m %H:00", "day": "%d.%m"}
+
+
+def render_downloads_chart(points: list, resolution: str) -> str:
+    """Спарклайн и таблица последних корзин"""
+    counts = [count for _, count in points]
+    peak = max(counts)
+    spark = "".join(SPARK_BARS[count * (len(SPARK_BARS) - 1) // peak] if peak else SPARK_BARS[0] for count in counts)
+    fmt = ROLLUP_LABELS[resolution]
+    rows = "\n".join(
+        f"{datetime.fromtimestamp(start).strftime(fmt):>11} │ {count}"
+        for start, count in reversed(points[-ANALYTICS_TABLE_ROWS:])
+    )
+    return f"<code>{spark}</code>\nВсего: {sum(counts)} ⬇️ · пик: {peak}\n\n<pre>{rows}</pre>"
+
+
+def analytics_keyboard(kind: str, resolution: str, key: str):
+    """Переключатель разрешения, категории (для общего графика) и возврат"""
+    buttons = [[
+        InlineKeyboardButton(
+            text=f"• {label}" if res == resolution else label,
+            callback_data=pack_callback("an", kind, res, pack_id(key) if kind == "post" else key)
+        )
+        for res, (label, _, _) in ROLLUP_RESOLUTIONS.items()
+    ]]
+    if kind == "all":
+        categories = [(cat, name) for cat, name in CATEGORIES.items() if cat != "all"]
+        for i in range(0, len(categories), 2):
+            buttons.append([
+                InlineKeyboardButton(text=name, callback_data=pack_callback("an", "cat", resolution, cat))
+                for cat, name in categories[i:i + 2]
+            ])
+        buttons.append([InlineKeyboardButton(text="🏠 Меню", callback_data="back_to_menu")])
+    elif kind == "cat":
+        buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=pack_callback("an", "all", resolution, "all"))])
+    else:
+        buttons.append([InlineKeyboardButton(text="⬅️ К моду", callback_data=pack_callback("edit", pack_id(key)))])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@callbacks.route("an", args=3)
+async def show_analytics(call: CallbackQuery, kind: str, resolution: str, key: str):
+    """Графики скачиваний: общий, по категории или по моду (an:<вид>:<разрешение>:<ключ>)"""
+    if not is_admin(call.from_user.id):
+        return await call.answer("❌ Доступ запрещен", show_alert=True)
+    
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return await call.answer()
+    
+    if kind == "post":
+        key = unpack_id(key)
+        if key not in posts:
+            return await call.answer("❌ Мод не найден", show_alert=True)
+        name = posts[key].get('title', 'Без названия')
+        series_key = f"post:{key}"
+    elif kind == "cat":
+        name = CATEGORIES.get(key, key)
+        series_key = f"cat:{key}"
+    else:
+        name = "все моды"
+        series_key = "all"
+    
+    label, step, size = ROLLUP_RESOLUTIONS[resolution]
+    points = download_analytics.points(series_key, resolution, time.time())
+    text = (
+        f"📈 <b>Скачивания: {name}</b>\n"
+        f"🕒 {label}, последние {size}\n\n"
+        f"{render_downloads_chart(points, resolution)}"
+    )
+    
+    kb = analytics_keyboard(kind, resolution, key)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        # Сообщение нельзя отредактировать (слишком старое или текст не изменился) — шлем новое
+        await call.message.answer(text, reply_markup=kb)
     await call.answer()
 
 
@@ -1519,7 +4795,7 @@ async def show_stats(call: CallbackQuery):
 # УПРАВЛЕНИЕ АДМИНАМИ
 # =====================
 
-@dp.callback_query(F.data == "manage_admins")
+@callbacks.route("manage_admins")
 async def manage_admins(call: CallbackQuery):
     """Управление админами (доступно только для создателя)"""
     if not is_owner(call.from_user.id):
@@ -1544,7 +4820,7 @@ async def manage_admins(call: CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data == "add_admin")
+@callbacks.route("add_admin", with_state=True)
 async def add_admin_start(call: CallbackQuery, state: FSMContext):
     """Начало процесса добавления админа"""
     if not is_owner(call.from_user.id):
@@ -1571,7 +4847,7 @@ async def process_add_admin(message: Message, state: FSMContext):
         await state.clear()
         return await message.answer(
             "❌ Добавление отменено",
-            reply_markup=admin_menu()
+            reply_markup=ADMIN_MENU
         )
     
     try:
@@ -1593,12 +4869,13 @@ async def process_add_admin(message: Message, state: FSMContext):
             except Exception:
                 username = None
             admins_info[admin_id] = username
+            await storage.save_admin(admin_id, username)
 
             await message.answer(
                 f"✅ <b>Админ добавлен!</b>\n\n"
                 f"ID: {admin_id} {'('+username+')' if username else ''}\n"
                 f"Всего админов: {len(admins)}",
-                reply_markup=admin_menu()
+                reply_markup=ADMIN_MENU
             )
         
         await state.clear()
@@ -1611,7 +4888,7 @@ async def process_add_admin(message: Message, state: FSMContext):
         )
 
 
-@dp.callback_query(F.data == "list_admins")
+@callbacks.route("list_admins")
 async def list_admins(call: CallbackQuery):
     """Показать список администраторов"""
     if not is_owner(call.from_user.id):
@@ -1625,6 +4902,7 @@ async def list_admins(call: CallbackQuery):
                 user = await bot.get_chat(admin_id)
                 name = getattr(user, 'username', None)
                 admins_info[admin_id] = name
+                await storage.save_admin(admin_id, name)
             except Exception:
                 name = None
         if name:
@@ -1645,7 +4923,7 @@ async def list_admins(call: CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query(F.data == "remove_admin")
+@callbacks.route("remove_admin", with_state=True)
 async def remove_admin_start(call: CallbackQuery, state: FSMContext):
     """Начало процесса удаления админа"""
     if not is_owner(call.from_user.id):
@@ -1670,7 +4948,7 @@ async def remove_admin_start(call: CallbackQuery, state: FSMContext):
     for admin_id in sorted(other_admins):
         buttons.append([InlineKeyboardButton(
             text=f"❌ {admin_id}",
-            callback_data=f"confirm_remove_{admin_id}"
+            callback_data=pack_callback("confirm_remove", admin_id)
         )])
     
     buttons.append([InlineKeyboardButton(text="🏠 Отмена", callback_data="manage_admins")])
@@ -1683,13 +4961,13 @@ async def remove_admin_start(call: CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("confirm_remove_"))
-async def confirm_remove_admin(call: CallbackQuery):
+@callbacks.route("confirm_remove", args=1)
+async def confirm_remove_admin(call: CallbackQuery, admin_id: str):
     """Подтверждение удаления админа"""
     if not is_owner(call.from_user.id):
         return await call.answer("❌ Только создатель может управлять админами", show_alert=True)
     
-    admin_id = int(call.data.replace("confirm_remove_", ""))
+    admin_id = unpack_int(admin_id)
     
     if admin_id not in admins or admin_id == OWNER_ID:
         return await call.answer("❌ Админ не найден", show_alert=True)
@@ -1697,12 +4975,13 @@ async def confirm_remove_admin(call: CallbackQuery):
     # Удаляем админа
     admins.discard(admin_id)
     admins_info.pop(admin_id, None)
+    await storage.delete_admin(admin_id)
     
     await call.message.answer(
         f"✅ <b>Админ удален!</b>\n\n"
         f"ID: {admin_id}\n"
         f"Всего админов: {len(admins)}",
-        reply_markup=admin_menu()
+        reply_markup=ADMIN_MENU
     )
     await call.answer("✅ Админ успешно удален!")
 
@@ -1711,7 +4990,7 @@ async def confirm_remove_admin(call: CallbackQuery):
 # ПРЕДЛОЖЕНИЯ
 # =====================
 
-@dp.callback_query(F.data == "suggest_idea")
+@callbacks.route("suggest_idea", with_state=True)
 async def suggest_idea_start(call: CallbackQuery, state: FSMContext):
     """Начало процесса предложения идеи"""
     user_id = call.from_user.id
@@ -1720,7 +4999,7 @@ async def suggest_idea_start(call: CallbackQuery, state: FSMContext):
         return await call.answer("🚫 Вы заблокированы за спам предложениями", show_alert=True)
     
     # Проверка кулдауна
-    can_suggest, remaining = check_suggestion_cooldown(user_id)
+    can_suggest, remaining = await check_suggestion_cooldown(user_id)
     
     if not can_suggest:
         minutes = remaining // 60
@@ -1746,10 +5025,10 @@ async def process_suggestion(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
     # Проверка кулдауна еще раз
-    can_suggest, remaining = check_suggestion_cooldown(user_id)
+    can_suggest, remaining = await check_suggestion_cooldown(user_id)
     
     if not can_suggest:
-        is_banned_now = add_suggestion_violation(user_id)
+        is_banned_now = await add_suggestion_violation(user_id)
         
         if is_banned_now:
             await state.clear()
@@ -1766,7 +5045,7 @@ async def process_suggestion(message: Message, state: FSMContext):
         )
     
     # Сохраняем время последнего предложения
-    suggestion_cooldowns[user_id] = time.time()
+    await storage.set_cooldown(user_id, time.time())
     
     suggestion_id = str(uuid.uuid4())
     
@@ -1816,13 +5095,13 @@ async def process_suggestion(message: Message, state: FSMContext):
     await state.clear()
 
 
-@dp.callback_query(F.data.startswith("approve_"))
-async def approve_suggestion(call: CallbackQuery, state: FSMContext):
+@callbacks.route("approve", args=1, with_state=True)
+@callbacks.legacy("approve_", with_state=True)
+async def approve_suggestion(call: CallbackQuery, state: FSMContext, packed_id: str):
     """Одобрение предложения"""
-    suggestion_id = call.data.replace("approve_", "")
     
     await state.update_data(
-        suggestion_id=suggestion_id,
+        suggestion_id=unpack_id(packed_id),
         action="approve",
         original_message_id=call.message.message_id
     )
@@ -1835,13 +5114,13 @@ async def approve_suggestion(call: CallbackQuery, state: FSMContext):
     await call.answer()
 
 
-@dp.callback_query(F.data.startswith("reject_"))
-async def reject_suggestion(call: CallbackQuery, state: FSMContext):
+@callbacks.route("reject", args=1, with_state=True)
+@callbacks.legacy("reject_", with_state=True)
+async def reject_suggestion(call: CallbackQuery, state: FSMContext, packed_id: str):
     """Отклонение предложения"""
-    suggestion_id = call.data.replace("reject_", "")
     
     await state.update_data(
-        suggestion_id=suggestion_id,
+        suggestion_id=unpack_id(packed_id),
         action="reject",
         original_message_id=call.message.message_id
     )
@@ -1893,7 +5172,7 @@ async def process_review_comment(message: Message, state: FSMContext):
         await bot.send_message(user_id, result_text)
         
         # Подтверждаем админу
-        await message.answer(admin_text, reply_markup=admin_menu())
+        await message.answer(admin_text, reply_markup=ADMIN_MENU)
         
     except Exception as e:
         logger.error(f"Ошибка обработки решения: {e}")
@@ -1906,12 +5185,13 @@ async def process_review_comment(message: Message, state: FSMContext):
 # СКАЧИВАНИЕ
 # =====================
 
-async def handle_download(message: Message, args: str):
+async def handle_download(message: Message, args: str, use_cache: bool = True, source: str = "link"):
     """Обработка запроса на скачивание"""
     if is_banned(message.from_user.id):
         return await message.answer("🚫 Вы заблокированы")
     
-    post_id = args.replace("download_", "")
+    # Ссылки из старых постов содержат UUID — переводим в текущий id
+    post_id = post_ids.resolve(args.replace("download_", ""))
     post = posts.get(post_id)
     
     if not post:
@@ -1922,44 +5202,42 @@ async def handle_download(message: Message, args: str):
     
     # Проверка подписки
     required_channels = post.get('required_channels', ['main'])
-    is_subscribed, missing = await check_subscription(message.from_user.id, required_channels)
+    is_subscribed, missing = await check_subscription(message.from_user.id, required_channels, use_cache=use_cache)
     
     if not is_subscribed:
-        bot_username = (await bot.get_me()).username
         return await message.answer(
             "⚠️ <b>Требуется подписка</b>\n\n"
             "Для скачивания подпишитесь на указанные каналы:",
-            reply_markup=subscribe_keyboard(bot_username, post_id, missing)
+            reply_markup=subscribe_keyboard(post_id, missing)
         )
     
     # Увеличиваем счетчик скачиваний
-    post['downloads'] = post.get('downloads', 0) + 1
-    try:
-        save_posts()
-    except Exception as e:
-        logger.error(f"Ошибка сохранения счетчика скачиваний: {e}")
+    record_download(post_id, post, message.from_user.id, source)
     
     await send_file_to_user(message, post)
 
 
-@dp.callback_query(F.data.startswith("check_"))
-async def recheck_subscription(call: CallbackQuery):
-    """Повторная проверка подписки"""
+# Кнопки check_<uuid> и download_<uuid> больше не создаются (проверка и скачивание идут через deep link /start),
+# обработчики оставлены только для сообщений старого формата
+@callbacks.legacy("check_")
+async def recheck_subscription(call: CallbackQuery, packed_id: str):
+    """Повторная проверка подписки (кнопка старого формата)"""
     if is_banned(call.from_user.id):
         return await call.answer("🚫 Вы заблокированы", show_alert=True)
     
-    post_id = call.data.replace("check_", "")
+    post_id = unpack_id(packed_id)
     post = posts.get(post_id)
     
     if not post:
         return await call.answer("❌ Файл не найден", show_alert=True)
     
     required_channels = post.get('required_channels', ['main'])
-    is_subscribed, missing = await check_subscription(call.from_user.id, required_channels)
+    # Пользователь только что подписался — кэш не используем
+    is_subscribed, missing = await check_subscription(call.from_user.id, required_channels, use_cache=False)
     
     if is_subscribed:
         # Увеличиваем счетчик скачиваний
-        post['downloads'] = post.get('downloads', 0) + 1
+        record_download(post_id, post, call.from_user.id, "recheck")
         
         await send_file_to_user(call.message, post)
         await call.answer("✅ Подписка подтверждена!")
@@ -1971,13 +5249,13 @@ async def recheck_subscription(call: CallbackQuery):
         )
 
 
-@dp.callback_query(F.data.startswith("download_"))
-async def download_mod(call: CallbackQuery):
-    """Обработка нажатия на кнопку скачивания"""
+@callbacks.legacy("download_")
+async def download_mod(call: CallbackQuery, packed_id: str):
+    """Обработка нажатия на кнопку скачивания (кнопка старого формата)"""
     if is_banned(call.from_user.id):
         return await call.answer("🚫 Вы заблокированы", show_alert=True)
     
-    post_id = call.data.replace("download_", "")
+    post_id = unpack_id(packed_id)
     post = posts.get(post_id)
     
     if not post:
@@ -1988,35 +5266,24 @@ async def download_mod(call: CallbackQuery):
     is_subscribed, missing = await check_subscription(call.from_user.id, required_channels)
     
     if not is_subscribed:
-        bot_username = (await bot.get_me()).username
         await call.message.answer(
             "⚠️ <b>Требуется подписка</b>\n\n"
             "Для скачивания подпишитесь на указанные каналы:",
-            reply_markup=subscribe_keyboard(bot_username, post_id, missing)
+            reply_markup=subscribe_keyboard(post_id, missing)
         )
         return await call.answer()
     
     # Увеличиваем счетчик скачиваний
-    post['downloads'] = post.get('downloads', 0) + 1
-    try:
-        save_posts()
-    except Exception as e:
-        logger.error(f"Ошибка сохранения счетчика скачиваний: {e}")
+    record_download(post_id, post, call.from_user.id, "button")
     
     await send_file_to_user(call.message, post)
     await call.answer("✅ Готово!")
 
 
-async def send_media_with_caption(message: Message, post: dict):
+async def send_media_with_caption(message: Message, post_id: str, post: dict):
     """Отправка медиа (фото/видео/гифка) с подписью"""
     try:
-        caption = f"🔥 <b>{post['title']}</b>\n\n📥 Нажмите кнопку для скачивания"
-        
-        if "file" in post:
-            file_size_mb = post['file_size'] / (1024 * 1024)
-            caption += f"\n\n📦 Файл: {post['file_name']}\n💾 Размер: {file_size_mb:.2f} МБ"
-        elif "link" in post:
-            caption += f"\n\n🔗 Ссылка: {post['link']}"
+        caption = post_caption(post_id, post, "details")
         
         media_id = post.get("media")
         media_type = post.get("media_type", "photo")
@@ -2089,37 +5356,370 @@ async def unknown_message(message: Message):
     return
 
 
+# =====================
+# НЕСКОЛЬКО ПРОЦЕССОВ
+# =====================
+
+CATALOG_SYNC_INTERVAL = 2  # Как часто процесс подтягивает изменения других процессов (сек)
+
+worker_index = None  # Номер процесса-обработчика; None — однопроцессный режим
+_catalog_cursor = 0  # Номер изменения каталога, до которого изменения уже применены
+_downloads_cursor = 0  # Номер сброса счетчиков, до которого изменения уже применены
+
+
+def update_user_id(update: dict) -> int:
+    """Пользователь (или чат), к которому относится сырой апдейт"""
+    for kind in ("chat_member", "my_chat_member"):
+        if kind in update:
+            # Важен участник, чей статус изменился (его кэш подписок), а не тот, кто его изменил
+            return update[kind]["new_chat_member"]["user"]["id"]
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"]
+            chat = value.get("chat")
+            if chat:
+                return chat["id"]
+    return 0
+
+
+def update_worker(update: dict) -> int:
+    """Номер процесса-обработчика для сырого апдейта"""
+    callback = update.get("callback_query")
+    if callback and callback.get("data", "").split(CALLBACK_SEP, 1)[0] in BROADCAST_ACTIONS:
+        # Состояние рассылок есть только в процессе 0
+        return 0
+    return update_user_id(update) % BOT_WORKERS
+
+
+def apply_downloads(counts: dict):
+    """Обновляет счетчики скачиваниями, записанными другими процессами"""
+    pending = download_counter.pending()
+    for post_id, downloads in counts.items():
+        post = posts.get(post_id)
+        if post is None:
+            continue
+        # Свои несброшенные скачивания в хранилище еще не попали
+        downloads += pending.get(post_id, 0)
+        if post.get('downloads', 0) != downloads:
+            post['downloads'] = downloads
+            catalog_index.touch(post_id, post)
+            leaderboard.add_post(post_id, post)
+
+
+def apply_catalog(fresh: dict, deleted: list):
+    """Применяет изменения каталога: посты, добавленные, измененные или удаленные другими процессами"""
+    changed = False
+    for post_id in deleted:
+        if post_id in posts:
+            unindex_post(post_id, clear_inline=False)
+            del posts[post_id]
+            changed = True
+    
+    pending = download_counter.pending()
+    for post_id, post in fresh.items():
+        post['downloads'] = post.get('downloads', 0) + pending.get(post_id, 0)
+        current = posts.get(post_id)
+        if current is not None and same_post_data(current, post):
+            # Изменились только скачивания — переиндексация не нужна
+            if current.get('downloads', 0) != post['downloads']:
+                current['downloads'] = post['downloads']
+                catalog_index.touch(post_id, current)
+                leaderboard.add_post(post_id, current)
+            continue
+        posts[post_id] = post
+        index_post(post_id, clear_inline=False)
+        changed = True
+    if changed:
+        inline_cache.clear()
+
+
+def same_post_data(a: dict, b: dict) -> bool:
+    """Совпадают ли посты без учета счетчика скачиваний"""
+    return a.keys() - {'downloads'} == b.keys() - {'downloads'} and all(
+        a[key] == b[key] for key in a if key != 'downloads'
+    )
+
+
+async def sync_shared_state():
+    """Подтягивает изменения других процессов: каталог, счетчики, события, баны и админов"""
+    global _catalog_cursor, _downloads_cursor
+    while True:
+        await asyncio.sleep(CATALOG_SYNC_INTERVAL)
+        try:
+            # Только строки, изменившиеся после прошлой синхронизации
+            _catalog_cursor, fresh, deleted = await storage.load_catalog_changes(_catalog_cursor)
+            apply_catalog(fresh, deleted)
+            _downloads_cursor, counts = await storage.load_download_changes(_downloads_cursor)
+            apply_downloads(counts)
+            
+            events = await storage.load_download_events(time.time() - ROLLUP_HORIZON, _events_cursor)
+            apply_download_events(events, with_uniques=True)
+            
+            banned = await storage.load_banned()
+            banned_users.intersection_update(banned)
+            banned_users.update(banned)
+            saved_admins = await storage.load_admins()
+            admins.intersection_update(saved_admins.keys() | {OWNER_ID})
+            admins.update(saved_admins)
+            admins_info.clear()
+            admins_info.update({k: v for k, v in saved_admins.items() if v})
+            
+            # Рассылки, созданные в других процессах, выполняет процесс 0
+            if owns_broadcasts():
+                await resume_broadcasts(startup=False)
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации с хранилищем: {e}")
+
+
+class OrderedFeeder:
+    """Апдейты одного пользователя обрабатываются строго по очереди, разных пользователей — параллельно"""
+
+    def __init__(self):
+        self._tails = {}  # {user_id: задача последнего апдейта пользователя}
+        self._tasks = set()
+
+    def feed(self, update: dict):
+        user_id = update_user_id(update)
+        task = asyncio.create_task(self._process(update, self._tails.get(user_id)))
+        self._tails[user_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._done(user_id, t))
+
+    async def _process(self, update: dict, previous):
+        if previous is not None:
+            # Ждем предыдущий апдейт пользователя (его ошибка на этот не влияет)
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+
+    def _done(self, user_id: int, task):
+        self._tasks.discard(task)
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    async def drain(self):
+        """Дожидается обработки всех принятых апдейтов"""
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+
+async def run_worker(index: int, queue):
+    """Процесс-обработчик: получает апдейты своих пользователей из очереди"""
+    global worker_index
+    worker_index = index
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    await dp.emit_startup(bot=bot)
+    sync_task = asyncio.create_task(sync_shared_state())
+    
+    feeder = OrderedFeeder()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            feeder.feed(update)
+        await feeder.drain()
+    finally:
+        sync_task.cancel()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+def worker_main(index: int, queue):
+    """Точка входа процесса-обработчика"""
+    # Останавливает принимающий процесс (через None в очереди), а не Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, queue))
+
+
+async def poll_updates(route):
+    """Long polling без обработки: апдейты только раздаются процессам"""
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
+async def run_front():
+    """Принимающий процесс: получает апдейты и раздает их обработчикам по пользователю"""
+    # Схема и миграции — один раз, до запуска обработчиков
+    await storage.open()
+    await storage.close()
+    
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(BOT_WORKERS)]
+    workers = [ctx.Process(target=worker_main, args=(i, queue), name=f"worker-{i}") for i, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Запущено обработчиков: {BOT_WORKERS}")
+    
+    def route(update: dict):
+        # Апдейты одного пользователя всегда попадают в один процесс (кроме управления рассылками)
+        queues[update_worker(update)].put(update)
+    
+    async def forward_update(request: web.Request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+        route(await request.json())
+        return web.Response()
+    
+    try:
+        if BOT_MODE == "webhook":
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, forward_update)
+            app.router.add_get("/healthz", healthcheck)
+            await register_webhook()
+            await serve_app(app)
+        else:
+            await poll_updates(route)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            await asyncio.to_thread(worker.join)
+
+
 # =====================
 # ЗАПУСК БОТА
 # =====================
 
 async def on_startup():
     """Действия при запуске бота"""
+    global posts, _catalog_cursor, _downloads_cursor
     logger.info("🚀 Бот запущен!")
-    # Загружаем сохраненные посты
+    # Открываем хранилище и загружаем сохраненные данные
     try:
-        load_posts()
+        await storage.open()
+        if worker_index is not None:
+            # Номера берутся до загрузки: изменения между ними и загрузкой применятся повторно, а не потеряются
+            _catalog_cursor = await storage.catalog_version()
+            _downloads_cursor = await storage.downloads_version()
+        posts = await storage.load_posts()
+        rebuild_indexes()
+        await load_download_history()
+        await load_unique_downloaders()
+        banned_users.update(await storage.load_banned())
+        saved_admins = await storage.load_admins()
+        admins.update(saved_admins)
+        admins_info.update({k: v for k, v in saved_admins.items() if v})
+        drafts.load(await storage.load_drafts())
+        download_counter.start()
+        fsm_storage.start()
+        drafts.start()
+        logger.info(f"Загружено постов: {len(posts)}")
     except Exception as e:
-        logger.error(f"Ошибка при загрузке постов: {e}")
+        logger.error(f"Ошибка при загрузке данных: {e}")
+    # Незавершенные рассылки продолжаются с сохраненного курсора (в одном процессе)
+    if owns_broadcasts():
+        if BROADCAST_STAGING_CHAT_ID is None:
+            logger.warning("BROADCAST_STAGING_CHAT_ID не задан: рассылки отправляют пост каждому целиком, без copy_message")
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.error(f"Ошибка при возобновлении рассылок: {e}")
     try:
-        bot_info = await bot.get_me()
+        bot_info = await bot_context.refresh()
         logger.info(f"Бот @{bot_info.username} готов к работе")
     except Exception as e:
         logger.error(f"Ошибка при запуске: {e}")
+    # В многопроцессном режиме вебхук ставит принимающий процесс
+    if BOT_MODE == "webhook" and worker_index is None:
+        await register_webhook()
 
 
 async def on_shutdown():
     """Действия при остановке бота"""
+    await stop_broadcasts()
+    await download_counter.stop()
+    await fsm_storage.stop()
+    await drafts.stop()
+    try:
+        await storage.close()
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии хранилища: {e}")
     logger.info("⛔️ Бот остановлен!")
 
 
+async def register_webhook():
+    """Сообщает Telegram адрес вебхука (если задан WEBHOOK_URL)"""
+    if not WEBHOOK_URL:
+        return
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Вебхук установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    except Exception as e:
+        logger.error(f"Ошибка установки вебхука: {e}")
+
+
+async def healthcheck(request: web.Request):
+    """Проверка живости для балансировщика"""
+    return web.Response(text="ok")
+
+
+async def run_webhook():
+    """Прием апдейтов через aiohttp-сервер вместо long polling"""
+    app = web.Application()
+    # Запросы без правильного секретного заголовка отклоняются с 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", healthcheck)
+    # on_startup/on_shutdown диспетчера вызываются при старте и остановке приложения
+    setup_application(app, dp, bot=bot)
+    await serve_app(app)
+
+
+async def serve_app(app: web.Application):
+    """Запускает aiohttp-приложение и держит его до остановки бота"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Сервер вебхука слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        # Вебхук не снимаем: апдейты дождутся перезапуска в очереди Telegram
+        await runner.cleanup()
+
+
 async def main():
     """Главная функция запуска"""
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+            logger.error("Для режима webhook нужен WEBHOOK_SECRET")
+            return
+        if BOT_WORKERS > 1:
+            if STORAGE_BACKEND != "sqlite":
+                logger.error("Для BOT_WORKERS > 1 нужно общее хранилище: STORAGE_BACKEND=sqlite")
+                return
+            await run_front()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Апдейты не приходят в getUpdates, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
     finally: